@@ -0,0 +1,493 @@
+import functools
+import struct
+
+from afpreader import AP2_DEFINE_SPRITE, AP2_PLACE_OBJECT, AP2_SHAPE
+
+"""
+Builds decoded afp files and GE2D geo files from a description of what's in them, following AFP_FORMAT.MD: add shapes,
+sprites, place objects, frames and labels to a clip and build() lays the file out. Every string goes through one
+interned string table, so each is stored once, and the whole file is sized up front and written into a single
+preallocated buffer with precompiled Structs.
+
+The output is a decoded afp, the same as decode_afp.py produces. encode_afp.py (or any BSI) turns it into what the game
+loads.
+"""
+
+# Decoded afp magic, see AP2Header in AFP_FORMAT.MD.
+AFP_MAGIC = b'\x08\xb2\xd0\xc1'
+
+# Modern afp libs only accept 0x200.
+AFP_VERSION = 0x200
+
+# AP2Header flags. The others aren't understood, and can be passed to AfpBuilder as they are.
+FLAG_BG_COLOR = 0x1
+FLAG_FIXED_FPS = 0x2
+FLAG_INITIALIZERS = 0x4
+
+HEADER = struct.Struct("<4sIHHIHHHH")
+FPS = struct.Struct("<i")
+BG_COLOR = struct.Struct("<4B")
+ATTRIBUTES = struct.Struct("<HhIIIII")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+
+# ExportedTag, Label, ImportedTag's header, NamedTagReference and AP2ShapeTag are all two u16s.
+PAIR = struct.Struct("<HH")
+FRAME_BYTECODE = struct.Struct("<HHII")
+TAGS_BASE_HEADER = struct.Struct("<HHIIIII")
+
+# Sprite flags, id and the offset of its TagsBaseHeader from the start of the tag data.
+SPRITE_HEADER = struct.Struct("<HHI")
+
+MAX_TAG_LENGTH = 0x3FFFFF
+MAX_FRAME_TAGS = 0xFFF
+MAX_FRAME_START = 0xFFFFF
+
+
+class AfpBuildError(Exception):
+    pass
+
+
+def pad4(length):
+    return (length + 3) & ~3
+
+
+class StringPool(object):
+    """
+    An afp string table. Each string is stored once, NUL terminated and padded out to 4 bytes, and offset 0 is the
+    empty string.
+    """
+    def __init__(self, encoding="shift-jis"):
+        self.encoding = encoding
+        self.offsets = {"": 0}
+        self.strings = []
+        self.size = 4
+
+    def add(self, value):
+        offset = self.offsets.get(value)
+        if offset is None:
+            encoded = value.encode(self.encoding)
+            offset = self.offsets[value] = self.size
+            if offset > 0xFFFF:
+                raise AfpBuildError("String table is too big for a 16 bit offset to \"%s\"" % value)
+            self.strings.append((offset, encoded))
+            self.size += pad4(len(encoded) + 1)
+        return offset
+
+    def write_into(self, buffer, offset):
+        # The buffer is zeroed, so terminators and padding are already there.
+        for string_offset, encoded in self.strings:
+            start = offset + string_offset
+            buffer[start:start + len(encoded)] = encoded
+
+
+# Place object fields PlaceObject can write, in file order: (flag, attribute, format, scale). None marks where the
+# fields are realigned to 4 bytes. Scales match the ones afpreader divides by.
+PLACE_OBJECT_FIELDS = (
+    (0x2, 'src_tag_id', "H", None),
+    (0x20, 'name', "H", None),
+    (0x20000, 'blend', "B", None),
+    None,
+    (0x100, 'scale', "ii", 1024.0),
+    (0x200, 'rotate', "ii", 1024.0),
+    (0x400, 'translate', "ii", 20.0),
+    (0x800, 'mult_color', "4h", 255.0),
+    (0x1000, 'add_color', "4h", 255.0),
+    (0x1000000, 'rot_origin', "ii", 20.0),
+)
+PLACE_OBJECT_FLAGS = tuple((field[0], field[1]) for field in PLACE_OBJECT_FIELDS if field is not None)
+
+
+@functools.lru_cache(maxsize=None)
+def place_object_layout(flags1):
+    """
+    The precompiled Struct for a place object with these flags, and the fields that go in it after flags1, depth and
+    object id. Its size is the tag length, padding included.
+    """
+    layout = "<IHH"
+    size = 8
+    fields = []
+    for field in PLACE_OBJECT_FIELDS:
+        if field is None:
+            layout += "x" * (-size & 3)
+            size = pad4(size)
+            continue
+
+        flag, name, format, scale = field
+        if flags1 & flag:
+            layout += format
+            size += struct.calcsize("<" + format)
+            fields.append((name, scale))
+
+    layout += "x" * (-size & 3)
+    return struct.Struct(layout), tuple(fields)
+
+
+class PlaceObject(object):
+    """
+    An AP2_PLACE_OBJECT tag. Values are in the units afpreader decodes them to: scale (a, d) and rotate (b, c) as
+    matrix factors, translate and rot_origin in pixels and colors as 0 to 1 (r, g, b, a). Fields left as None aren't
+    written. update modifies the object already placed at depth instead of placing a new one.
+    """
+    __slots__ = (
+        'depth', 'object_id', 'update', 'src_tag_id', 'name', 'blend', 'scale', 'rotate', 'translate', 'mult_color',
+        'add_color', 'rot_origin',
+    )
+
+    def __init__(self, depth, object_id, src_tag_id=None, name=None, update=False, blend=None, scale=None, rotate=None,
+                 translate=None, mult_color=None, add_color=None, rot_origin=None):
+        self.depth = depth
+        self.object_id = object_id
+        self.update = update
+        self.src_tag_id = src_tag_id
+        self.name = name
+        self.blend = blend
+        self.scale = scale
+        self.rotate = rotate
+        self.translate = translate
+        self.mult_color = mult_color
+        self.add_color = add_color
+        self.rot_origin = rot_origin
+
+    @property
+    def flags1(self):
+        flags = 0x1 if self.update else 0
+        for flag, name in PLACE_OBJECT_FLAGS:
+            if getattr(self, name) is not None:
+                flags |= flag
+
+        # New placements always use their transform, updates only when they change it.
+        if not self.update or flags & 0x700:
+            flags |= 0x4
+        if flags & 0x1800:
+            flags |= 0x8
+        return flags
+
+    def layout(self):
+        # flags1 and its place_object_layout(), worked out once per build.
+        flags1 = self.flags1
+        return (flags1,) + place_object_layout(flags1)
+
+    def write_into(self, buffer, offset, strings, layout=None):
+        flags1, layout, fields = layout or self.layout()
+
+        values = [flags1, self.depth, self.object_id]
+        for name, scale in fields:
+            value = getattr(self, name)
+            if name == 'name':
+                values.append(strings.add(value))
+            elif scale is None:
+                values.append(value)
+            else:
+                values += [int(round(x * scale)) for x in value]
+
+        layout.pack_into(buffer, offset, *values)
+
+
+class ClipBuilder(object):
+    """
+    The root clip or a sprite: its tags in the order they're added, and the frames and labels that point into them.
+    Definition tags (shapes, sprites) should be added before the control tags that use them.
+    """
+    def __init__(self, afp, sprite_id=None):
+        self.afp = afp
+        self.sprite_id = sprite_id
+
+        # (tag type, ShapeTag flags and id / ClipBuilder / PlaceObject)
+        self.tags = []
+        self.frames = []
+        self.labels = []
+        self.funcnames = []
+        self._frame_start = 0
+
+        # (length, place object layout) of every tag, from the last size().
+        self._tag_layouts = None
+
+    def add_shape(self, shape_id, flags=0x2):
+        """
+        Defines a shape, which draws the geo file <movie>_shape<shape_id>. flags 0x2 marks a textured shape. A shape
+        that's already defined isn't defined again.
+        """
+        if self.afp.define(shape_id, ('shape', flags)):
+            self.tags.append((AP2_SHAPE, (flags, shape_id)))
+
+    def add_sprite(self, sprite_id):
+        # Defines a sprite and returns its clip, to add its tags and frames to.
+        if not self.afp.define(sprite_id, ('sprite', sprite_id)):
+            raise AfpBuildError("Sprite %d is already defined" % sprite_id)
+
+        clip = ClipBuilder(self.afp, sprite_id)
+        self.tags.append((AP2_DEFINE_SPRITE, clip))
+        return clip
+
+    def place(self, depth, object_id, **fields):
+        # Adds a place object tag, see PlaceObject for the fields.
+        tag = PlaceObject(depth, object_id, **fields)
+        if tag.name is not None:
+            self.afp.strings.add(tag.name)
+        self.tags.append((AP2_PLACE_OBJECT, tag))
+        return tag
+
+    def show_frame(self, frames=1):
+        """
+        Ends a frame, which plays every tag added since the last one. Any further frames play nothing, and hold what's
+        on screen.
+        """
+        count = len(self.tags) - self._frame_start
+        if count > MAX_FRAME_TAGS or self._frame_start > MAX_FRAME_START:
+            raise AfpBuildError("Frame %d has too many tags to index" % len(self.frames))
+
+        self.frames.append((self._frame_start, count))
+        self._frame_start = len(self.tags)
+        if frames > 1:
+            self.frames += [(self._frame_start, 0)] * (frames - 1)
+
+    def add_label(self, name, frame):
+        self.labels.append((frame, self.afp.strings.add(name)))
+
+    def add_funcname(self, name, frame):
+        self.funcnames.append((frame, self.afp.strings.add(name)))
+
+    def _header_size(self):
+        # funcname_count follows the TagsBaseHeader when there are funcnames.
+        return TAGS_BASE_HEADER.size + (4 if self.funcnames else 0)
+
+    def _tag_layout(self, tag_type, tag):
+        if tag_type == AP2_SHAPE:
+            return PAIR.size, None
+        elif tag_type == AP2_DEFINE_SPRITE:
+            return SPRITE_HEADER.size + tag.size(), None
+
+        layout = tag.layout()
+        return layout[1].size, layout
+
+    def size(self):
+        # Also lays out every tag, for the write_into() that follows.
+        self._tag_layouts = [self._tag_layout(tag_type, tag) for tag_type, tag in self.tags]
+
+        size = self._header_size() + (len(self.labels) + len(self.funcnames) + len(self.frames)) * 4
+        for length, _ in self._tag_layouts:
+            size += 4 + pad4(length)
+        return size
+
+    def write_into(self, buffer, base):
+        if self._tag_layouts is None or len(self._tag_layouts) != len(self.tags):
+            self.size()
+
+        labels_offset = self._header_size()
+        frames_offset = labels_offset + (len(self.labels) + len(self.funcnames)) * 4
+        tags_offset = frames_offset + len(self.frames) * 4
+
+        TAGS_BASE_HEADER.pack_into(
+            buffer, base, 4 if self.funcnames else 0, len(self.labels), len(self.frames), len(self.tags),
+            labels_offset, frames_offset, tags_offset
+        )
+        if self.funcnames:
+            U16.pack_into(buffer, base + TAGS_BASE_HEADER.size, len(self.funcnames))
+
+        offset = base + labels_offset
+        for frame, string_offset in self.labels + self.funcnames:
+            PAIR.pack_into(buffer, offset, frame, string_offset)
+            offset += 4
+
+        for start, count in self.frames:
+            U32.pack_into(buffer, offset, start | (count << 20))
+            offset += 4
+
+        for (tag_type, tag), (length, layout) in zip(self.tags, self._tag_layouts):
+            if length > MAX_TAG_LENGTH:
+                raise AfpBuildError("Tag is too long: %d bytes" % length)
+
+            U32.pack_into(buffer, offset, (tag_type << 22) | length)
+            offset += 4
+
+            if tag_type == AP2_SHAPE:
+                PAIR.pack_into(buffer, offset, *tag)
+            elif tag_type == AP2_DEFINE_SPRITE:
+                SPRITE_HEADER.pack_into(buffer, offset, 1, tag.sprite_id, SPRITE_HEADER.size)
+                tag.write_into(buffer, offset + SPRITE_HEADER.size)
+            else:
+                tag.write_into(buffer, offset, self.afp.strings, layout)
+            offset += pad4(length)
+        self._tag_layouts = None
+
+
+class AfpBuilder(object):
+    """
+    A decoded afp being built. bounds is the composition's (left, right, top, bottom). flags are extra AP2Header
+    flags to set; the ones for the background color, fps and initializers are set from what's added.
+    """
+    def __init__(self, name, bounds, fps=60.0, bg_color=None, flags=0):
+        self.strings = StringPool()
+        self.name_offset = self.strings.add(name)
+        self.bounds = bounds
+        self.fps = fps
+        self.bg_color = bg_color
+        self.flags = flags
+
+        self.exports = []
+        self.imports = []
+        self.initializers = []
+        self.defined = {}
+        self.root = ClipBuilder(self)
+
+    def define(self, object_id, definition):
+        # Returns False if the id is already defined as the same thing, and raises if it's something else.
+        previous = self.defined.get(object_id)
+        if previous is None:
+            self.defined[object_id] = definition
+            return True
+        if previous != definition:
+            raise AfpBuildError("Object id %d is already defined as a %s" % (object_id, previous[0]))
+        return False
+
+    def add_export(self, name, tag_id):
+        self.exports.append((tag_id, self.strings.add(name)))
+
+    def add_import(self, name, references):
+        # references are the (tag id, name) pairs imported from name.
+        self.imports.append((self.strings.add(name), [(tag_id, self.strings.add(x)) for tag_id, x in references]))
+
+    def add_initializer(self, tag_id, frame, bytecode=b""):
+        self.initializers.append((tag_id, frame, bytes(bytecode)))
+
+    def build(self):
+        flags = self.flags | FLAG_FIXED_FPS
+        if self.bg_color is not None:
+            flags |= FLAG_BG_COLOR
+        if self.initializers:
+            flags |= FLAG_INITIALIZERS
+
+        # Lay out every section first, so the buffer is only allocated once.
+        offset = HEADER.size + FPS.size + (BG_COLOR.size if self.bg_color is not None else 0) + ATTRIBUTES.size
+        if self.initializers:
+            offset += U32.size
+
+        exported_tags_offset = offset
+        offset += len(self.exports) * PAIR.size
+
+        imported_tags_offset = offset
+        offset += sum(PAIR.size * (1 + len(references)) for _, references in self.imports)
+
+        initializers_offset = offset
+        if self.initializers:
+            offset += 4 + FRAME_BYTECODE.size * len(self.initializers)
+            offset += sum(pad4(len(bytecode)) for _, _, bytecode in self.initializers)
+
+        tags_base_offset = offset
+        offset += self.root.size()
+
+        string_table_offset = offset
+        length = string_table_offset + self.strings.size
+
+        data = bytearray(length)
+        left, right, top, bottom = self.bounds
+        HEADER.pack_into(data, 0, AFP_MAGIC, length, AFP_VERSION, self.name_offset, flags, left, right, top, bottom)
+
+        offset = HEADER.size
+        FPS.pack_into(data, offset, int(round(self.fps * 1024)))
+        offset += FPS.size
+        if self.bg_color is not None:
+            BG_COLOR.pack_into(data, offset, *self.bg_color)
+            offset += BG_COLOR.size
+
+        ATTRIBUTES.pack_into(
+            data, offset, len(self.exports), len(self.imports), tags_base_offset, exported_tags_offset,
+            imported_tags_offset, string_table_offset, self.strings.size
+        )
+        if self.initializers:
+            U32.pack_into(data, offset + ATTRIBUTES.size, initializers_offset)
+
+        offset = exported_tags_offset
+        for export in self.exports:
+            PAIR.pack_into(data, offset, *export)
+            offset += PAIR.size
+
+        for string_offset, references in self.imports:
+            PAIR.pack_into(data, offset, string_offset, len(references))
+            offset += PAIR.size
+            for reference in references:
+                PAIR.pack_into(data, offset, *reference)
+                offset += PAIR.size
+
+        if self.initializers:
+            # Bytecode follows the table, at offsets relative to the start of the section.
+            PAIR.pack_into(data, initializers_offset, 0, len(self.initializers))
+            offset = initializers_offset + 4
+            bytecode_offset = 4 + FRAME_BYTECODE.size * len(self.initializers)
+            for tag_id, frame, bytecode in self.initializers:
+                FRAME_BYTECODE.pack_into(data, offset, tag_id, frame, bytecode_offset if bytecode else 0, len(bytecode))
+                offset += FRAME_BYTECODE.size
+                start = initializers_offset + bytecode_offset
+                data[start:start + len(bytecode)] = bytecode
+                bytecode_offset += pad4(len(bytecode))
+
+        self.root.write_into(data, tags_base_offset)
+        self.strings.write_into(data, string_table_offset)
+        return data
+
+
+GEO_MAGIC = b"GE2D"
+
+# Magic, two version words, file size and a zero word. The texture size that follows is little endian.
+GEO_HEADER = struct.Struct(">4sIIII")
+GEO_TEXTURE_SIZE = struct.Struct("<HH")
+
+# Textured flag, an unknown word, then the rect points, texture points, unknown, label table and unknown data offsets.
+GEO_OFFSETS = struct.Struct(">IIIIIII")
+GEO_POINTS = struct.Struct(">8f")
+GEO_UNKNOWN = struct.Struct(">7I")
+
+# The unknown data block ends with an offset into itself. The words around it are the ones every geo genoverlay writes
+# has always had, for solid and textured shapes.
+GEO_UNKNOWN_SOLID = (0x0409ffff, 0x00060000, 0xff00ffff)
+GEO_UNKNOWN_TEXTURED = (0x040300ff, 0x00060000, 0x00000000)
+GEO_UNKNOWN_TAIL = (0x00000001, 0x00020002, 0x00010003)
+
+
+def build_geo(texture_size, rect, uv=None, label=None):
+    """
+    A GE2D geo file for a quad. rect and uv are the 4 corners (top left, top right, bottom left, bottom right), uv on
+    the texture as 0 to 1. Without uv the quad is a solid shape. label is the texture name, NUL terminated and padded
+    to 4 bytes.
+    """
+    encoded_label = label.encode('shift-jis') if label is not None else None
+
+    offset = GEO_HEADER.size + GEO_TEXTURE_SIZE.size + GEO_OFFSETS.size
+    labels_offset = 0
+    if encoded_label is not None:
+        labels_offset = offset
+        offset += 4 + pad4(len(encoded_label) + 1)
+
+    rects_offset = offset
+    offset += GEO_POINTS.size
+
+    texture_points_offset = 0
+    if uv is not None:
+        texture_points_offset = offset
+        offset += GEO_POINTS.size
+
+    unknown_offset = offset
+    length = offset + GEO_UNKNOWN.size
+
+    data = bytearray(length)
+    GEO_HEADER.pack_into(data, 0, GEO_MAGIC, 0x00010000, 0x00010100, length, 0)
+    GEO_TEXTURE_SIZE.pack_into(data, GEO_HEADER.size, *texture_size)
+    GEO_OFFSETS.pack_into(
+        data, GEO_HEADER.size + GEO_TEXTURE_SIZE.size, 1 if uv is not None else 0, 0x00010000, rects_offset,
+        texture_points_offset, 0, labels_offset, unknown_offset
+    )
+
+    if encoded_label is not None:
+        struct.pack_into(">I", data, labels_offset, labels_offset + 4)
+        data[labels_offset + 4:labels_offset + 4 + len(encoded_label)] = encoded_label
+
+    GEO_POINTS.pack_into(data, rects_offset, *[x for point in rect for x in point])
+    if uv is not None:
+        GEO_POINTS.pack_into(data, texture_points_offset, *[x for point in uv for x in point])
+
+    GEO_UNKNOWN.pack_into(
+        data, unknown_offset, *(GEO_UNKNOWN_TEXTURED if uv is not None else GEO_UNKNOWN_SOLID),
+        unknown_offset + 0x10, *GEO_UNKNOWN_TAIL
+    )
+    return data
@@ -0,0 +1,494 @@
+import argparse
+import glob
+import hashlib
+import os
+import sqlite3
+import struct
+import time
+
+from lxml import etree
+
+from afpreader import AP2_SHAPE, AfpFile, AfpParseError
+from decode_afp import AfpDecodeError, decode_afp_data, find_afp_files, find_bsi, run_in_pool
+from geoindex import GEO_FILENAME
+from georeader import GeoParseError, read_geo
+
+"""
+Indexes a whole extracted dump (every *_ifs folder with its afp, afp/bsi, geo and tex/texturelist.xml) into a SQLite
+database, so finding which movie exports a sprite, uses a frame label or references a texture is a single indexed
+query instead of decoding and grepping every archive.
+
+Files are parsed by worker processes and their rows are written by this process alone, in batched transactions.
+Updates only parse files whose mtime or size changed, and of those only the ones whose SHA-1 changed too, so
+re-indexing a dump after a game update only costs as much as the files that actually changed.
+"""
+
+# Bump when SCHEMA or the way files are parsed changes, so old databases get rebuilt.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    archive TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha1 TEXT,
+    error TEXT
+);
+
+-- One row per afp. movie is the afp's filename, which geo files and afplist.xml go by, and name the name in its header.
+CREATE TABLE IF NOT EXISTS movies (
+    file_id INTEGER PRIMARY KEY,
+    movie TEXT NOT NULL,
+    name TEXT NOT NULL,
+    frame_count INTEGER NOT NULL,
+    fps REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS exports (
+    file_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    tag_id INTEGER NOT NULL
+);
+
+-- Frame labels and funcnames of the root clip (sprite_id NULL) and of every sprite.
+CREATE TABLE IF NOT EXISTS labels (
+    file_id INTEGER NOT NULL,
+    sprite_id INTEGER,
+    name TEXT NOT NULL,
+    frame INTEGER NOT NULL,
+    funcname INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS shapes (
+    file_id INTEGER NOT NULL,
+    shape_id INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS geo (
+    file_id INTEGER PRIMARY KEY,
+    movie TEXT NOT NULL,
+    shape_id INTEGER NOT NULL,
+    label TEXT,
+    texture_width INTEGER NOT NULL,
+    texture_height INTEGER NOT NULL
+);
+
+-- imgrect is left, right, top, bottom in half pixels, as in texturelist.xml.
+CREATE TABLE IF NOT EXISTS images (
+    file_id INTEGER NOT NULL,
+    texture TEXT NOT NULL,
+    format TEXT,
+    name TEXT NOT NULL,
+    left INTEGER NOT NULL,
+    right INTEGER NOT NULL,
+    top INTEGER NOT NULL,
+    bottom INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS movies_movie ON movies (movie);
+CREATE INDEX IF NOT EXISTS movies_name ON movies (name);
+CREATE INDEX IF NOT EXISTS exports_name ON exports (name);
+CREATE INDEX IF NOT EXISTS exports_file ON exports (file_id);
+CREATE INDEX IF NOT EXISTS labels_name ON labels (name);
+CREATE INDEX IF NOT EXISTS labels_file ON labels (file_id);
+CREATE INDEX IF NOT EXISTS shapes_file ON shapes (file_id, shape_id);
+CREATE INDEX IF NOT EXISTS geo_label ON geo (label);
+CREATE INDEX IF NOT EXISTS geo_shape ON geo (movie, shape_id);
+CREATE INDEX IF NOT EXISTS images_name ON images (name);
+CREATE INDEX IF NOT EXISTS images_file ON images (file_id);
+"""
+
+# Every table with rows that belong to a file, in the order they're filled in.
+ROW_TABLES = {
+    'movies': "INSERT INTO movies VALUES (?, ?, ?, ?, ?)",
+    'exports': "INSERT INTO exports VALUES (?, ?, ?)",
+    'labels': "INSERT INTO labels VALUES (?, ?, ?, ?, ?)",
+    'shapes': "INSERT INTO shapes VALUES (?, ?)",
+    'geo': "INSERT INTO geo VALUES (?, ?, ?, ?, ?, ?)",
+    'images': "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+}
+
+# Parsed files are committed in batches of this many, so an interrupted update keeps most of its work.
+COMMIT_EVERY = 1000
+
+
+def default_database_filename():
+    return "afpindex.db"
+
+
+def find_ifs_folders(path):
+    # A single extracted IFS folder, a dump folder of *_ifs folders or a glob pattern of IFS folders.
+    if os.path.isdir(path):
+        if any(os.path.isdir(os.path.join(path, x)) for x in ("afp", "geo", "tex")):
+            return [path]
+        path = os.path.join(path, "*_ifs")
+
+    return sorted(x for x in glob.glob(path, recursive=True) if os.path.isdir(x))
+
+
+def _stat(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def scan_dump(ifs_folders):
+    """
+    (path, archive, kind, bsi path, mtime, size) of every afp, geo file and texturelist in the IFS folders. An afp's
+    mtime and size cover its bsi too, since a changed bsi changes what it decodes to.
+    """
+    files = []
+    for ifs_folder in ifs_folders:
+        archive = os.path.basename(os.path.normpath(ifs_folder))
+
+        afp_folder = os.path.join(ifs_folder, "afp")
+        if os.path.isdir(afp_folder):
+            for afp_filename in find_afp_files(afp_folder):
+                bsi_filename = find_bsi(afp_filename)
+                mtime, size = _stat(afp_filename)
+                if bsi_filename is not None:
+                    bsi_mtime, bsi_size = _stat(bsi_filename)
+                    mtime, size = max(mtime, bsi_mtime), size + bsi_size
+                files.append((os.path.abspath(afp_filename), archive, "afp", bsi_filename, mtime, size))
+
+        geo_folder = os.path.join(ifs_folder, "geo")
+        if os.path.isdir(geo_folder):
+            with os.scandir(geo_folder) as entries:
+                for entry in entries:
+                    if GEO_FILENAME.match(entry.name) is None or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    files.append((os.path.abspath(entry.path), archive, "geo", None, stat.st_mtime_ns, stat.st_size))
+
+        texturelist_filename = os.path.join(ifs_folder, "tex", "texturelist.xml")
+        if os.path.isfile(texturelist_filename):
+            mtime, size = _stat(texturelist_filename)
+            files.append((os.path.abspath(texturelist_filename), archive, "texturelist", None, mtime, size))
+
+    files.sort()
+    return files
+
+
+def afp_rows(afp_filename, afp_data, bsi_data):
+    if bsi_data is not None:
+        decode_afp_data(afp_data, bsi_data)
+    afp = AfpFile(afp_data)
+
+    labels = []
+    for clip in afp.clips:
+        labels += [(clip.sprite_id, name, frame, 0) for name, frame in clip.labels]
+        labels += [(clip.sprite_id, name, frame, 1) for name, frame in clip.funcnames]
+
+    return {
+        'movies': [(os.path.basename(afp_filename), afp.name, afp.root.frame_count, afp.fps)],
+        'exports': afp.exports,
+        'labels': labels,
+        'shapes': [(afp.parse_tag(i).id,) for i in range(len(afp)) if afp.tag_types[i] == AP2_SHAPE],
+    }
+
+
+def geo_rows(geo_filename, data):
+    match = GEO_FILENAME.match(os.path.basename(geo_filename))
+    geo = read_geo(data)
+    return {
+        'geo': [(match.group('movie'), int(match.group('shape_id')), geo['label'], geo['texture_width'], geo['texture_height'])],
+    }
+
+
+def texturelist_rows(data):
+    texturelist = etree.fromstring(data)
+
+    images = []
+    for texture in texturelist.iterchildren("texture"):
+        for image in texture.iterchildren("image"):
+            left, right, top, bottom = [int(x) for x in image.find("imgrect").text.split()]
+            images.append((texture.attrib["name"], texture.attrib.get("format"), image.attrib["name"], left, right, top, bottom))
+
+    return {'images': images}
+
+
+# Errors a broken file can raise while it's being parsed. It's recorded with the error instead of stopping the run.
+PARSE_ERRORS = (
+    AfpDecodeError, AfpParseError, GeoParseError, etree.XMLSyntaxError, struct.error, ValueError, IndexError,
+    AttributeError, KeyError,
+)
+
+
+def read_file(path, bsi_filename):
+    # Returns (data, bsi data, sha1). data is writable, so an afp can be decoded in place.
+    with open(path, "rb") as infile:
+        data = bytearray(infile.read())
+    bsi_data = None
+    if bsi_filename is not None:
+        with open(bsi_filename, "rb") as infile:
+            bsi_data = infile.read()
+
+    sha1 = hashlib.sha1(data)
+    if bsi_data is not None:
+        sha1.update(bsi_data)
+    return data, bsi_data, sha1.hexdigest()
+
+
+def parse_rows(path, kind, data, bsi_data=None):
+    # The rows of one file, by table. An afp is decoded first if bsi_data is given.
+    if kind == "afp":
+        return afp_rows(path, data, bsi_data)
+    elif kind == "geo":
+        return geo_rows(path, data)
+    return texturelist_rows(bytes(data))
+
+
+def _index_file(path, kind, bsi_filename, known_sha1):
+    # Returns (path, sha1, rows, error). rows is None when the file's content hasn't changed since known_sha1.
+    try:
+        data, bsi_data, sha1 = read_file(path, bsi_filename)
+    except OSError as e:
+        return path, None, {}, str(e)
+
+    if sha1 == known_sha1:
+        return path, sha1, None, None
+
+    try:
+        return path, sha1, parse_rows(path, kind, data, bsi_data), None
+    except PARSE_ERRORS as e:
+        return path, sha1, {}, str(e)
+
+
+class AfpIndex(object):
+    """
+    The SQLite index of a dump. Only one thread writes to it at a time, but that doesn't need to be the thread that
+    opened it, so pipeline.py can write from its last stage.
+    """
+    def __init__(self, database_filename):
+        self.db = sqlite3.connect(database_filename, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            with self.db:
+                for table in ["files"] + list(ROW_TABLES):
+                    self.db.execute("DROP TABLE IF EXISTS %s" % table)
+                self.db.executescript(SCHEMA)
+                self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+        self.known = None
+        self._pending = 0
+
+    def close(self):
+        self.db.close()
+
+    def _delete_rows(self, file_id):
+        for table in ROW_TABLES:
+            self.db.execute("DELETE FROM %s WHERE file_id = ?" % table, (file_id,))
+
+    def load_known(self):
+        # path -> (file id, mtime, size, sha1) of every file in the index.
+        self.known = {
+            path: (file_id, mtime, size, sha1)
+            for file_id, path, mtime, size, sha1 in self.db.execute("SELECT id, path, mtime, size, sha1 FROM files")
+        }
+        return self.known
+
+    def is_current(self, path, mtime, size):
+        old = self.known.get(path)
+        return old is not None and old[1] == mtime and old[2] == size
+
+    def known_sha1(self, path):
+        old = self.known.get(path)
+        return None if old is None else old[3]
+
+    def begin(self):
+        self.db.execute("BEGIN")
+        self._pending = 0
+
+    def commit(self):
+        self.db.execute("COMMIT")
+        self._pending = 0
+
+    def remove_missing(self, paths):
+        # Drops every file that isn't in paths. Returns how many were dropped.
+        removed = [old[0] for path, old in self.known.items() if path not in paths]
+        for file_id in removed:
+            self._delete_rows(file_id)
+            self.db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        return len(removed)
+
+    def write_file(self, path, archive, kind, mtime, size, sha1, rows, error=None):
+        """
+        Replaces the rows of one file inside the current transaction, which is committed every COMMIT_EVERY files.
+        rows is None for a file that was touched but whose sha1 didn't change.
+        """
+        old = self.known.get(path)
+
+        if rows is None:
+            # Only the mtime needs updating.
+            self.db.execute("UPDATE files SET mtime = ?, size = ? WHERE id = ?", (mtime, size, old[0]))
+        elif old is not None:
+            file_id = old[0]
+            self._delete_rows(file_id)
+            self.db.execute(
+                "UPDATE files SET archive = ?, kind = ?, mtime = ?, size = ?, sha1 = ?, error = ? WHERE id = ?",
+                (archive, kind, mtime, size, sha1, error, file_id)
+            )
+        else:
+            file_id = self.db.execute(
+                "INSERT INTO files (path, archive, kind, mtime, size, sha1, error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, archive, kind, mtime, size, sha1, error)
+            ).lastrowid
+
+        if rows:
+            for table, table_rows in rows.items():
+                self.db.executemany(ROW_TABLES[table], ((file_id,) + tuple(row) for row in table_rows))
+
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self.commit()
+            self.begin()
+
+    def update(self, ifs_folders, jobs=None, rebuild=False):
+        """
+        Brings the index in line with the IFS folders: new and changed files are parsed, and files that are gone
+        are dropped. The index always mirrors the folders of the last update. Returns (parsed, unchanged, removed,
+        errors), with errors a list of (path, error).
+        """
+        self.load_known()
+
+        scanned = {}
+        tasks = []
+        for path, archive, kind, bsi_filename, mtime, size in scan_dump(ifs_folders):
+            scanned[path] = (archive, kind, mtime, size)
+            if not rebuild and self.is_current(path, mtime, size):
+                continue
+            tasks.append((path, kind, bsi_filename, None if rebuild else self.known_sha1(path)))
+
+        unchanged = len(scanned) - len(tasks)
+        parsed = 0
+        errors = []
+
+        self.begin()
+        removed = self.remove_missing(scanned)
+
+        for path, sha1, rows, error in run_in_pool(_index_file, tasks, jobs):
+            archive, kind, mtime, size = scanned[path]
+            self.write_file(path, archive, kind, mtime, size, sha1, rows, error)
+
+            if rows is None:
+                unchanged += 1
+                continue
+            if error is not None:
+                errors.append((path, error))
+            parsed += 1
+
+        self.commit()
+        return parsed, unchanged, removed, errors
+
+    def errors(self):
+        return self.db.execute("SELECT path, error FROM files WHERE error IS NOT NULL ORDER BY path").fetchall()
+
+    # Lookups take SQLite GLOB patterns: exact names, or with * and ? wildcards. They're case sensitive, and a
+    # pattern that starts with a fixed prefix still uses the index.
+
+    def find_export(self, name):
+        # (archive, movie, export name, tag id) of every export matching name.
+        return self.db.execute(
+            "SELECT files.archive, movies.movie, exports.name, exports.tag_id FROM exports "
+            "JOIN movies USING (file_id) JOIN files ON files.id = exports.file_id "
+            "WHERE exports.name GLOB ? ORDER BY files.archive, movies.movie", (name,)
+        ).fetchall()
+
+    def find_label(self, name):
+        # (archive, movie, sprite id or None for the root clip, label, frame, is funcname) of every matching label.
+        return self.db.execute(
+            "SELECT files.archive, movies.movie, labels.sprite_id, labels.name, labels.frame, labels.funcname FROM labels "
+            "JOIN movies USING (file_id) JOIN files ON files.id = labels.file_id "
+            "WHERE labels.name GLOB ? ORDER BY files.archive, movies.movie, labels.sprite_id, labels.frame", (name,)
+        ).fetchall()
+
+    def find_texture(self, name):
+        """
+        Where the matching texturelist images are and what uses them: a list of (archive, texture, format, image
+        name, imgrect) and a list of (archive, movie, shape id, image name) of the shapes whose geo file names them.
+        """
+        images = [
+            (archive, texture, texture_format, image, (left, right, top, bottom))
+            for archive, texture, texture_format, image, left, right, top, bottom in self.db.execute(
+                "SELECT files.archive, images.texture, images.format, images.name, images.left, images.right, images.top, images.bottom "
+                "FROM images JOIN files ON files.id = images.file_id "
+                "WHERE images.name GLOB ? ORDER BY files.archive, images.name", (name,)
+            )
+        ]
+        shapes = self.db.execute(
+            "SELECT files.archive, geo.movie, geo.shape_id, geo.label FROM geo JOIN files ON files.id = geo.file_id "
+            "WHERE geo.label GLOB ? ORDER BY files.archive, geo.movie, geo.shape_id", (name,)
+        ).fetchall()
+        return images, shapes
+
+    def find_movie(self, name):
+        # (archive, movie, name, frame count, fps) of every movie whose filename or header name matches.
+        return self.db.execute(
+            "SELECT files.archive, movies.movie, movies.name, movies.frame_count, movies.fps FROM movies "
+            "JOIN files ON files.id = movies.file_id WHERE movies.movie GLOB ?1 OR movies.name GLOB ?1 "
+            "ORDER BY files.archive, movies.movie", (name,)
+        ).fetchall()
+
+    def counts(self):
+        return {table: self.db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0] for table in ["files"] + list(ROW_TABLES)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dump', nargs='?', help='Extracted dump folder of *_ifs folders, one IFS folder or a glob pattern of them. Leave out to only query.')
+    parser.add_argument('-db', default=default_database_filename(), help="Database filename. Defaults to afpindex.db")
+    parser.add_argument('-export', nargs='+', default=[], help='Find the movies that export these names')
+    parser.add_argument('-label', nargs='+', default=[], help='Find the movies and sprites with these frame labels or funcnames')
+    parser.add_argument('-texture', nargs='+', default=[], help='Find these texturelist images and the shapes that use them')
+    parser.add_argument('-movie', nargs='+', default=[], help='Find movies by filename or header name')
+    parser.add_argument('-rebuild', action='store_true', help="Parse every file again instead of updating the index")
+    parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes. Defaults to the CPU count.")
+    args = parser.parse_args()
+
+    index = AfpIndex(args.db)
+
+    if args.dump is not None:
+        ifs_folders = find_ifs_folders(args.dump)
+        if not ifs_folders:
+            print("No IFS folders found in", args.dump)
+            exit(1)
+
+        start_time = time.perf_counter()
+        parsed, unchanged, removed, errors = index.update(ifs_folders, args.jobs, args.rebuild)
+        for path, error in errors:
+            print("Failed to index %s: %s" % (path, error))
+        print("Indexed %d files from %d folders (%d unchanged, %d removed, %d failed) in %.2fs" % (
+            parsed, len(ifs_folders), unchanged, removed, len(errors), time.perf_counter() - start_time
+        ))
+        print(", ".join("%s:%d" % x for x in index.counts().items()))
+
+    start_time = time.perf_counter()
+    for name in args.export:
+        for archive, movie, export, tag_id in index.find_export(name):
+            print("export \"%s\": %s/%s id:%d" % (export, archive, movie, tag_id))
+
+    for name in args.label:
+        for archive, movie, sprite_id, label, frame, funcname in index.find_label(name):
+            print("%s \"%s\": %s/%s %s frame %d" % (
+                "funcname" if funcname else "label", label, archive, movie, "root" if sprite_id is None else "sprite %d" % sprite_id, frame
+            ))
+
+    for name in args.texture:
+        images, shapes = index.find_texture(name)
+        for archive, texture, texture_format, image, rect in images:
+            print("image \"%s\": %s/%s %s imgrect:%s" % (image, archive, texture, texture_format, rect))
+        for archive, movie, shape_id, image in shapes:
+            print("shape \"%s\": %s/%s shape %d" % (image, archive, movie, shape_id))
+
+    for name in args.movie:
+        for archive, movie, movie_name, frame_count, fps in index.find_movie(name):
+            print("movie %s/%s \"%s\": %d frames at %.2f fps" % (archive, movie, movie_name, frame_count, fps))
+
+    if args.export or args.label or args.texture or args.movie:
+        print("Queried in %.1fms" % ((time.perf_counter() - start_time) * 1000))
+
+    index.close()
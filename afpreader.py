@@ -0,0 +1,789 @@
+import argparse
+import collections
+import functools
+import mmap
+import struct
+from array import array
+
+"""
+Reads a decoded afp file, following the layout in AFP_FORMAT.MD and afp.hexpat. Tags are indexed up front into
+flat arrays of offsets, types and lengths (including the tags inside sprites), and only decoded when accessed.
+"""
+
+# Every tag found in an AFP file, by tag id. Matches the Ap2Tag function in afp.hexpat.
+AP2_TAGS = {
+    0x0: "END",
+    0x1: "SHOW_FRAME",
+    0x2: "DEFINE_SHAPE",
+    0x4: "PLACE_OBJECT",
+    0x5: "REMOVE_OBJECT",
+    0x6: "DEFINE_BITS",
+    0x7: "DEFINE_BUTTON",
+    0x8: "JPEG_TABLES",
+    0x9: "BACKGROUND_COLOR",
+    0xA: "DEFINE_FONT",
+    0xB: "DEFINE_TEXT",
+    0xC: "DO_ACTION",
+    0xD: "DEFINE_FONT_INFO",
+    0xE: "DEFINE_SOUND",
+    0xF: "START_SOUND",
+    0x11: "DEFINE_BUTTON_SOUND",
+    0x12: "SOUND_STREAM_HEAD",
+    0x13: "SOUND_STREAM_BLOCK",
+    0x14: "DEFINE_BITS_LOSSLESS",
+    0x15: "DEFINE_BITS_JPEG2",
+    0x16: "DEFINE_SHAPE2",
+    0x17: "DEFINE_BUTTON_CXFORM",
+    0x18: "PROTECT",
+    0x1A: "PLACE_OBJECT2",
+    0x1C: "REMOVE_OBJECT2",
+    0x20: "DEFINE_SHAPE3",
+    0x21: "DEFINE_TEXT2",
+    0x22: "DEFINE_BUTTON2",
+    0x23: "DEFINE_BITS_JPEG3",
+    0x24: "DEFINE_BITS_LOSSLESS2",
+    0x25: "DEFINE_EDIT_TEXT",
+    0x27: "DEFINE_SPRITE",
+    0x2B: "FRAME_LABEL",
+    0x2D: "SOUND_STREAM_HEAD2",
+    0x2E: "DEFINE_MORPH_SHAPE",
+    0x30: "DEFINE_FONT2",
+    0x38: "EXPORT_ASSETS",
+    0x39: "IMPORT_ASSETS",
+    0x3B: "DO_INIT_ACTION",
+    0x3C: "DEFINE_VIDEO_STREAM",
+    0x3D: "VIDEO_FRAME",
+    0x3E: "DEFINE_FONT_INFO2",
+    0x40: "ENABLE_DEBUGGER2",
+    0x41: "SCRIPT_LIMITS",
+    0x42: "SET_TAB_INDEX",
+    0x46: "PLACE_OBJECT3",
+    0x47: "IMPORT_ASSETS2",
+    0x4B: "DEFINE_FONT3",
+    0x4D: "METADATA",
+    0x4E: "DEFINE_SCALING_GRID",
+    0x53: "DEFINE_SHAPE4",
+    0x54: "DEFINE_MORPH_SHAPE2",
+    0x56: "SCENE_LABEL",
+    0x64: "AFP_IMAGE",
+    0x65: "AFP_DEFINE_SOUND",
+    0x66: "AFP_SOUND_STREAM_BLOCK",
+    0x67: "AFP_DEFINE_FONT",
+    0x68: "AFP_DEFINE_SHAPE",
+    0x6E: "AEP_PLACE_OBJECT",
+    0x78: "AP2_DEFINE_FONT",
+    0x79: "AP2_DEFINE_SPRITE",
+    0x7A: "AP2_DO_ACTION",
+    0x7B: "AP2_DEFINE_BUTTON",
+    0x7C: "AP2_DEFINE_BUTTON_SOUND",
+    0x7D: "AP2_DEFINE_TEXT",
+    0x7E: "AP2_DEFINE_EDIT_TEXT",
+    0x7F: "AP2_PLACE_OBJECT",
+    0x80: "AP2_REMOVE_OBJECT",
+    0x81: "AP2_START_SOUND",
+    0x82: "AP2_DEFINE_MORPH_SHAPE",
+    0x83: "AP2_IMAGE",
+    0x84: "AP2_SHAPE",
+    0x85: "AP2_SOUND",
+    0x86: "AP2_VIDEO",
+    0x88: "AP2_PLACE_CAMERA",
+    0x89: "AP2_SCALING_GRID",
+}
+
+AP2_DEFINE_SPRITE = 0x79
+AP2_DO_ACTION = 0x7A
+AP2_PLACE_OBJECT = 0x7F
+AP2_REMOVE_OBJECT = 0x80
+AP2_IMAGE = 0x83
+AP2_SHAPE = 0x84
+AP2_PLACE_CAMERA = 0x88
+
+ShapeTag = collections.namedtuple('ShapeTag', ['flags', 'id'])
+ImageTag = collections.namedtuple('ImageTag', ['flags', 'id', 'name'])
+SpriteTag = collections.namedtuple('SpriteTag', ['flags', 'id', 'clip'])
+RemoveObjectTag = collections.namedtuple('RemoveObjectTag', ['object_id', 'depth'])
+PlaceCameraTag = collections.namedtuple('PlaceCameraTag', ['flags', 'camera_id', 'center', 'focal_length'])
+
+
+class AfpParseError(Exception):
+    pass
+
+
+# Steps a compiled place object layout is made of.
+STEP_STRUCT = 0
+STEP_ALIGN = 1
+STEP_EVENTS = 2
+STEP_SHORT_MATRIX = 3
+STEP_VECTOR_MASK = 4
+STEP_COLORED_VECTOR_MASK = 5
+
+
+class PlaceObjectTag(object):
+    """
+    A decoded AP2_PLACE_OBJECT. Only the fields present in the tag are set, everything else reads as None.
+    """
+    __slots__ = (
+        'flags1', 'flags2', 'depth', 'object_id', 'src_tag_id', 'label_id', 'name_offset', 'name', 'unk3', 'blend',
+        'matrix_a', 'matrix_b', 'matrix_c', 'matrix_d', 'matrix_tx', 'matrix_ty', 'mult_color', 'add_color',
+        'event_data', 'filter_count', 'filter_size', 'rot_origin_x', 'rot_origin_y', 'rot_origin_z', 'unk_4',
+        'translate_z_3d', 'matrix_3d', 'hsl', 'vector_mask', 'ap2_image_1', 'ap2_image_2',
+        'colored_vector_mask',
+    )
+
+    def __getattr__(self, name):
+        # Only called for slots that were never set.
+        if name in PlaceObjectTag.__slots__:
+            return None
+        raise AttributeError(name)
+
+    def __repr__(self):
+        fields = ["%s:%r" % (name, getattr(self, name)) for name in self.__slots__ if getattr(self, name) is not None]
+        return "<%s %s>" % (self.__class__.__name__, " ".join(fields))
+
+    @property
+    def update(self):
+        # Updates the object already placed at this depth instead of placing a new one.
+        return bool(self.flags1 & 0x1)
+
+    @property
+    def reset_rot_origin(self):
+        return bool(self.flags1 & 0x2000000)
+
+
+class VectorMask(object):
+    """
+    The flags2 & 0x8 vector mask, see VECTOR_MASK.md. The slot data is kept as raw bytes and only decoded by slots.
+    """
+    __slots__ = ('bitmask', 'data')
+
+    def __init__(self, bitmask, data):
+        self.bitmask = bitmask
+        self.data = data
+
+    def __repr__(self):
+        return "<%s bitmask:0x%x size:%d>" % (self.__class__.__name__, self.bitmask, len(self.data))
+
+    @staticmethod
+    def slot_size(vertex_flags, vertex_count):
+        components = 6 if vertex_flags & 0x10 else 2
+        return vertex_count * components * (4 if vertex_flags & 0x1 else 2)
+
+    @classmethod
+    def measure(cls, data, offset):
+        # Size of the mask starting at offset, bitmask included.
+        bitmask = struct.unpack_from("<I", data, offset)[0]
+        size = 4
+        for slot in range(32):
+            if bitmask & (1 << slot):
+                vertex_flags, vertex_count = struct.unpack_from("<HH", data, offset + size)
+                size += 4 + cls.slot_size(vertex_flags, vertex_count)
+        return bitmask, size
+
+    @property
+    def slots(self):
+        # (slot index, vertex flags, [(anchor, tangent_in, tangent_out)]) for every slot in the bitmask, in pixels.
+        # The tangents are None for straight slots.
+        slots = []
+        offset = 0
+        for slot in range(32):
+            if not self.bitmask & (1 << slot):
+                continue
+
+            vertex_flags, vertex_count = struct.unpack_from("<HH", self.data, offset)
+            offset += 4
+            size = self.slot_size(vertex_flags, vertex_count)
+            coords = [x / 20.0 for x in struct.unpack_from(
+                "<%d%s" % (size // (4 if vertex_flags & 0x1 else 2), "i" if vertex_flags & 0x1 else "h"), self.data, offset
+            )]
+            offset += size
+
+            vertices = []
+            stride = 6 if vertex_flags & 0x10 else 2
+            for i in range(0, len(coords), stride):
+                if stride == 6:
+                    vertices.append((tuple(coords[i:i+2]), tuple(coords[i+2:i+4]), tuple(coords[i+4:i+6])))
+                else:
+                    vertices.append((tuple(coords[i:i+2]), None, None))
+
+            slots.append((slot, vertex_flags, vertices))
+
+        return slots
+
+
+class ColoredVectorMask(object):
+    """
+    The flags2 & 0x40 colored vector mask: an optional VectorMask, a palette of packed RGBA colors and a palette
+    index for each slot. Only the header is documented in VECTOR_MASK.md, so the layout of the palette and indices
+    in the tag is a best guess.
+    """
+    __slots__ = ('sub_flags', 'mask', 'palette_bitmask', 'palette', 'color_indices')
+
+    def __init__(self, sub_flags, mask, palette_bitmask, palette, color_indices):
+        self.sub_flags = sub_flags
+        self.mask = mask
+        self.palette_bitmask = palette_bitmask
+        self.palette = palette
+        self.color_indices = color_indices
+
+    def __repr__(self):
+        return "<%s sub_flags:0x%x mask:%r palette:%r>" % (self.__class__.__name__, self.sub_flags, self.mask, self.palette)
+
+    @classmethod
+    def parse(cls, data, offset):
+        # Returns the mask and its size, up to but not including the padding after it.
+        sub_flags = struct.unpack_from("<I", data, offset)[0]
+        size = 4
+
+        mask = None
+        if sub_flags & 0x1:
+            bitmask, mask_size = VectorMask.measure(data, offset + size)
+            mask = VectorMask(bitmask, data[offset + size + 4:offset + size + mask_size])
+            size += mask_size
+
+        palette_bitmask = None
+        palette = None
+        if sub_flags & 0x2:
+            # One u32 color for each slot in the palette bitmask.
+            palette_bitmask = struct.unpack_from("<I", data, offset + size)[0]
+            count = bin(palette_bitmask).count("1")
+            palette = struct.unpack_from("<%dI" % count, data, offset + size + 4)
+            size += 4 + count * 4
+
+        color_indices = None
+        if sub_flags & 0x4:
+            # One palette index byte for each slot of the mask.
+            count = bin(mask.bitmask).count("1") if mask is not None else 0
+            color_indices = bytes(data[offset + size:offset + size + count])
+            size += count
+
+        return cls(sub_flags, mask, palette_bitmask, palette, color_indices), size
+
+
+class _PlaceObjectLayoutBuilder(object):
+    # Merges runs of fixed size fields into as few Structs as possible. offset is the position within the tag
+    # where the pending Struct starts, or None once a variable size field has made it unknown.
+    def __init__(self):
+        self.steps = []
+        self.offset = 0
+        self.format = ""
+        self.fields = []
+        self.value_count = 0
+
+    @property
+    def position(self):
+        if self.offset is None:
+            return None
+        return self.offset + struct.calcsize("<" + self.format)
+
+    def add(self, name, format, count=1, scale=None, reverse=False):
+        # Each field is (name, first value, value count, scale, reverse) into the unpacked values. Values are divided
+        # by the scale.
+        self.fields.append((name, self.value_count, count, scale, reverse))
+        self.value_count += count
+        self.format += format
+
+    def align(self):
+        if self.offset is None:
+            self.flush()
+            self.steps.append((STEP_ALIGN,))
+        else:
+            self.format += "%dx" % (-self.position & 3)
+
+    def variable(self, step):
+        self.flush()
+        self.steps.append((step,))
+        self.offset = None
+
+    def flush(self):
+        if self.fields:
+            layout = struct.Struct("<" + self.format)
+            self.steps.append((STEP_STRUCT, layout, tuple(self.fields)))
+            if self.offset is not None:
+                self.offset += layout.size
+        elif self.offset is not None:
+            self.offset += struct.calcsize("<" + self.format)
+
+        self.format = ""
+        self.fields = []
+        self.value_count = 0
+
+
+class PlaceObjectLayout(object):
+    """
+    How to decode one (flags1, flags2) combination: a list of steps, mostly precompiled Structs with a table of
+    field names and scales. Without event data, a place object is decoded with a single unpack_from.
+    """
+    __slots__ = ('flags1', 'flags2', 'steps', 'short_matrix_offset')
+
+    def __init__(self, flags1, flags2, short_matrix):
+        self.flags1 = flags1
+        self.flags2 = flags2
+
+        # The flags1 & 0x40000 matrix is only there if the tag has room left for it. Where it would start, if that's
+        # known up front. Otherwise the check is made while decoding.
+        self.short_matrix_offset = None
+
+        flags = flags1 | (flags2 << 32)
+        builder = _PlaceObjectLayoutBuilder()
+
+        builder.add('flags1', "I")
+        builder.add('depth', "H")
+        builder.add('object_id', "H")
+        if flags1 & 0x80000000:
+            builder.add('flags2', "I")
+        if flags & 0x2:
+            builder.add('src_tag_id', "H")
+        if flags & 0x10:
+            builder.add('label_id', "H")
+        if flags & 0x20:
+            builder.add('name_offset', "H")
+        if flags & 0x40:
+            builder.add('unk3', "H")
+        if flags & 0x20000:
+            builder.add('blend', "B")
+        builder.align()
+
+        if flags & 0x100:
+            builder.add('matrix_a', "i", scale=1024.0)
+            builder.add('matrix_d', "i", scale=1024.0)
+        if flags & 0x200:
+            builder.add('matrix_b', "i", scale=1024.0)
+            builder.add('matrix_c', "i", scale=1024.0)
+        if flags & 0x400:
+            builder.add('matrix_tx', "i", scale=20.0)
+            builder.add('matrix_ty', "i", scale=20.0)
+
+        # Colors are r, g, b, a. The u8 variants are stored backwards.
+        if flags & 0x800:
+            builder.add('mult_color', "4h", 4, 255.0)
+        if flags & 0x1000:
+            builder.add('add_color', "4h", 4, 255.0)
+        if flags & 0x2000:
+            builder.add('mult_color', "4B", 4, 255.0, reverse=True)
+        if flags & 0x4000:
+            builder.add('add_color', "4B", 4, 255.0, reverse=True)
+
+        if flags & 0x80:
+            builder.variable(STEP_EVENTS)
+
+        if flags & 0x10000:
+            builder.add('filter_count', "H")
+            builder.add('filter_size', "H")
+        if flags & 0x1000000:
+            builder.add('rot_origin_x', "i", scale=20.0)
+            builder.add('rot_origin_y', "i", scale=20.0)
+        if flags & 0x200000000:
+            builder.add('rot_origin_z', "i", scale=20.0)
+
+        if flags & 0x40000:
+            if builder.offset is None:
+                builder.flush()
+                builder.steps.append((STEP_SHORT_MATRIX, struct.Struct("<hh"), (
+                    ('matrix_a', 0, 1, 32768.0, False), ('matrix_d', 1, 1, 32768.0, False),
+                )))
+            else:
+                self.short_matrix_offset = builder.position
+                if short_matrix:
+                    builder.add('matrix_a', "h", scale=32768.0)
+                    builder.add('matrix_d', "h", scale=32768.0)
+        if flags & 0x80000:
+            builder.add('matrix_b', "h", scale=32768.0)
+            builder.add('matrix_c', "h", scale=32768.0)
+        if flags & 0x100000:
+            builder.add('unk_4', "H")
+        builder.align()
+
+        if flags & 0x8000000:
+            builder.add('translate_z_3d', "i", scale=20.0)
+        if flags & 0x10000000:
+            builder.add('matrix_3d', "9i", 9, 1024.0)
+        if flags & 0x20000000:
+            # Hue, saturation, lightness
+            builder.add('hsl', "hbb", 3)
+
+        # flags2 & 0x4 has no data.
+        if flags & 0x800000000:
+            builder.variable(STEP_VECTOR_MASK)
+
+        if flags & 0x1000000000:
+            builder.add('ap2_image_1', "Ihh", 3)
+        if flags & 0x2000000000:
+            builder.add('ap2_image_2', "Hhh", 3)
+        builder.align()
+
+        if flags & 0x4000000000:
+            builder.variable(STEP_COLORED_VECTOR_MASK)
+            builder.align()
+
+        builder.flush()
+        self.steps = builder.steps
+
+    def decode(self, data, offset, length):
+        tag = PlaceObjectTag()
+        tag.flags2 = 0
+        position = offset
+        end = offset + length
+
+        for step in self.steps:
+            kind = step[0]
+
+            if kind == STEP_STRUCT or kind == STEP_SHORT_MATRIX:
+                _, layout, fields = step
+                if kind == STEP_SHORT_MATRIX and position - offset >= length:
+                    continue
+
+                values = layout.unpack_from(data, position)
+                position += layout.size
+
+                for name, first, count, scale, reverse in fields:
+                    if count == 1:
+                        value = values[first]
+                        if scale is not None:
+                            value /= scale
+                    else:
+                        value = values[first:first + count]
+                        if scale is not None:
+                            value = tuple(x / scale for x in value)
+                        if reverse:
+                            value = value[::-1]
+                    setattr(tag, name, value)
+
+            elif kind == STEP_ALIGN:
+                position += -(position - offset) & 3
+
+            elif kind == STEP_EVENTS:
+                # Event flags and the length of the whole block, header included.
+                event_length = struct.unpack_from("<I", data, position + 4)[0]
+                tag.event_data = data[position:position + event_length]
+                position += event_length
+
+            elif kind == STEP_VECTOR_MASK:
+                bitmask, size = VectorMask.measure(data, position)
+                tag.vector_mask = VectorMask(bitmask, data[position + 4:position + size])
+                position += size
+
+            elif kind == STEP_COLORED_VECTOR_MASK:
+                tag.colored_vector_mask, size = ColoredVectorMask.parse(data, position)
+                position += size
+
+            if position > end:
+                raise AfpParseError("Place object at 0x%x runs past the end of the tag" % offset)
+
+        return tag
+
+
+@functools.lru_cache(maxsize=None)
+def place_object_layout(flags1, flags2, short_matrix=True):
+    return PlaceObjectLayout(flags1, flags2, short_matrix)
+
+
+class Clip(object):
+    """
+    The root movie clip or a sprite: a TagsBaseHeader and the frames, labels and tags it points to.
+    """
+    __slots__ = (
+        'afp', 'sprite_id', 'parent', 'base_offset', 'name_reference_flags', 'frame_label_count', 'frame_count',
+        'tags_count', 'frame_labels_offset', 'frames_offset', 'tags_offset', 'funcname_count', 'first_tag',
+    )
+
+    def __init__(self, afp, sprite_id, parent, base_offset):
+        self.afp = afp
+        self.sprite_id = sprite_id
+        self.parent = parent
+        self.base_offset = base_offset
+
+        self.name_reference_flags, self.frame_label_count, self.frame_count, self.tags_count, \
+            self.frame_labels_offset, self.frames_offset, self.tags_offset = struct.unpack_from("<HHIIIII", afp.data, base_offset)
+
+        self.funcname_count = 0
+        if self.name_reference_flags & 4:
+            self.funcname_count = struct.unpack_from("<H", afp.data, base_offset + 0x18)[0]
+
+        # Index into the afp's tag index of this clip's first tag. A clip's tags are always contiguous there.
+        self.first_tag = 0
+
+    def __repr__(self):
+        return "<%s %s frames:%d tags:%d>" % (
+            self.__class__.__name__, "root" if self.sprite_id is None else "id:%d" % self.sprite_id,
+            self.frame_count, self.tags_count
+        )
+
+    @property
+    def frames(self):
+        # (start tag index, number of tags to play) for every frame. The start index is relative to this clip's tags.
+        return [
+            (frame_info & 0xFFFFF, (frame_info >> 20) & 0xFFF)
+            for frame_info, in struct.iter_unpack("<I", self.afp.data[self.base_offset + self.frames_offset:][:self.frame_count * 4])
+        ]
+
+    def _labels(self, start, count):
+        offset = self.base_offset + self.frame_labels_offset + start * 4
+        return [
+            (self.afp.string(string_offset), frameno)
+            for frameno, string_offset in struct.iter_unpack("<HH", self.afp.data[offset:offset + count * 4])
+        ]
+
+    @property
+    def labels(self):
+        return self._labels(0, self.frame_label_count)
+
+    @property
+    def funcnames(self):
+        # Funcnames don't have an offset of their own, they always follow right after the frame labels.
+        return self._labels(self.frame_label_count, self.funcname_count)
+
+    @property
+    def tags(self):
+        return [self.afp.tag(i) for i in range(self.first_tag, self.first_tag + self.tags_count)]
+
+
+class Tag(object):
+    """
+    A lightweight view of one entry in the tag index. The tag data is only decoded by parse().
+    """
+    __slots__ = ('afp', 'index')
+
+    def __init__(self, afp, index):
+        self.afp = afp
+        self.index = index
+
+    def __repr__(self):
+        return "<%s %s @ 0x%x length:%d>" % (self.__class__.__name__, self.name, self.offset, self.length)
+
+    @property
+    def tag_type(self):
+        return self.afp.tag_types[self.index]
+
+    @property
+    def name(self):
+        return AP2_TAGS.get(self.tag_type, "Unknown tag id")
+
+    @property
+    def offset(self):
+        # Offset of the tag data, just past the tag header.
+        return self.afp.tag_offsets[self.index]
+
+    @property
+    def length(self):
+        return self.afp.tag_lengths[self.index]
+
+    @property
+    def clip(self):
+        clip = self.afp.tag_clips[self.index]
+        return self.afp.clips[clip]
+
+    @property
+    def data(self):
+        return self.afp.data[self.offset:self.offset + self.length]
+
+    def parse(self):
+        return self.afp.parse_tag(self.index)
+
+
+class AfpFile(object):
+    """
+    A decoded afp file. data can be anything that supports the buffer protocol, and is never copied.
+    """
+    def __init__(self, data):
+        self.data = memoryview(data).cast('B')
+
+        if len(self.data) < 0x18 or self.data[1:4] != b'\xb2\xd0\xc1':
+            raise AfpParseError("Unexpected magic bytes. Has your data been decoded yet?")
+
+        self.magic, self.length, self.version, self.name_offset, self.flags, \
+            self.left, self.right, self.top, self.bottom = struct.unpack_from("<4sIHHIHHHH", self.data, 0)
+
+        offset = 0x18
+        if self.flags & 0x2:
+            self.fps = struct.unpack_from("<i", self.data, offset)[0] / 1024.0
+        else:
+            self.fps = struct.unpack_from("<f", self.data, offset)[0]
+        offset += 4
+
+        self.bg_color = None
+        if self.flags & 0x1:
+            self.bg_color = struct.unpack_from("<BBBB", self.data, offset)
+            offset += 4
+
+        self.num_exported_assets, self.imported_tags_count, self.tags_base_offset, self.exported_tags_offset, \
+            self.imported_tags_offset, self.string_table_offset, self.string_table_size = struct.unpack_from("<HhIIIII", self.data, offset)
+        offset += 0x18
+
+        self.imported_tag_initializers_offset = None
+        if self.flags & 0x4:
+            self.imported_tag_initializers_offset = struct.unpack_from("<I", self.data, offset)[0]
+
+        self._string_table = None
+
+        # The tag index. Every tag of every clip gets one entry in each array.
+        self.tag_offsets = array('I')
+        self.tag_lengths = array('I')
+        self.tag_types = array('H')
+        self.tag_clips = array('H')
+        self.clips = []
+
+        # Tag index of each AP2_DEFINE_SPRITE tag -> index of its clip
+        self.sprite_clips = {}
+
+        # How many place objects were decoded with each (flags1, flags2) layout.
+        self.place_object_layouts = collections.Counter()
+
+        self._index_tags()
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, "rb") as infile:
+            return cls(mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self.tag_offsets)
+
+    def __iter__(self):
+        return (Tag(self, i) for i in range(len(self.tag_offsets)))
+
+    def tag(self, index):
+        return Tag(self, index)
+
+    @property
+    def root(self):
+        return self.clips[0]
+
+    @property
+    def name(self):
+        return self.string(self.name_offset)
+
+    def string(self, offset):
+        if self._string_table is None:
+            self._string_table = bytes(self.data[self.string_table_offset:self.string_table_offset + self.string_table_size])
+
+        end = self._string_table.find(b'\0', offset)
+        return self._string_table[offset:end if end >= 0 else None].decode('shift-jis', errors='replace')
+
+    @property
+    def exports(self):
+        offset = self.exported_tags_offset
+        return [
+            (self.string(string_offset), tag_id)
+            for tag_id, string_offset in struct.iter_unpack("<HH", self.data[offset:offset + self.num_exported_assets * 4])
+        ]
+
+    def _index_tags(self):
+        # Clips are indexed breadth first, so each clip's own tags stay contiguous in the index and
+        # frame start indices can be mapped with a single addition.
+        self.clips.append(Clip(self, None, None, self.tags_base_offset))
+
+        clip_index = 0
+        while clip_index < len(self.clips):
+            clip = self.clips[clip_index]
+            clip.first_tag = len(self.tag_offsets)
+
+            offset = clip.base_offset + clip.tags_offset
+            for _ in range(clip.tags_count):
+                if offset + 4 > len(self.data):
+                    raise AfpParseError("Tag at 0x%x runs past the end of the file" % offset)
+
+                tag_header = struct.unpack_from("<I", self.data, offset)[0]
+                tag_type = (tag_header >> 22) & 0x3FF
+                length = tag_header & 0x3FFFFF
+                offset += 4
+
+                if tag_type == AP2_DEFINE_SPRITE:
+                    sprite_flags, sprite_id = struct.unpack_from("<HH", self.data, offset)
+                    base_offset = offset + (8 if sprite_flags & 1 else 4)
+                    self.sprite_clips[len(self.tag_offsets)] = len(self.clips)
+                    self.clips.append(Clip(self, sprite_id, clip_index, base_offset))
+
+                self.tag_offsets.append(offset)
+                self.tag_lengths.append(length)
+                self.tag_types.append(tag_type)
+                self.tag_clips.append(clip_index)
+
+                # Tag data is padded out to 4 bytes.
+                offset += (length + 3) & ~3
+
+            clip_index += 1
+
+    def parse_tag(self, index):
+        tag_type = self.tag_types[index]
+        offset = self.tag_offsets[index]
+        length = self.tag_lengths[index]
+
+        if tag_type == AP2_SHAPE:
+            return ShapeTag(*struct.unpack_from("<HH", self.data, offset))
+
+        elif tag_type == AP2_IMAGE:
+            flags, image_id, string_offset = struct.unpack_from("<IHH", self.data, offset)
+            return ImageTag(flags, image_id, self.string(string_offset))
+
+        elif tag_type == AP2_DEFINE_SPRITE:
+            flags, sprite_id = struct.unpack_from("<HH", self.data, offset)
+            return SpriteTag(flags, sprite_id, self.clips[self.sprite_clips[index]])
+
+        elif tag_type == AP2_REMOVE_OBJECT:
+            return RemoveObjectTag(*struct.unpack_from("<HH", self.data, offset))
+
+        elif tag_type == AP2_PLACE_CAMERA:
+            flags, camera_id = struct.unpack_from("<HH", self.data, offset)
+            offset += 4
+
+            center = None
+            if flags & 0x1:
+                center = tuple(x / 20.0 for x in struct.unpack_from("<iii", self.data, offset))
+                offset += 12
+
+            focal_length = None
+            if flags & 0x2:
+                focal_length = struct.unpack_from("<i", self.data, offset)[0] / 20.0
+
+            return PlaceCameraTag(flags, camera_id, center, focal_length)
+
+        elif tag_type == AP2_PLACE_OBJECT:
+            return self.parse_place_object(offset, length)
+
+        # Everything else (e.g. AP2_DO_ACTION bytecode) is left as raw data.
+        return self.data[offset:offset + length]
+
+    def parse_place_object(self, offset, length):
+        flags1 = struct.unpack_from("<I", self.data, offset)[0]
+        flags2 = struct.unpack_from("<I", self.data, offset + 8)[0] if flags1 & 0x80000000 else 0
+
+        layout = place_object_layout(flags1, flags2)
+        if layout.short_matrix_offset is not None and layout.short_matrix_offset >= length:
+            layout = place_object_layout(flags1, flags2, False)
+        self.place_object_layouts[(flags1, flags2)] += 1
+
+        tag = layout.decode(self.data, offset, length)
+        if tag.name_offset is not None:
+            tag.name = self.string(tag.name_offset)
+        return tag
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_afp', help='Input decoded AFP file')
+    parser.add_argument('-tags', action='store_true', help='Print every tag')
+    args = parser.parse_args()
+
+    afp = AfpFile.from_file(args.input_afp)
+
+    print("Name: \"%s\", fps: %s, flags: 0x%02x" % (afp.name, afp.fps, afp.flags))
+    print("Exports:", afp.exports)
+
+    for clip in afp.clips:
+        print(clip)
+        if clip.labels:
+            print("  Labels:", clip.labels)
+        if clip.funcnames:
+            print("  Funcnames:", clip.funcnames)
+
+    print("Tags:", collections.Counter(tag.name for tag in afp))
+
+    if args.tags:
+        for tag in afp:
+            print(tag, tag.parse())
+
+        print("Place objects: %d, distinct layouts: %d" % (
+            sum(afp.place_object_layouts.values()), len(afp.place_object_layouts)
+        ))
+        for (flags1, flags2), count in afp.place_object_layouts.most_common():
+            print("  flags1:0x%08x flags2:0x%x %d" % (flags1, flags2, count))
@@ -0,0 +1,81 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from texturelist import GUTTER, PackNode, pack_images
+
+"""
+Compares the MaxRects packer behind create_texturelist with the old PackNode loop, which filled fixed 1024x1024
+canvases and retried every image that didn't fit on a new one. Density is the area of the cells over the area of
+the canvases they ended up on.
+"""
+
+PACKNODE_SIZE = (1024, 1024)
+
+
+def random_sizes(count, seed, min_size=8, max_size=300):
+    # Mostly small sprites with the odd large one, like the pix_* archives.
+    rng = random.Random(seed)
+    sizes = []
+    for _ in range(count):
+        scale = max_size if rng.random() < 0.05 else max_size // 4
+        sizes.append((rng.randint(min_size, scale) + GUTTER * 2, rng.randint(min_size, scale) + GUTTER * 2))
+    return sizes
+
+
+def uniform_sizes(count, size=200):
+    return [(size + GUTTER * 2, size + GUTTER * 2)] * count
+
+
+def pack_packnode(sizes):
+    # The old create_texturelist loop, minus the images. Returns the canvas sizes.
+    canvases = []
+    remaining = list(sizes)
+    while remaining:
+        tree = PackNode(PACKNODE_SIZE)
+        not_used = []
+        for size in remaining:
+            if tree.insert(size) is None:
+                not_used.append(size)
+
+        if len(not_used) == len(remaining):
+            raise ValueError("%dx%d doesn't fit in a %dx%d canvas" % (remaining[0] + PACKNODE_SIZE))
+
+        remaining = not_used
+        canvases.append(PACKNODE_SIZE)
+    return canvases
+
+
+def pack_maxrects(sizes):
+    return pack_images(sizes)[1]
+
+
+def run(name, pack, sizes):
+    start_time = time.perf_counter()
+    try:
+        canvases = pack(sizes)
+    except RecursionError:
+        print("  %-10s hit the recursion limit" % name)
+        return
+    elapsed = time.perf_counter() - start_time
+
+    used = sum(width * height for width, height in sizes)
+    total = sum(width * height for width, height in canvases)
+    print("  %-10s %4d canvases  density %5.1f%%  %8.3fs" % (name, len(canvases), used * 100.0 / total, elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-counts', type=int, nargs='+', default=[100, 1000, 3000], help='Number of images to pack')
+    parser.add_argument('-seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for count in args.counts:
+        for label, sizes in (("random", random_sizes(count, args.seed)), ("uniform", uniform_sizes(count))):
+            print("%d %s images" % (count, label))
+            run("PackNode", pack_packnode, sizes)
+            run("MaxRects", pack_maxrects, sizes)
@@ -0,0 +1,256 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import generators
+from bench_packer import pack_packnode
+from decode_afp import decode_afp_data, deobfuscate_string_table, obfuscate_string_table
+from genoverlay import parse_animation
+from geoindex import GeoIndex
+from georeader import read_geo
+from texturelist import GUTTER, pack_images
+
+"""
+Runs every stage of the toolchain on synthetic inputs from generators.py and saves throughput, peak RSS and packing
+density as JSON, so runs on different commits can be compared with -compare. Nothing is read from a game dump.
+
+Each stage runs in a fresh process, so its peak RSS isn't hidden by an earlier stage's. Inputs are generated in that
+process before the clock starts, and the peak includes them.
+"""
+
+RESULTS_VERSION = 1
+
+DEFAULT_RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Metrics where lower is better, for -compare.
+LOWER_IS_BETTER = ("seconds", "peak_rss_mb", "canvases")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_decode(params, seed):
+    files = [
+        generators.afp_pair(params['afp_size'], params['swap_mix'], params['string_table_size'], seed + i)
+        for i in range(params['afp_count'])
+    ]
+    buffers = [(bytearray(encoded), bsi) for encoded, bsi, decoded in files]
+
+    start_time = time.perf_counter()
+    for afp_data, bsi_data in buffers:
+        decode_afp_data(afp_data, bsi_data)
+    elapsed = time.perf_counter() - start_time
+
+    total = sum(len(afp_data) for afp_data, bsi_data in buffers)
+    if any(bytes(afp_data) != decoded for (afp_data, bsi_data), (encoded, bsi, decoded) in zip(buffers, files)):
+        raise ValueError("Decoded afp doesn't match what was encoded")
+
+    return {'seconds': elapsed, 'mb_per_sec': total / elapsed / 1024 / 1024, 'files_per_sec': len(buffers) / elapsed}
+
+
+def bench_string_table(params, seed):
+    table = generators.string_table(params['string_table_size'], seed)
+    tables = []
+    for _ in range(params['string_table_count']):
+        tables.append(bytearray(table))
+        obfuscate_string_table(memoryview(tables[-1]))
+
+    start_time = time.perf_counter()
+    for data in tables:
+        deobfuscate_string_table(memoryview(data))
+    elapsed = time.perf_counter() - start_time
+
+    return {'seconds': elapsed, 'mb_per_sec': len(table) * len(tables) / elapsed / 1024 / 1024}
+
+
+def bench_geo(params, seed):
+    with tempfile.TemporaryDirectory() as temp_folder:
+        filenames = generators.write_geo_folder(temp_folder, params['geo_count'], seed)
+
+        start_time = time.perf_counter()
+        total = 0
+        for filename in filenames:
+            with open(filename, "rb") as infile:
+                data = infile.read()
+            read_geo(data)
+            total += len(data)
+        elapsed = time.perf_counter() - start_time
+
+        index_start_time = time.perf_counter()
+        GeoIndex.build(temp_folder)
+        index_elapsed = time.perf_counter() - index_start_time
+
+    return {
+        'seconds': elapsed, 'files_per_sec': len(filenames) / elapsed, 'mb_per_sec': total / elapsed / 1024 / 1024,
+        'index_files_per_sec': len(filenames) / index_elapsed,
+    }
+
+
+def _packing_result(sizes, canvases, elapsed):
+    used = sum(width * height for width, height in sizes)
+    total = sum(width * height for width, height in canvases)
+    return {
+        'seconds': elapsed, 'sprites_per_sec': len(sizes) / elapsed, 'canvases': len(canvases),
+        'density': used / float(total),
+    }
+
+
+def bench_pack_maxrects(params, seed):
+    sizes = [(w + GUTTER * 2, h + GUTTER * 2) for w, h in generators.sprite_sizes(params['sprite_count'], seed)]
+    start_time = time.perf_counter()
+    placements, canvases = pack_images(sizes)
+    return _packing_result(sizes, canvases, time.perf_counter() - start_time)
+
+
+def bench_pack_packnode(params, seed):
+    # The old packer can't fit anything over 1024 px, so those are left out.
+    sizes = [
+        (w + GUTTER * 2, h + GUTTER * 2) for w, h in generators.sprite_sizes(params['sprite_count'], seed)
+        if max(w, h) + GUTTER * 2 <= 1024
+    ]
+    start_time = time.perf_counter()
+    canvases = pack_packnode(sizes)
+    return _packing_result(sizes, canvases, time.perf_counter() - start_time)
+
+
+def bench_genoverlay(params, seed):
+    sizes = generators.sprite_sizes(params['build_sprite_count'], seed)
+    with tempfile.TemporaryDirectory() as temp_folder:
+        input_folder = os.path.join(temp_folder, "sprites")
+        generators.write_sprite_set(input_folder, sizes, seed)
+        output_filename = os.path.join(temp_folder, "out.ifs")
+
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            parse_animation(input_folder, output_filename, texture_format=params['texture_format'], incremental=False)
+        elapsed = time.perf_counter() - start_time
+
+        output_size = os.path.getsize(output_filename)
+
+    return {
+        'seconds': elapsed, 'sprites_per_sec': len(sizes) / elapsed, 'output_mb_per_sec': output_size / elapsed / 1024 / 1024,
+    }
+
+
+STAGES = {
+    'decode': bench_decode,
+    'string_table': bench_string_table,
+    'geo': bench_geo,
+    'pack_maxrects': bench_pack_maxrects,
+    'pack_packnode': bench_pack_packnode,
+    'genoverlay': bench_genoverlay,
+}
+
+
+def _run_stage(name, params, seed):
+    result = STAGES[name](params, seed)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_stage(name, params, seed):
+    # A fresh process per stage, started from scratch rather than forked so it doesn't inherit this one's memory.
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_run_stage, (name, params, seed))
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    for name, result in new['stages'].items():
+        previous = old['stages'].get(name)
+        if previous is None:
+            continue
+
+        print(name)
+        for metric, value in result.items():
+            if metric not in previous or not isinstance(value, (int, float)) or not previous[metric]:
+                continue
+
+            change = (value - previous[metric]) * 100.0 / previous[metric]
+            better = (change < 0) == (metric in LOWER_IS_BETTER)
+            print("  %-20s %12.3f -> %12.3f  %+7.1f%%%s" % (metric, previous[metric], value, change, "" if better or change == 0 else "  worse"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-stages', nargs='+', choices=list(STAGES), default=list(STAGES), help='Stages to run')
+    parser.add_argument('-seed', type=int, default=0)
+    parser.add_argument('-afp-count', type=int, default=64, help='Number of afp/bsi pairs to decode')
+    parser.add_argument('-afp-size', type=int, default=256 * 1024, help='Size of each afp in bytes')
+    parser.add_argument('-swap-mix', default='2:0.15,4:0.7,8:0.15', help='BSI swap lengths and their weights')
+    parser.add_argument('-string-table-size', type=int, default=16 * 1024, help='Size of each string table in bytes')
+    parser.add_argument('-string-table-count', type=int, default=256, help='Number of string tables to deobfuscate')
+    parser.add_argument('-geo-count', type=int, default=2000, help='Number of geo files to parse')
+    parser.add_argument('-sprite-count', type=int, default=2000, help='Number of sprites to pack')
+    parser.add_argument('-build-sprite-count', type=int, default=200, help='Number of sprites in the genoverlay build')
+    parser.add_argument('-texture-format', choices=['auto', 'argb8888rev'], default='auto', help='genoverlay texture format')
+    parser.add_argument('-output', help='Results JSON. Defaults to benchmarks/results/<time>.json')
+    parser.add_argument('-compare', help='Earlier results JSON to compare this run with')
+    args = parser.parse_args()
+
+    params = {
+        'afp_count': args.afp_count,
+        'afp_size': args.afp_size,
+        'swap_mix': {int(length): float(weight) for length, weight in (x.split(":") for x in args.swap_mix.split(","))},
+        'string_table_size': args.string_table_size,
+        'string_table_count': args.string_table_count,
+        'geo_count': args.geo_count,
+        'sprite_count': args.sprite_count,
+        'build_sprite_count': args.build_sprite_count,
+        'texture_format': args.texture_format,
+    }
+
+    results = {
+        'version': RESULTS_VERSION,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'seed': args.seed,
+        'params': params,
+        'stages': {},
+    }
+
+    for name in args.stages:
+        result = results['stages'][name] = run_stage(name, params, args.seed)
+        print("%-14s %s" % (name, "  ".join(
+            "%s:%.3f" % (metric, value) if isinstance(value, float) else "%s:%s" % (metric, value)
+            for metric, value in result.items()
+        )))
+
+    output_filename = args.output
+    if output_filename is None:
+        os.makedirs(DEFAULT_RESULTS_FOLDER, exist_ok=True)
+        output_filename = os.path.join(DEFAULT_RESULTS_FOLDER, results['time'].replace(":", "") + ".json")
+
+    with open(output_filename, "w") as outfile:
+        json.dump(results, outfile, indent=1)
+    print("Saved results to", output_filename)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as infile:
+            compare(json.load(infile), results)
@@ -0,0 +1,169 @@
+import json
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+from PIL import Image
+
+from encode_afp import build_bsi, encode_afp_data
+from genoverlay import build_blank_geo, build_image_geo
+
+"""
+Deterministic synthetic inputs for the benchmarks. The same arguments and seed always give the same bytes, so runs
+on different commits measure the same work.
+"""
+
+# Decoded afp magic, see AP2Header in AFP_FORMAT.MD.
+AFP_MAGIC = b'\x08\xb2\xd0\xc1'
+
+AFP_HEADER_SIZE = 0x38
+
+# Swap lengths to weights. The default leans on 4 byte swaps like real BSIs, with some 2 and 8 byte ones.
+DEFAULT_SWAP_MIX = {2: 0.15, 4: 0.7, 8: 0.15}
+
+# (weight, min size, max size) of image sizes, after CANVAS_TEXTURE_ANALYSIS.md: mostly small and medium sprites,
+# the odd large one that spills into its own canvas, and uniform icon sets that get packed in grids.
+SPRITE_CLASSES = [
+    (0.55, 8, 128),
+    (0.25, 128, 400),
+    (0.05, 400, 1136),
+]
+ICON_SIZES = [(200, 200), (120, 120), (50, 50)]
+
+
+def string_table(length, seed=0):
+    """
+    A string table of NUL terminated names, padded with NULs to exactly length bytes.
+    """
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyz_0123456789"
+    table = bytearray()
+    while len(table) < length:
+        table += "".join(rng.choice(alphabet) for _ in range(rng.randint(3, 24))).encode('ascii') + b"\0"
+    table = table[:length]
+    if table:
+        table[-1] = 0
+    return bytes(table)
+
+
+def random_swaps(body_size, swap_mix=None, seed=0, max_gap=32):
+    """
+    A sorted list of non-overlapping (offset, length) swaps over the first body_size bytes, with lengths picked by
+    the weights in swap_mix and even gaps of up to max_gap bytes between them.
+    """
+    rng = random.Random(seed)
+    swap_mix = swap_mix or DEFAULT_SWAP_MIX
+    lengths = list(swap_mix)
+    weights = [swap_mix[x] for x in lengths]
+
+    swaps = []
+    offset = 0
+    while True:
+        # Runs of the same length are common in real files and pack into single ops.
+        length = rng.choices(lengths, weights)[0]
+        for _ in range(rng.randint(1, 16)):
+            if offset + length > body_size:
+                return swaps
+            swaps.append((offset, length))
+            offset += length
+        offset += rng.randrange(0, max_gap + 1, 2)
+
+
+def afp_pair(size, swap_mix=None, string_table_size=4096, seed=0):
+    """
+    An encoded afp of size bytes and its BSI, plus the decoded afp they decode to. The body is random bytes and
+    the string table sits at the end.
+    """
+    rng = np.random.default_rng(seed)
+    size = max(size, AFP_HEADER_SIZE + string_table_size)
+    string_table_offset = size - string_table_size
+
+    decoded = bytearray(rng.integers(0, 256, size, dtype=np.uint8).tobytes())
+    decoded[0:4] = AFP_MAGIC
+    struct.pack_into("<I", decoded, 4, size)
+    struct.pack_into("<II", decoded, 0x30, string_table_offset, string_table_size)
+    decoded[string_table_offset:] = string_table(string_table_size, seed)
+
+    # Swaps stop at the string table, which is obfuscated separately.
+    swaps = random_swaps(string_table_offset & ~1, swap_mix, seed)
+    encoded, bsi = encode_afp_data(decoded, build_bsi(swaps))
+    return bytes(encoded), bsi, bytes(decoded)
+
+
+def write_geo_folder(folder, count, seed=0, movie="bench"):
+    """
+    Writes count shape geo files named <movie>_shape<N> to folder, mostly textured quads with some blank ones.
+    Returns their filenames.
+    """
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    filenames = []
+    for i in range(count):
+        texture_size = (rng.randint(64, 2048), rng.randint(64, 4096))
+        if rng.random() < 0.1:
+            data = build_blank_geo(texture_size[0])
+        else:
+            width, height = float(rng.randint(8, 512)), float(rng.randint(8, 512))
+            left, top = rng.random() * 0.5, rng.random() * 0.5
+            right, bottom = left + rng.random() * 0.5, top + rng.random() * 0.5
+            data = build_image_geo(
+                "spr_%05d" % i, texture_size,
+                ((0.0, 0.0), (width, 0.0), (0.0, height), (width, height)),
+                ((left, top), (right, top), (left, bottom), (right, bottom)),
+            )
+
+        filenames.append(os.path.join(folder, "%s_shape%d" % (movie, 10 + i * 3)))
+        with open(filenames[-1], "wb") as outfile:
+            outfile.write(data)
+
+    return filenames
+
+
+def sprite_sizes(count, seed=0, icon_fraction=0.15):
+    """
+    count image sizes following SPRITE_CLASSES, with icon_fraction of them as same-size icon sets.
+    """
+    rng = random.Random(seed)
+
+    icon_count = int(count * icon_fraction)
+    sizes = [ICON_SIZES[i % len(ICON_SIZES)] for i in range(icon_count)]
+    for _ in range(count - icon_count):
+        weight, low, high = rng.choices(SPRITE_CLASSES, [x[0] for x in SPRITE_CLASSES])[0]
+        sizes.append((rng.randint(low, high), rng.randint(low, high)))
+
+    rng.shuffle(sizes)
+    return sizes
+
+
+def sprite_pixels(size, rng):
+    # A few flat, partly transparent rectangles, like UI art.
+    width, height = size
+    pixels = np.zeros((height, width, 4), dtype=np.uint8)
+    for _ in range(4):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        x1, y1 = rng.integers(x0, width) + 1, rng.integers(y0, height) + 1
+        pixels[y0:y1, x0:x1] = rng.integers(0, 256, 4, dtype=np.uint8) | np.array([0, 0, 0, 128], dtype=np.uint8)
+    return pixels
+
+
+def write_sprite_set(folder, sizes, seed=0):
+    """
+    Writes a PNG for every size and a genoverlay animation.json with one frame per image. Returns the image names.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    names = []
+    for i, size in enumerate(sizes):
+        names.append("s%05d.png" % i)
+        Image.fromarray(sprite_pixels(size, rng), "RGBA").save(os.path.join(folder, names[-1]), compress_level=1)
+
+    with open(os.path.join(folder, "animation.json"), "w") as outfile:
+        json.dump({"animations": [{"frames": names}]}, outfile)
+
+    return names
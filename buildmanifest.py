@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+
+"""
+Build manifest for incremental IFS builds, kept next to the output as <output>.manifest.json. It records the content
+hash of every input, where every image was placed, and for every file in the IFS the key of what it was built from
+along with the hash of what came out. A rebuild only builds files whose key changed, and takes the rest straight out
+of the previous IFS.
+"""
+
+# Bump when the manifest layout or anything that changes build output without changing keys changes.
+MANIFEST_VERSION = 1
+
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_file(filename):
+    with open(filename, "rb") as infile:
+        return hash_bytes(infile.read())
+
+
+def hash_key(key):
+    # Keys are any JSON serializable value describing everything an artifact depends on.
+    return hash_bytes(json.dumps(key, sort_keys=True).encode('utf-8'))
+
+
+def default_manifest_filename(output_filename):
+    return output_filename + ".manifest.json"
+
+
+class BuildManifest(object):
+    def __init__(self, options=None, inputs=None, placements=None, formats=None, artifacts=None):
+        self.options = options or {}
+
+        # Input filename -> content hash
+        self.inputs = inputs or {}
+
+        # Image filename -> [cell area, image size, canvas index], as returned by create_texturelist
+        self.placements = placements or {}
+
+        # Canvas key -> [format, reason]
+        self.formats = formats or {}
+
+        # IFS path -> {'key': key hash, 'hash': data hash}
+        self.artifacts = artifacts or {}
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a manifest, or returns an empty one if it's missing, unreadable or from another version.
+        """
+        try:
+            with open(filename, "r") as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return cls()
+
+        if data.get('version') != MANIFEST_VERSION:
+            return cls()
+
+        return cls(data['options'], data['inputs'], data['placements'], data['formats'], data['artifacts'])
+
+    def save(self, filename):
+        # Written to a temporary file first, so an interrupted save never leaves a broken manifest behind.
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as outfile:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'options': self.options,
+                'inputs': self.inputs,
+                'placements': self.placements,
+                'formats': self.formats,
+                'artifacts': self.artifacts,
+            }, outfile, indent=1, sort_keys=True)
+        os.replace(temp_filename, filename)
+
+
+class IncrementalBuild(object):
+    """
+    Decides what has to be built again, given the manifest and files of the previous build. Everything goes into a
+    new manifest, which replaces the old one once the build is written.
+    """
+    def __init__(self, previous, previous_files, options):
+        # Nothing from a build made with other options can be trusted.
+        if previous.options != options:
+            previous, previous_files = BuildManifest(), {}
+
+        self.previous = previous
+        self.previous_files = previous_files
+        self.manifest = BuildManifest(options)
+
+        self.built = []
+        self.reused = []
+
+    def add_input(self, name, filename):
+        content_hash = self.manifest.inputs[name] = hash_file(filename)
+        return content_hash
+
+    def input_changed(self, name):
+        return self.previous.inputs.get(name) != self.manifest.inputs.get(name)
+
+    def previous_placements(self):
+        # Placements of images that haven't changed since the previous build
+        return {
+            name: placement for name, placement in self.previous.placements.items()
+            if name in self.manifest.inputs and not self.input_changed(name)
+        }
+
+    def reusable(self, path, key):
+        """
+        Returns the previous build's data for path if it was built from the same key and is intact, otherwise None.
+        """
+        key_hash = hash_key(key)
+        artifact = self.previous.artifacts.get(path)
+        data = self.previous_files.get(path)
+        if artifact is None or data is None or artifact['key'] != key_hash or artifact['hash'] != hash_bytes(data):
+            return None
+        return data
+
+    def record(self, path, key, data, reused=False):
+        self.manifest.artifacts[path] = {'key': hash_key(key), 'hash': hash_bytes(data)}
+        (self.reused if reused else self.built).append(path)
+
+    def artifact(self, path, key, build):
+        """
+        Returns the data of an artifact, from the previous build if its key is unchanged, otherwise from build().
+        """
+        data = self.reusable(path, key)
+        if data is not None:
+            self.record(path, key, data, reused=True)
+            return data
+
+        data = build()
+        self.record(path, key, data)
+        return data
+
+    def canvas_format(self, key, select):
+        # Format selection composites and compresses the whole canvas, so it's only done again if the canvas changed.
+        key_hash = hash_key(key)
+        selected = self.previous.formats.get(key_hash)
+        if selected is None:
+            selected = select()
+        self.manifest.formats[key_hash] = list(selected)
+        return tuple(selected)
+
+    @property
+    def unchanged(self):
+        # Nothing was built and every file of the previous build is still there
+        return not self.built and set(self.manifest.artifacts) == set(self.previous.artifacts)
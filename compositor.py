@@ -0,0 +1,120 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from lxml import etree
+from PIL import Image
+
+from decode_afp import run_in_pool
+from dxt import choose_format
+from texturelist import GUTTER
+
+"""
+Composites texture canvases into _canvas_texNNN.png atlases, the same files ifstools dumps on extract. Every canvas
+is an RGBA NumPy buffer that sprites are copied into one at a time, so a worker only ever holds one canvas and one
+sprite, and canvases are spread over a process pool.
+
+A canvas job is (name, (width, height), [(image filename, x, y), ...]), with x and y where the top left of the file
+goes. Jobs come either from the packer's results or from a tex folder's texturelist.xml.
+"""
+
+
+def canvas_jobs(input_folder, canvas_sizes, image_lookup):
+    """
+    Jobs for the results of create_texturelist. The source images don't have gutters, so each one goes inside its
+    cell's gutter.
+    """
+    jobs = [("tex{0:03d}".format(i), size, []) for i, size in enumerate(canvas_sizes)]
+    for basename, (cell, image_size, canvas) in sorted(image_lookup.items()):
+        jobs[canvas][2].append((os.path.join(input_folder, basename), cell[0] + GUTTER, cell[1] + GUTTER))
+    return jobs
+
+
+def canvas_jobs_from_texturelist(tex_folder):
+    """
+    Jobs for a tex folder with a plain texturelist.xml, like one extracted by ifstools. Those images are whole cells,
+    so each one goes at its imgrect.
+    """
+    texturelist = etree.parse(os.path.join(tex_folder, "texturelist.xml")).getroot()
+
+    jobs = []
+    for texture in texturelist.iterchildren("texture"):
+        width, height = [int(x) for x in texture.find("size").text.split()]
+        sprites = []
+        for image in texture.iterchildren("image"):
+            left, right, top, bottom = [int(x) // 2 for x in image.find("imgrect").text.split()]
+            sprites.append((os.path.join(tex_folder, image.attrib["name"] + ".png"), left, top))
+        jobs.append((texture.attrib["name"], (width, height), sprites))
+    return jobs
+
+
+def composite_canvas(size, sprites):
+    """
+    Copies sprites into a transparent (height, width, 4) uint8 buffer. Sprites are clipped to the canvas.
+    """
+    width, height = size
+    canvas = np.zeros((height, width, 4), dtype=np.uint8)
+
+    for filename, x, y in sprites:
+        with Image.open(filename) as img:
+            pixels = np.asarray(img.convert("RGBA"))
+
+        pixels = pixels[:max(0, height - y), :max(0, width - x)]
+        canvas[y:y + pixels.shape[0], x:x + pixels.shape[1]] = pixels
+
+    return canvas
+
+
+def choose_canvas_format(size, sprites):
+    """
+    Composites a canvas and picks dxt5 or argb8888rev for it, see dxt.choose_format. Can be given to
+    create_texturelist as select_format.
+    """
+    return choose_format(composite_canvas(size, sprites))
+
+
+def _write_canvas(name, size, sprites, output_folder):
+    output_filename = os.path.join(output_folder, "_canvas_{}.png".format(name))
+    try:
+        Image.fromarray(composite_canvas(size, sprites), "RGBA").save(output_filename)
+    except (OSError, ValueError) as e:
+        return name, None, str(e)
+
+    return name, output_filename, None
+
+
+def write_canvases(jobs, output_folder, processes=None):
+    """
+    Writes every canvas job to output_folder across a process pool. Returns the filenames written and a list of
+    (canvas name, error).
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    written = []
+    errors = []
+    tasks = [(name, size, sprites, output_folder) for name, size, sprites in jobs]
+    for name, output_filename, error in run_in_pool(_write_canvas, tasks, processes):
+        if error is not None:
+            errors.append((name, error))
+        else:
+            written.append(output_filename)
+
+    return sorted(written), errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tex', help='Input tex folder with a texturelist.xml')
+    parser.add_argument('output', help='Output folder for the _canvas_texNNN.png files')
+    parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes. Defaults to the CPU count.")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    written, errors = write_canvases(canvas_jobs_from_texturelist(args.tex), args.output, args.jobs)
+
+    for name, error in errors:
+        print("Failed to write %s: %s" % (name, error))
+
+    print("Wrote %d canvases in %.2fs" % (len(written), time.perf_counter() - start_time))
+    exit(1 if errors else 0)
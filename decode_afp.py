@@ -1,70 +1,474 @@
 import argparse
+import collections
+import concurrent.futures
+import glob
+import mmap
 import struct
 import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+import stats
+
+# Bytes swapped by each BSI swap type. Type 0 is unverified and not supported.
+SWAP_LEN = { 1: 2, 2: 4, 3: 8 }
+
+# Number of swaps handled per numpy gather, to keep the index arrays small.
+SWAP_CHUNK = 0x10000
+
+# The string table key stream (0x80 + 0xff * i) & 0xff reduces to (0x80 - i) & 0xff, which repeats every 256 bytes.
+# It's pre-tiled to a multiple of 256 so long tables can be handled in chunks without losing the phase.
+STRING_TABLE_KEY = np.tile(((0x80 - np.arange(0x100)) & 0xff).astype(np.uint8), 0x100)
+
+# Total size of the BSI files and compiled plans compile_bsi keeps cached. A plan takes about 1.3x the size of its
+# afp, and dumps mostly pair each afp with its own BSI, so the cache is bounded by size rather than entry count.
+COMPILE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class AfpDecodeError(Exception):
+    pass
+
+
+class SwapPlan(object):
+    """
+    A BSI stream compiled into the start offsets of every byte range it swaps, grouped by swap length.
+    """
+    __slots__ = ('offsets', 'op_counts', '_starts', '_ends')
+
+    def __init__(self, offsets, op_counts=None):
+        self.offsets = offsets
+
+        # Swap length -> number of BSI ops of that length. None for plans sliced out of another one, like
+        # AfpRangeReader's, where swaps can't be told apart from the ops they came from.
+        self.op_counts = op_counts
+
+        self._starts = None
+        self._ends = None
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, {k: len(v) for k, v in self.offsets.items()})
+
+    @property
+    def nbytes(self):
+        return sum(offsets.nbytes for offsets in self.offsets.values())
+
+    def apply(self, data):
+        # The swaps never overlap, so they can be applied in any order.
+        buf = np.frombuffer(data, dtype=np.uint8)
+
+        if stats.enabled:
+            for swap_len, offsets in self.offsets.items():
+                if self.op_counts is not None:
+                    stats.count("bsi_ops_swap%d" % swap_len, self.op_counts.get(swap_len, 0))
+                stats.count("bsi_bytes_swap%d" % swap_len, len(offsets) * swap_len)
+
+        for swap_len, offsets in self.offsets.items():
+            # Swaps running past the end of the file only reverse what's there, like a slice would.
+            count = int(np.searchsorted(offsets, len(buf) - swap_len, side='right'))
+            forward = np.arange(swap_len)
+
+            for i in range(0, count, SWAP_CHUNK):
+                idx = offsets[i:min(i + SWAP_CHUNK, count), None] + forward
+                buf[idx] = buf[idx[:, ::-1]]
+
+            for offset in offsets[count:].tolist():
+                data[offset:offset+swap_len] = data[offset:offset+swap_len][::-1]
+
+        return data
+
+    def ops_in_range(self, start, end):
+        """
+        Returns the start offsets and lengths of every swap touching the byte range [start, end).
+        """
+        if self._starts is None:
+            # Swaps never overlap, so sorting them by start also sorts them by end, which makes
+            # both ends of a range query a binary search.
+            starts = np.concatenate([x for x in self.offsets.values()] + [np.zeros(0, dtype=np.int64)])
+            lengths = np.concatenate([np.full(len(x), k) for k, x in self.offsets.items()] + [np.zeros(0, dtype=np.int64)])
+            order = np.argsort(starts, kind='stable')
+            self._starts = starts[order]
+            self._ends = starts[order] + lengths[order]
+
+        first = int(np.searchsorted(self._ends, start, side='right'))
+        last = int(np.searchsorted(self._starts, end, side='left'))
+        return self._starts[first:last], self._ends[first:last] - self._starts[first:last]
+
+
+def _shift_string_table(data, key_sign, key_offset):
+    buf = np.frombuffer(data, dtype=np.uint8)
+    phase = key_offset & 0xff
+    step = len(STRING_TABLE_KEY) - 0x100
+
+    for i in range(0, len(buf), step):
+        chunk = buf[i:i+step]
+        if key_sign > 0:
+            chunk += STRING_TABLE_KEY[phase:phase+len(chunk)]
+        else:
+            chunk -= STRING_TABLE_KEY[phase:phase+len(chunk)]
+
+    return data
 
-def decode_afp_file(input_afp_filename, input_bsi_filename):
-    bsi_file = bytearray(open(input_bsi_filename, "rb").read())
-    afp_file = bytearray(open(input_afp_filename, "rb").read())
+
+def deobfuscate_string_table(data, key_offset=0):
+    # data should be a writable buffer (bytearray, memoryview, mmap) covering the string table, or part of it
+    # starting key_offset bytes into the table.
+    stats.count("string_table_bytes", len(data))
+    return _shift_string_table(data, 1, key_offset)
+
+
+def obfuscate_string_table(data, key_offset=0):
+    return _shift_string_table(data, -1, key_offset)
+
+
+# BSI bytes -> (plan, bytes it holds), least recently used first
+_compile_cache = collections.OrderedDict()
+_compile_cache_bytes = 0
+_compile_cache_lock = threading.Lock()
+
+
+def compile_bsi(bsi_data):
+    """
+    Compiles a BSI file into a SwapPlan. Plans are cached by BSI content, up to COMPILE_CACHE_BYTES, so files sharing
+    a BSI only compile it once.
+    """
+    global _compile_cache_bytes
+
+    bsi_data = bytes(bsi_data)
+    with _compile_cache_lock:
+        cached = _compile_cache.get(bsi_data)
+        if cached is not None:
+            _compile_cache.move_to_end(bsi_data)
+            return cached[0]
+
+    plan = _compile_bsi(bsi_data)
+    size = len(bsi_data) + plan.nbytes
+    if size > COMPILE_CACHE_BYTES:
+        return plan
+
+    with _compile_cache_lock:
+        if bsi_data not in _compile_cache:
+            _compile_cache[bsi_data] = (plan, size)
+            _compile_cache_bytes += size
+            while _compile_cache_bytes > COMPILE_CACHE_BYTES:
+                _, (_, evicted_size) = _compile_cache.popitem(last=False)
+                _compile_cache_bytes -= evicted_size
+
+    return plan
+
+
+def _compile_bsi(bsi_data):
+    ops = np.frombuffer(bsi_data, dtype="<u2", count=len(bsi_data) // 2)
+
+    end = np.flatnonzero(ops == 0)
+    if len(end) > 0:
+        ops = ops[:end[0]]
+
+    ops = ops.astype(np.int64)
+    swap_type = ops >> 13
+    loops = ((ops >> 7) & 0x3f) + 1
+
+    if np.any(swap_type == 0):
+        raise AfpDecodeError("Check out swap type 0 code (unverified)")
+
+    if np.any(swap_type > 3):
+        raise AfpDecodeError("Unknown swap type")
+
+    swap_len = np.left_shift(1, swap_type)
+    op_len = loops * swap_len
+
+    # Each op skips (val & 0x7f) * 2 bytes from where the previous op finished, then swaps `loops` times.
+    op_start = np.cumsum((ops & 0x7f) * 2 + op_len) - op_len
+
+    offsets = {}
+    op_counts = {}
+    for swap_type_id, length in SWAP_LEN.items():
+        selected = swap_type == swap_type_id
+        if not np.any(selected):
+            continue
+
+        op_counts[length] = int(np.count_nonzero(selected))
+        op_loops = loops[selected]
+        first_loop = np.cumsum(op_loops) - op_loops
+        loop_idx = np.arange(int(op_loops.sum())) - np.repeat(first_loop, op_loops)
+        offsets[length] = np.repeat(op_start[selected], op_loops) + loop_idx * length
+
+    return SwapPlan(offsets, op_counts)
+
+
+def decode_afp_data(afp_data, bsi_data):
+    # Decodes a writable afp buffer in place.
 
     # This can deobfuscate the magic bytes to read "AP2", but we should leave it alone.
     # The game can actually handle a fully unobfuscated ap2 file so long as the magic bytes are left intact and
     # an empty bsi file is provided.
     # afp_file = bytearray(struct.pack("<I", (struct.unpack(">I", afp_file[:4])[0] & 0x7f7f7f00)) + afp_file[4:])
 
-    afp_offset = 0
-    for i in range(0, len(bsi_file), 2):
-        val = struct.unpack("<H", bsi_file[i:i+2])[0]
+    compile_bsi(bytes(bsi_data)).apply(afp_data)
+    stats.count("afp_files_decoded")
+    stats.count("afp_bytes_decoded", len(afp_data))
 
-        if val == 0:
-            break
+    if len(afp_data) < 0x38:
+        raise AfpDecodeError("File is too short to be an afp")
 
-        offset = (val & 0x7f) * 2
-        swap_type = val >> 13
-        loops = ((val >> 7) & 0x3f) + 1
-        afp_offset += offset
+    afp_size, unk_flag = struct.unpack_from("<IH", afp_data, 4)
+    string_table_offset, string_table_size = struct.unpack_from("<II", afp_data, 0x30)
 
-        for j in range(loops):
-            if swap_type == 0:
-                offset = (offset << 8) - 100
-                print("Check out swap type 0 code (unverified)")
-                exit(1)
-                continue
+    if string_table_offset + string_table_size > len(afp_data):
+        raise AfpDecodeError("String table runs past the end of the file")
 
-            swap_len = { 1: 2, 2: 4, 3: 8 }
+    with memoryview(afp_data) as view:
+        deobfuscate_string_table(view[string_table_offset:string_table_offset+string_table_size])
 
-            if swap_type not in swap_len:
-                print("Unknown swap type")
-                exit(1)
+    return afp_data
+
+
+def decode_afp_file(input_afp_filename, input_bsi_filename):
+    bsi_file = open(input_bsi_filename, "rb").read()
+    afp_file = bytearray(open(input_afp_filename, "rb").read())
 
-            afp_file[afp_offset:afp_offset+swap_len[swap_type]] = afp_file[afp_offset:afp_offset+swap_len[swap_type]][::-1]
-            afp_offset += swap_len[swap_type]
+    return decode_afp_data(afp_file, bsi_file)
 
-    afp_size, unk_flag = struct.unpack("<IH", afp_file[4:10])
-    string_table_offset, string_table_size = struct.unpack("<II", afp_file[0x30:0x38])
 
-    for i in range(string_table_size):
-        afp_file[string_table_offset + i] = (afp_file[string_table_offset + i] + 0x80 + (0xff * i)) & 0xff
+def decode_afp_file_inplace(input_afp_filename, input_bsi_filename, output_filename):
+    # Copies the afp to the output once and decodes it through a memory map, so the only full copy
+    # of the file is the output's page cache. Returns the size of the decoded file.
+    bsi_file = open(input_bsi_filename, "rb").read()
 
-    return afp_file
+    if not os.path.exists(output_filename) or not os.path.samefile(input_afp_filename, output_filename):
+        shutil.copyfile(input_afp_filename, output_filename)
+
+    try:
+        with open(output_filename, "r+b") as outfile:
+            size = os.fstat(outfile.fileno()).st_size
+            if size < 0x38:
+                raise AfpDecodeError("File is too short to be an afp")
+
+            with mmap.mmap(outfile.fileno(), 0) as afp_file:
+                decode_afp_data(afp_file, bsi_file)
+                afp_file.flush()
+
+    except Exception:
+        # Don't leave a half decoded file behind that looks up to date.
+        if not os.path.samefile(input_afp_filename, output_filename):
+            os.remove(output_filename)
+        raise
+
+    return size
+
+
+class AfpRangeReader(object):
+    """
+    Decodes arbitrary byte ranges of an afp file without decoding the rest of it.
+    """
+    def __init__(self, input_afp_filename, input_bsi_filename):
+        self.plan = compile_bsi(open(input_bsi_filename, "rb").read())
+        self.file = open(input_afp_filename, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        if self.size < 0x38:
+            raise AfpDecodeError("File is too short to be an afp")
+
+        data, read_start = self._read(0x30, 0x38)
+        self.string_table_offset, self.string_table_size = struct.unpack_from("<II", data, 0x30 - read_start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _clamp(self, start, end):
+        start = min(max(start, 0), self.size)
+        return start, min(max(end, start), self.size)
+
+    def _read(self, start, end):
+        start, end = self._clamp(start, end)
+        starts, lengths = self.plan.ops_in_range(start, end)
+
+        # Widen the read to whole swaps at both ends of the range.
+        read_start = min(start, int(starts[0])) if len(starts) > 0 else start
+        read_end = max(end, int(starts[-1] + lengths[-1])) if len(starts) > 0 else end
+        read_end = min(read_end, self.size)
+
+        self.file.seek(read_start, 0)
+        data = bytearray(self.file.read(read_end - read_start))
+
+        # Range plans only count swapped bytes, not BSI ops.
+        SwapPlan({k: starts[lengths == k] - read_start for k in SWAP_LEN.values()}).apply(data)
+
+        return data, read_start
+
+    def read(self, start, end):
+        data, read_start = self._read(start, end)
+        start, end = self._clamp(start, end)
+
+        string_table_start = max(start, self.string_table_offset)
+        string_table_end = min(end, self.string_table_offset + self.string_table_size)
+
+        with memoryview(data) as view:
+            if string_table_start < string_table_end:
+                deobfuscate_string_table(
+                    view[string_table_start - read_start:string_table_end - read_start],
+                    string_table_start - self.string_table_offset
+                )
+
+            return bytes(view[start - read_start:end - read_start])
+
+
+def decode_range(input_afp_filename, input_bsi_filename, start, end):
+    with AfpRangeReader(input_afp_filename, input_bsi_filename) as reader:
+        return reader.read(start, end)
+
+
+def find_bsi(afp_filename):
+    # BSI files live in a bsi folder next to the afp files, under the same name.
+    bsi = os.path.join(os.path.dirname(afp_filename), 'bsi', os.path.basename(afp_filename))
+    return bsi if os.path.exists(bsi) else None
+
+
+def find_afp_files(path):
+    if os.path.isdir(path):
+        # afplist.xml lives alongside the afp files
+        filenames = [os.path.join(path, x) for x in os.listdir(path) if not x.endswith(".xml")]
+    else:
+        filenames = glob.glob(path, recursive=True)
+
+    return sorted(x for x in filenames if os.path.isfile(x))
+
+
+def is_up_to_date(output_filename, *input_filenames):
+    if not os.path.exists(output_filename):
+        return False
+
+    output_mtime = os.path.getmtime(output_filename)
+    return all(os.path.getmtime(x) <= output_mtime for x in input_filenames)
+
+
+def run_in_pool(func, tasks, jobs=None):
+    # Runs func(*task) for every task across a process pool and yields the results as they finish.
+    # Only a few tasks per worker are kept in flight, so memory stays bounded no matter how many there are.
+    jobs = jobs or os.cpu_count()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        max_pending = jobs * 2
+        pending = set()
+        tasks = iter(tasks)
+
+        while True:
+            for task in tasks:
+                pending.add(executor.submit(func, *task))
+                if len(pending) >= max_pending:
+                    break
+
+            if not pending:
+                break
+
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def _decode_batch_file(afp_filename, bsi_filename, output_filename, collect_stats=False):
+    # Stats are counted per task and sent back with the result.
+    if collect_stats:
+        stats.enable()
+        stats.reset()
+
+    try:
+        with stats.timer("decode_file"):
+            size = decode_afp_file_inplace(afp_filename, bsi_filename, output_filename)
+
+    except (AfpDecodeError, OSError, struct.error) as e:
+        return afp_filename, 0, str(e), stats.snapshot()
+
+    return afp_filename, size, None, stats.snapshot()
+
+
+def decode_afp_batch(afp_filenames, output_folder, jobs=None, force=False):
+    # Outputs keep their paths relative to the common input folder, so pairs from different
+    # archives that share a name don't overwrite each other.
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(x)) for x in afp_filenames]) if afp_filenames else ""
+
+    tasks = []
+    errors = []
+    skipped = 0
+    for afp_filename in afp_filenames:
+        bsi_filename = find_bsi(afp_filename)
+        if bsi_filename is None:
+            errors.append((afp_filename, "Could not find BSI"))
+            continue
+
+        output_filename = os.path.join(output_folder, os.path.relpath(os.path.abspath(afp_filename), root))
+        if not force and is_up_to_date(output_filename, afp_filename, bsi_filename):
+            skipped += 1
+            continue
+
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        tasks.append((afp_filename, bsi_filename, output_filename, stats.enabled))
+
+    start_time = time.perf_counter()
+    decoded_files = 0
+    decoded_bytes = 0
+
+    for afp_filename, size, error, worker_stats in run_in_pool(_decode_batch_file, tasks, jobs):
+        stats.merge(worker_stats)
+        if error is not None:
+            errors.append((afp_filename, error))
+            continue
+
+        decoded_files += 1
+        decoded_bytes += size
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+
+    for afp_filename, error in errors:
+        print("Failed to decode %s: %s" % (afp_filename, error))
+
+    print("Decoded %d files (%d up to date, %d failed) in %.2fs: %.1f files/sec, %.2f MB/sec" % (
+        decoded_files, skipped, len(errors), elapsed, decoded_files / elapsed, decoded_bytes / elapsed / 1024 / 1024
+    ))
+
+    return decoded_files, skipped, errors
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('afp', help='Input AFP file')
-    parser.add_argument('output', help='Output filename')
+    parser.add_argument('afp', help='Input AFP file. A folder or glob pattern decodes every afp it matches.')
+    parser.add_argument('output', help='Output filename, or output folder when decoding a folder or glob pattern')
     parser.add_argument('-bsi', help="Optional path to BSI file. Default behavior looks in the afp/bsi dir.")
+    parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes for batch decoding. Defaults to the CPU count.")
+    parser.add_argument('-f', '--force', action='store_true', help="Decode every file in a batch, even if its output is up to date.")
+    stats.add_arguments(parser)
     args = parser.parse_args()
 
-    if args.bsi is None:
-        basename = os.path.basename(args.afp)
-        dirname = os.path.dirname(args.afp)
-        bsi = os.path.join(dirname, 'bsi', basename)
-        if os.path.exists(bsi):
-            args.bsi = bsi
-        else:
-            raise FileNotFoundError(f"Could not find BSI. Use -bsi [path] if it's not in the default location")
-    decoded = decode_afp_file(args.afp, args.bsi)
-    with open(args.output, "wb") as outfile:
-        outfile.write(decoded)
+    with stats.session(args.stats, args.profile):
+        if os.path.isdir(args.afp) or any(c in args.afp for c in "*?["):
+            if args.bsi is not None:
+                parser.error("-bsi can't be used when decoding a folder or glob pattern")
+
+            afp_filenames = find_afp_files(args.afp)
+            if not afp_filenames:
+                print("No afp files found in", args.afp)
+                exit(1)
+
+            decoded_files, skipped, errors = decode_afp_batch(afp_filenames, args.output, args.jobs, args.force)
+            exit(1 if errors else 0)
+
+        if args.bsi is None:
+            args.bsi = find_bsi(args.afp)
+            if args.bsi is None:
+                raise FileNotFoundError(f"Could not find BSI. Use -bsi [path] if it's not in the default location")
+
+        try:
+            decode_afp_file_inplace(args.afp, args.bsi, args.output)
+        except AfpDecodeError as e:
+            print(e)
+            exit(1)
 
-    print("Saved to", args.output)
\ No newline at end of file
+        print("Saved to", args.output)
\ No newline at end of file
@@ -0,0 +1,305 @@
+import argparse
+
+import numpy as np
+from PIL import Image
+
+"""
+A vectorized DXT5 (BC3) encoder and decoder, and the policy that picks dxt5 or argb8888rev for a texture canvas, see
+CANVAS_TEXTURE_ANALYSIS.md. Every 4x4 block of the image is encoded at once in NumPy: alpha gets its min/max
+endpoints with the 8 value ramp, color gets endpoints along the block's principal axis, and every pixel takes the
+nearest palette entry.
+
+dxt5 is only picked when both canvas dimensions are multiples of 4, the canvas is big enough for the saving to
+matter, and the decoded result stays close to the original, both overall and along alpha edges. That keeps flat
+art, masks and text compressed, and gradients and illustrations lossless like the game's own archives.
+"""
+
+# Textures with fewer pixels than this stay argb8888rev, the saving isn't worth the artifacts.
+DXT5_MIN_PIXELS = 128 * 128
+
+# Largest RMS error, in 0-255 units of premultiplied RGBA, allowed over the whole texture...
+DXT5_MAX_RMSE = 4.0
+
+# ...and over pixels on hard alpha edges, where bleeding colors show up as fringes.
+DXT5_MAX_EDGE_RMSE = 12.0
+
+# Alpha difference between neighbors that counts as a hard edge
+ALPHA_EDGE_THRESHOLD = 128
+
+# Blocks encoded per NumPy pass, to bound memory on big canvases
+BLOCKS_PER_PASS = 65536
+
+BYTES_PER_PIXEL = {
+    'argb8888rev': 4,
+    'argb4444': 2,
+    'dxt5': 1,
+    'dxt1': 0.5,
+}
+
+
+def texture_vram(size, texture_format):
+    return int(size[0] * size[1] * BYTES_PER_PIXEL[texture_format])
+
+
+def _to_blocks(pixels):
+    # (height, width, 4) -> (blocks, 16, 4), blocks in row major order. Edges are padded by repeating the last pixels.
+    height, width = pixels.shape[:2]
+    padded_height, padded_width = -(-height // 4) * 4, -(-width // 4) * 4
+    if (padded_height, padded_width) != (height, width):
+        pixels = np.pad(pixels, ((0, padded_height - height), (0, padded_width - width), (0, 0)), mode='edge')
+
+    blocks = pixels.reshape(padded_height // 4, 4, padded_width // 4, 4, 4).transpose(0, 2, 1, 3, 4)
+    return blocks.reshape(-1, 16, 4)
+
+
+def _from_blocks(blocks, width, height):
+    padded_height, padded_width = -(-height // 4) * 4, -(-width // 4) * 4
+    pixels = blocks.reshape(padded_height // 4, padded_width // 4, 4, 4, 4).transpose(0, 2, 1, 3, 4)
+    return pixels.reshape(padded_height, padded_width, 4)[:height, :width]
+
+
+def _rgb565(colors):
+    # (n, 3) float 0-255 -> u16
+    r = np.clip(np.rint(colors[:, 0] * 31 / 255), 0, 31).astype(np.uint16)
+    g = np.clip(np.rint(colors[:, 1] * 63 / 255), 0, 63).astype(np.uint16)
+    b = np.clip(np.rint(colors[:, 2] * 31 / 255), 0, 31).astype(np.uint16)
+    return (r << 11) | (g << 5) | b
+
+
+def _expand565(values):
+    # u16 -> (n, 3) float 0-255, bit replicated like the hardware does
+    r = (values >> 11) & 0x1f
+    g = (values >> 5) & 0x3f
+    b = values & 0x1f
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], axis=1).astype(np.float32)
+
+
+def _color_palettes(color0, color1):
+    # (n, 4, 3) palettes for 4 color mode
+    c0 = _expand565(color0)
+    c1 = _expand565(color1)
+    return np.stack([c0, c1, (2 * c0 + c1) / 3, (c0 + 2 * c1) / 3], axis=1)
+
+
+def _alpha_palettes(alpha0, alpha1):
+    # (n, 8) palettes for 8 value mode (alpha0 > alpha1). Blocks with equal endpoints only ever use index 0.
+    a0 = alpha0.astype(np.float32)[:, None]
+    a1 = alpha1.astype(np.float32)[:, None]
+    weights = np.arange(1, 7, dtype=np.float32)[None, :]
+    ramp = np.floor(((7 - weights) * a0 + weights * a1) / 7)
+    return np.concatenate([a0, a1, ramp], axis=1)
+
+
+def _color_indices(rgb, color0, color1):
+    palette = _color_palettes(color0, color1)
+    distances = ((rgb[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(axis=3)
+    return distances.argmin(axis=2).astype(np.uint32)
+
+
+def _color_error(rgb, color0, color1, indices):
+    palette = _color_palettes(color0, color1)
+    chosen = np.take_along_axis(palette, indices.astype(np.int64)[:, :, None], axis=1)
+    return ((rgb - chosen) ** 2).sum(axis=(1, 2))
+
+
+def _encode_pass(blocks):
+    count = len(blocks)
+    pixels = blocks.astype(np.float32)
+    rgb = pixels[:, :, :3]
+    alpha = pixels[:, :, 3]
+
+    # Alpha endpoints are the block's min and max, so fully opaque and fully transparent pixels stay exact.
+    alpha0 = blocks[:, :, 3].max(axis=1)
+    alpha1 = blocks[:, :, 3].min(axis=1)
+    alpha_palette = _alpha_palettes(alpha0, alpha1)
+    alpha_indices = np.abs(alpha[:, :, None] - alpha_palette[:, None, :]).argmin(axis=2).astype(np.uint64)
+    alpha_indices[alpha0 == alpha1] = 0
+
+    # Color endpoints are the extremes of the block along its principal axis, found with a few power iterations.
+    mean = rgb.mean(axis=1, keepdims=True)
+    centered = rgb - mean
+    covariance = np.einsum('npi,npj->nij', centered, centered)
+    axis = np.ones((count, 3), dtype=np.float32)
+    for _ in range(4):
+        axis = np.einsum('nij,nj->ni', covariance, axis)
+        axis /= np.maximum(np.linalg.norm(axis, axis=1, keepdims=True), 1e-12)
+
+    projection = np.einsum('npi,ni->np', centered, axis)
+    block_index = np.arange(count)
+    color0 = _rgb565(rgb[block_index, projection.argmax(axis=1)])
+    color1 = _rgb565(rgb[block_index, projection.argmin(axis=1)])
+
+    # color0 > color1 selects 4 color mode, which some decoders need even for DXT5.
+    swap = color0 < color1
+    color0[swap], color1[swap] = color1[swap], color0[swap].copy()
+
+    color_indices = _color_indices(rgb, color0, color1)
+
+    # One least squares pass moves the endpoints to fit the pixels each index was given, which is most of what
+    # an iterative encoder gains.
+    weights = np.array([1.0, 0.0, 2.0 / 3.0, 1.0 / 3.0], dtype=np.float32)[color_indices]
+    aa = (weights * weights).sum(axis=1)
+    ab = (weights * (1 - weights)).sum(axis=1)
+    bb = ((1 - weights) * (1 - weights)).sum(axis=1)
+    ax = np.einsum('np,npi->ni', weights, rgb)
+    bx = np.einsum('np,npi->ni', 1 - weights, rgb)
+    determinant = aa * bb - ab * ab
+    solvable = np.abs(determinant) > 1e-6
+    if solvable.any():
+        inverse = 1.0 / determinant[solvable, None]
+        refined0 = _rgb565((ax[solvable] * bb[solvable, None] - bx[solvable] * ab[solvable, None]) * inverse)
+        refined1 = _rgb565((bx[solvable] * aa[solvable, None] - ax[solvable] * ab[solvable, None]) * inverse)
+        swap = refined0 < refined1
+        refined0[swap], refined1[swap] = refined1[swap], refined0[swap].copy()
+        refined_indices = _color_indices(rgb[solvable], refined0, refined1)
+
+        # Only keep refined endpoints where they actually help.
+        before = _color_error(rgb[solvable], color0[solvable], color1[solvable], color_indices[solvable])
+        after = _color_error(rgb[solvable], refined0, refined1, refined_indices)
+        keep = after < before
+        better = np.flatnonzero(solvable)[keep]
+        color0[better] = refined0[keep]
+        color1[better] = refined1[keep]
+        color_indices[better] = refined_indices[keep]
+
+    # Blocks whose endpoints collapsed into one color end up in 3 color mode, so they only use index 0.
+    color_indices[color0 == color1] = 0
+
+    alpha_bits = (alpha_indices << (np.arange(16, dtype=np.uint64) * 3)).sum(axis=1, dtype=np.uint64)
+    color_bits = (color_indices << (np.arange(16, dtype=np.uint32) * 2)).sum(axis=1, dtype=np.uint32)
+
+    encoded = np.zeros((count, 16), dtype=np.uint8)
+    encoded[:, 0] = alpha0
+    encoded[:, 1] = alpha1
+    encoded[:, 2:8] = alpha_bits.astype('<u8').view(np.uint8).reshape(count, 8)[:, :6]
+    encoded[:, 8:10] = color0.astype('<u2').view(np.uint8).reshape(count, 2)
+    encoded[:, 10:12] = color1.astype('<u2').view(np.uint8).reshape(count, 2)
+    encoded[:, 12:16] = color_bits.astype('<u4').view(np.uint8).reshape(count, 4)
+    return encoded
+
+
+def swap_words(data):
+    # IFS textures store DXT blocks with every 16 bit word byte swapped.
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, 2)[:, ::-1].tobytes()
+
+
+def encode_dxt5(pixels, ifs_order=False):
+    """
+    Encodes a (height, width, 4) uint8 RGBA array to DXT5 blocks in row major order, byte swapped like IFS textures
+    if ifs_order is set. Dimensions that aren't multiples of 4 are padded by repeating the edge pixels.
+    """
+    blocks = _to_blocks(np.ascontiguousarray(pixels, dtype=np.uint8))
+    encoded = [_encode_pass(blocks[i:i + BLOCKS_PER_PASS]) for i in range(0, len(blocks), BLOCKS_PER_PASS)]
+    data = np.concatenate(encoded).tobytes() if encoded else b''
+    return swap_words(data) if ifs_order else data
+
+
+def decode_dxt5(data, width, height, ifs_order=False):
+    """
+    Decodes DXT5 blocks back into a (height, width, 4) uint8 RGBA array.
+    """
+    if ifs_order:
+        data = swap_words(data)
+    encoded = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+    count = len(encoded)
+
+    alpha0, alpha1 = encoded[:, 0], encoded[:, 1]
+    alpha_bits = np.zeros(count, dtype=np.uint64)
+    for i in range(6):
+        alpha_bits |= encoded[:, 2 + i].astype(np.uint64) << np.uint64(8 * i)
+    alpha_indices = (alpha_bits[:, None] >> (np.arange(16, dtype=np.uint64) * 3)) & 7
+
+    # 6 value mode, with 0 and 255 as the last two entries, when alpha0 <= alpha1
+    a0 = alpha0.astype(np.float32)[:, None]
+    a1 = alpha1.astype(np.float32)[:, None]
+    weights = np.arange(1, 5, dtype=np.float32)[None, :]
+    six_value = np.concatenate([
+        a0, a1, np.floor(((5 - weights) * a0 + weights * a1) / 5),
+        np.zeros((count, 1), dtype=np.float32), np.full((count, 1), 255, dtype=np.float32)
+    ], axis=1)
+    alpha_palette = np.where((alpha0 > alpha1)[:, None], _alpha_palettes(alpha0, alpha1), six_value)
+    alpha = np.take_along_axis(alpha_palette, alpha_indices.astype(np.int64), axis=1)
+
+    color0 = encoded[:, 8:10].copy().view('<u2')[:, 0].astype(np.uint16)
+    color1 = encoded[:, 10:12].copy().view('<u2')[:, 0].astype(np.uint16)
+    color_bits = encoded[:, 12:16].copy().view('<u4')[:, 0]
+    color_indices = (color_bits[:, None] >> (np.arange(16, dtype=np.uint32) * 2)) & 3
+
+    palette = _color_palettes(color0, color1)
+    rgb = np.take_along_axis(palette, color_indices.astype(np.int64)[:, :, None], axis=1)
+
+    blocks = np.concatenate([np.floor(rgb), alpha[:, :, None]], axis=2).astype(np.uint8)
+    return _from_blocks(blocks, width, height)
+
+
+def alpha_edges(pixels):
+    # Pixels whose alpha differs a lot from a neighbor's
+    alpha = pixels[:, :, 3].astype(np.int16)
+    edges = np.zeros(alpha.shape, dtype=np.bool_)
+
+    horizontal = np.abs(np.diff(alpha, axis=1)) >= ALPHA_EDGE_THRESHOLD
+    edges[:, 1:] |= horizontal
+    edges[:, :-1] |= horizontal
+
+    vertical = np.abs(np.diff(alpha, axis=0)) >= ALPHA_EDGE_THRESHOLD
+    edges[1:, :] |= vertical
+    edges[:-1, :] |= vertical
+
+    return edges
+
+
+def dxt5_error(pixels, decoded=None):
+    """
+    Returns the RMS error of DXT5 compressing pixels, over the whole image and over its alpha edges. Colors are
+    compared premultiplied, so whatever is under fully transparent pixels doesn't count.
+    """
+    height, width = pixels.shape[:2]
+    if decoded is None:
+        decoded = decode_dxt5(encode_dxt5(pixels), width, height)
+
+    def premultiplied(image):
+        image = image.astype(np.float32)
+        image[:, :, :3] *= image[:, :, 3:4] / 255.0
+        return image
+
+    squared = ((premultiplied(pixels) - premultiplied(decoded)) ** 2).mean(axis=2)
+    rmse = float(np.sqrt(squared.mean())) if squared.size else 0.0
+
+    edges = alpha_edges(pixels)
+    edge_rmse = float(np.sqrt(squared[edges].mean())) if edges.any() else 0.0
+
+    return rmse, edge_rmse
+
+
+def choose_format(pixels):
+    """
+    Picks dxt5 or argb8888rev for a canvas. Returns the format and the reason it was picked.
+    """
+    height, width = pixels.shape[:2]
+    if width % 4 or height % 4:
+        return 'argb8888rev', "%dx%d isn't a multiple of 4" % (width, height)
+
+    if width * height < DXT5_MIN_PIXELS:
+        return 'argb8888rev', "too small to compress"
+
+    rmse, edge_rmse = dxt5_error(pixels)
+    if rmse > DXT5_MAX_RMSE:
+        return 'argb8888rev', "dxt5 error %.2f" % rmse
+    if edge_rmse > DXT5_MAX_EDGE_RMSE:
+        return 'argb8888rev', "dxt5 alpha edge error %.2f" % edge_rmse
+
+    return 'dxt5', "dxt5 error %.2f, alpha edge error %.2f" % (rmse, edge_rmse)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images', nargs='+', help='Images to check, e.g. _canvas_texNNN.png files')
+    args = parser.parse_args()
+
+    for filename in args.images:
+        with Image.open(filename) as img:
+            pixels = np.asarray(img.convert("RGBA"))
+
+        texture_format, reason = choose_format(pixels)
+        size = (pixels.shape[1], pixels.shape[0])
+        print("%s: %dx%d %s (%s), %d KB" % (filename, size[0], size[1], texture_format, reason, texture_vram(size, texture_format) // 1024))
@@ -0,0 +1,186 @@
+import argparse
+import os
+import struct
+import tempfile
+
+from decode_afp import AfpDecodeError, compile_bsi, decode_afp_file, find_afp_files, obfuscate_string_table, run_in_pool
+
+"""
+Re-obfuscates a decoded afp into an afp/bsi pair that decode_afp.py (and the game) can decode.
+Byteswapping is its own inverse, so encoding is just applying the same swap plan the decoder will apply.
+"""
+
+SWAP_TYPE = { 2: 1, 4: 2, 8: 3 }
+
+# Limits of a single BSI op: the gap is stored in 2 byte units in 7 bits, and there are 6 bits of loops.
+MAX_GAP = 0x7f * 2
+MAX_LOOPS = 0x40
+
+
+def build_bsi(swaps):
+    """
+    Builds a BSI stream from a sorted list of non-overlapping (offset, length) swaps. Contiguous swaps of the same
+    length are packed into as few ops as possible.
+    """
+    ops = []
+    afp_offset = 0
+    run_offset, run_len, run_loops = None, None, 0
+
+    def flush_run():
+        nonlocal afp_offset
+
+        gap = run_offset - afp_offset
+        while gap > MAX_GAP:
+            # A gap can't be skipped without swapping something, so swap 2 filler bytes as far ahead as possible.
+            # The decoder swaps them back like anything else.
+            filler_gap = min(MAX_GAP, gap - 2)
+            ops.append((filler_gap // 2) | (SWAP_TYPE[2] << 13))
+            gap -= filler_gap + 2
+
+        loops = run_loops
+        while loops > 0:
+            op_loops = min(loops, MAX_LOOPS)
+            ops.append((gap // 2) | ((op_loops - 1) << 7) | (SWAP_TYPE[run_len] << 13))
+            gap = 0
+            loops -= op_loops
+
+        afp_offset = run_offset + run_loops * run_len
+
+    for offset, length in swaps:
+        if length not in SWAP_TYPE:
+            raise ValueError("Can't swap %d bytes" % length)
+
+        if run_len == length and offset == run_offset + run_loops * run_len:
+            run_loops += 1
+            continue
+
+        if run_len is not None:
+            flush_run()
+
+        if offset < afp_offset or (offset - afp_offset) % 2 != 0:
+            raise ValueError("Swap at 0x%x overlaps or isn't 2 byte aligned with the previous swap" % offset)
+
+        run_offset, run_len, run_loops = offset, length, 1
+
+    if run_len is not None:
+        flush_run()
+
+    ops.append(0)
+    return struct.pack("<%dH" % len(ops), *ops)
+
+
+def default_swaps(afp_data):
+    # Swap the whole body up to the string table as 32-bit words, which packs into 64 words per op.
+    string_table_offset = struct.unpack_from("<I", afp_data, 0x30)[0]
+    body_end = min(string_table_offset, len(afp_data)) & ~1
+
+    swaps = [(offset, 4) for offset in range(0, body_end & ~3, 4)]
+    if body_end & 2:
+        swaps.append((body_end - 2, 2))
+
+    return swaps
+
+
+def encode_afp_data(afp_data, bsi_data=None):
+    """
+    Encodes a decoded afp. If bsi_data is given (e.g. the BSI the file was originally decoded with), it is reused
+    as is instead of generating a new one. Returns the encoded afp and its BSI.
+    """
+    afp_file = bytearray(afp_data)
+
+    if len(afp_file) < 0x38:
+        raise AfpDecodeError("File is too short to be an afp")
+
+    string_table_offset, string_table_size = struct.unpack_from("<II", afp_file, 0x30)
+    if string_table_offset + string_table_size > len(afp_file):
+        raise AfpDecodeError("String table runs past the end of the file")
+
+    if bsi_data is None:
+        bsi_data = build_bsi(default_swaps(afp_file))
+
+    # The decoder swaps first and then fixes the string table, so do the opposite here.
+    with memoryview(afp_file) as view:
+        obfuscate_string_table(view[string_table_offset:string_table_offset+string_table_size])
+
+    compile_bsi(bytes(bsi_data)).apply(afp_file)
+
+    return afp_file, bytes(bsi_data)
+
+
+def encode_afp_file(input_afp_filename, output_afp_filename, output_bsi_filename, original_bsi_filename=None):
+    afp_data = open(input_afp_filename, "rb").read()
+    bsi_data = open(original_bsi_filename, "rb").read() if original_bsi_filename else None
+
+    afp_file, bsi_file = encode_afp_data(afp_data, bsi_data)
+
+    with open(output_afp_filename, "wb") as outfile:
+        outfile.write(afp_file)
+
+    with open(output_bsi_filename, "wb") as outfile:
+        outfile.write(bsi_file)
+
+
+def _verify_file(afp_filename):
+    try:
+        with tempfile.TemporaryDirectory() as temp_folder:
+            encoded_filename = os.path.join(temp_folder, "afp")
+            bsi_filename = os.path.join(temp_folder, "bsi")
+
+            encode_afp_file(afp_filename, encoded_filename, bsi_filename)
+            decoded = decode_afp_file(encoded_filename, bsi_filename)
+
+    except (AfpDecodeError, OSError, struct.error) as e:
+        return afp_filename, str(e)
+
+    if decoded != open(afp_filename, "rb").read():
+        return afp_filename, "Round trip output doesn't match the input"
+
+    return afp_filename, None
+
+
+def verify_roundtrip(afp_filenames, jobs=None):
+    errors = []
+
+    for afp_filename, error in run_in_pool(_verify_file, [(x,) for x in afp_filenames], jobs):
+        if error is not None:
+            errors.append((afp_filename, error))
+            print("Failed %s: %s" % (afp_filename, error))
+
+    print("Verified %d files, %d failed" % (len(afp_filenames), len(errors)))
+
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('afp', help='Input decoded AFP file, or a folder or glob pattern of them with --verify')
+    parser.add_argument('output', nargs='?', help='Output AFP filename')
+    parser.add_argument('-bsi', help="Optional output path for the BSI file. Default behavior writes to the bsi dir next to the output.")
+    parser.add_argument('--original-bsi', help="BSI the file was originally decoded with. It is reused instead of generating a new one.")
+    parser.add_argument('--verify', action='store_true', help="Encode and decode every input again, and check the result matches.")
+    parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes for --verify. Defaults to the CPU count.")
+    args = parser.parse_args()
+
+    if args.verify:
+        afp_filenames = find_afp_files(args.afp)
+        if not afp_filenames:
+            print("No afp files found in", args.afp)
+            exit(1)
+
+        errors = verify_roundtrip(afp_filenames, args.jobs)
+        exit(1 if errors else 0)
+
+    if args.output is None:
+        parser.error("An output filename is required")
+
+    if args.bsi is None:
+        args.bsi = os.path.join(os.path.dirname(args.output), 'bsi', os.path.basename(args.output))
+        os.makedirs(os.path.dirname(args.bsi), exist_ok=True)
+
+    try:
+        encode_afp_file(args.afp, args.output, args.bsi, args.original_bsi)
+    except AfpDecodeError as e:
+        print(e)
+        exit(1)
+
+    print("Saved to", args.output, "and", args.bsi)
@@ -2,21 +2,23 @@ import argparse
 import glob
 import json
 import os
-import shutil
 import struct
 import sys
-import tempfile
-import ifstools
 
 from lxml import etree, objectify
 from lxml.builder import E
-from PIL import Image
 
 """
-This appears to be an attempt to make a full afp animation and ifs package. While the hardcoded frame bytes aren't 
-very useful, some other parts of this code could be useful in the future, such as texturelist and ifs file packing.
+This appears to be an attempt to make a full afp animation and ifs package. The afp and geo files are described with 
+afpbuilder.py, and some other parts of this code could be useful in the future, such as texturelist and ifs file packing.
 """
-from texturelist import create_texturelist
+import stats
+from afpbuilder import AfpBuilder, build_geo
+from compositor import canvas_jobs, choose_canvas_format, composite_canvas, write_canvases
+from buildmanifest import BuildManifest, IncrementalBuild, default_manifest_filename
+from decode_afp import compile_bsi
+from ifsbuild import IfsBuildError, IfsBuilder, binary_xml, read_ifs
+from texturelist import GUTTER, create_texturelist, dedupe_images
 
 # Example animation.json
 # Creates a 5 frame animation, repeating a00 and a01
@@ -35,8 +37,78 @@ from texturelist import create_texturelist
 # }
 
 
+# Part of the afp and geo artifact keys, so files built by an older layout are built again.
+LAYOUT_VERSION = 2
 
-def parse_animation(input_folder, output_filename):
+# Swaps the magic and file size, which build_afp stores byteswapped, back. The rest of the afp is stored decoded.
+AFP_BSI = struct.pack(">I", 0x80400000)
+
+# Composition bounds (left, right, top, bottom), and the transform that shows the frames sprite in them.
+AFP_BOUNDS = (0, 304, 0, 416)
+FRAMES_TRANSFORM = {'scale': (1.0, 2.0), 'translate': (152.0, 208.0), 'rot_origin': (152.0, 104.0)}
+
+# Sprite ids of the aeplib boilerplate, and the lowest ids of the sprite that plays the frames and of the one
+# exported under the movie name. Those two move up past the shape ids when there are a lot of shapes.
+AEPLIBSET_ID = 3
+AEP_MASK_DUMMY_ID = 6
+FRAMES_SPRITE_ID = 128
+MOVIE_SPRITE_ID = 130
+
+
+def build_blank_geo(texture_width):
+    return build_geo((texture_width, 0), [(0.0, 0.0), (16.0, 0.0), (0.0, 16.0), (16.0, 16.0)])
+
+
+def build_image_geo(label, texture_size, rect, uv):
+    return build_geo(texture_size, rect, uv, label)
+
+
+def build_afp(label, frame_shapes):
+    """
+    frame_shapes is the shape id shown on each frame. Every shape id is defined once, no matter how many frames
+    show it.
+    """
+    frame_count = len(frame_shapes)
+    frames_sprite_id = max(FRAMES_SPRITE_ID, max(frame_shapes) + 1)
+    movie_sprite_id = frames_sprite_id + MOVIE_SPRITE_ID - FRAMES_SPRITE_ID
+
+    afp = AfpBuilder(label, AFP_BOUNDS, fps=30.0, bg_color=(0, 0, 0, 255), flags=0xc0)
+    afp.add_export(label, movie_sprite_id)
+    afp.add_export("aep_mask_dummy", AEP_MASK_DUMMY_ID)
+    afp.add_export("aeplibset", AEPLIBSET_ID)
+    afp.add_import("aeplib", [(2, "aeplib")])
+    afp.add_initializer(2, 0)
+
+    root = afp.root
+    aeplibset = root.add_sprite(AEPLIBSET_ID)
+    aeplibset.place(0, 1, src_tag_id=2)
+    aeplibset.show_frame()
+
+    root.add_shape(5, flags=0)
+    mask_dummy = root.add_sprite(AEP_MASK_DUMMY_ID)
+    mask_dummy.place(1, 1, src_tag_id=5)
+    mask_dummy.show_frame()
+
+    for shape_id in frame_shapes:
+        root.add_shape(shape_id)
+
+    frames = root.add_sprite(frames_sprite_id)
+    for i, shape_id in enumerate(frame_shapes):
+        frames.place(1, frame_count, src_tag_id=shape_id, update=i > 0)
+        frames.show_frame()
+
+    # The movie sprite and the root both place the frames sprite on their first frame, and hold it from then on.
+    movie = root.add_sprite(movie_sprite_id)
+    for clip in (movie, root):
+        clip.place(2, frame_count, src_tag_id=frames_sprite_id, **FRAMES_TRANSFORM)
+        clip.show_frame(frame_count)
+
+    data = afp.build()
+    compile_bsi(AFP_BSI).apply(data)
+    return bytes(data)
+
+
+def parse_animation(input_folder, output_filename, canvas_folder=None, texture_format="auto", incremental=True):
     animation_json = os.path.join(input_folder, "animation.json")
 
     if not os.path.exists(animation_json):
@@ -55,334 +127,176 @@ def parse_animation(input_folder, output_filename):
         for image in animation['frames']:
             all_images.append(image)
 
-    texture_size, xml_data, image_info = create_texturelist(input_folder, all_images)
-
-    for k in image_info:
-        uv_rect, image_size = image_info[k]
-        image_info[k] = {
-            'rect':  ((0.0, 0.0), (image_size[0] - 2, 0.0), (0.0, image_size[1] - 2), (image_size[0] - 2, image_size[1] - 2)),
-            'uv': (((uv_rect[0] + 1) / 1024, (uv_rect[1] + 1) / 1024), ((uv_rect[2] - 1) / 1024, (uv_rect[1] + 1) / 1024), ((uv_rect[0] + 1) / 1024, (uv_rect[3] - 1) / 1024), ((uv_rect[2] - 1) / 1024, (uv_rect[3] - 1) / 1024))
-        }
-
-    afp_info = {}
-    with tempfile.TemporaryDirectory() as temp_folder:
-        os.makedirs(os.path.join(temp_folder, "afp"))
-        os.makedirs(os.path.join(temp_folder, "afp", "bsi"))
-        os.makedirs(os.path.join(temp_folder, "geo"))
-        os.makedirs(os.path.join(temp_folder, "tex"))
-
-        with open(os.path.join(temp_folder, "c_version"), "w") as outfile:
-            outfile.write("1.3.71\0")
-
-        with open(os.path.join(temp_folder, "magic"), "w") as outfile:
-            outfile.write("NGPF")
-
-        for animation in animation_metadata['animations']:
-            afp_info[animation['label']] = [5]
-
-            # I'm not sure what the purpose of this blank frame is for, but create it anyway
-            with open(os.path.join(temp_folder, "geo", "%s_shape5" % (animation['label'])), "wb") as outfile:
-                outfile.write("GE2D".encode('ascii'))
-                outfile.write(struct.pack(">I", 0x00010000))
-                outfile.write(struct.pack(">I", 0x00010100))
-
-                filesize_offset = outfile.tell()
-                outfile.write(struct.pack(">I", 0x00000070)) # Total filesize
-                outfile.write(struct.pack(">I", 0x00000000))
-                outfile.write(struct.pack("<HH", texture_size[0], 0)) # Texture sheet size
-                outfile.write(struct.pack(">I", 0x00000000))
-                outfile.write(struct.pack(">I", 0x00010000))
-
-                rect_point_offset = outfile.tell()
-                outfile.write(struct.pack(">I", 0x00000034)) # Rect points offset
-                outfile.write(struct.pack(">I", 0x00000000)) # Texture points offset
-                outfile.write(struct.pack(">I", 0x00000000)) # Unknown offset
-                outfile.write(struct.pack(">I", 0x00000000)) # Label/strings offset offset
-
-                unk_data_offset = outfile.tell()
-                outfile.write(struct.pack(">I", 0x00000054)) # Unknown data offset
-
-                new_rect_point_offset = outfile.tell()
-                rects = [(0.0, 0.0), (16.0, 0.0), (0.0, 16.0), (16.0, 16.0)]
-                for p in rects:
-                    outfile.write(struct.pack(">ff", *p))
-
-                new_unk_data_offset = outfile.tell()
-                outfile.write(struct.pack(">I", 0x0409ffff))
-                outfile.write(struct.pack(">I", 0x00060000))
-                outfile.write(struct.pack(">I", 0xff00ffff))
-                outfile.write(struct.pack(">I", outfile.tell() + 4)) # Some offset?
-                outfile.write(struct.pack(">I", 0x00000001)) # Some offset's data?
-                outfile.write(struct.pack(">I", 0x00020002))
-                outfile.write(struct.pack(">I", 0x00010003))
-
-                new_filesize = outfile.tell()
-                outfile.seek(filesize_offset, 0)
-                outfile.write(struct.pack(">I", new_filesize))
-
-                outfile.seek(rect_point_offset, 0)
-                outfile.write(struct.pack(">I", new_rect_point_offset))
-
-                outfile.seek(unk_data_offset, 0)
-                outfile.write(struct.pack(">I", new_unk_data_offset))
-
-            # Create a geo file for every image
-            for i, image_name in enumerate(animation['frames']):
-                afp_info[animation['label']].append(10 + i * 3)
-
-                with open(os.path.join(temp_folder, "geo", "%s_shape%d" % (animation['label'], 10 + i * 3)), "wb") as outfile:
-                    outfile.write("GE2D".encode('ascii'))
-                    outfile.write(struct.pack(">I", 0x00010000))
-                    outfile.write(struct.pack(">I", 0x00010100))
-
-                    filesize_offset = outfile.tell()
-                    outfile.write(struct.pack(">I", 0x00000098)) # Total filesize
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write(struct.pack("<HH", texture_size[0], texture_size[1])) # Texture sheet size
-                    outfile.write(struct.pack(">I", 0x00000001))
-                    outfile.write(struct.pack(">I", 0x00010000))
-
-                    rect_point_offset = outfile.tell()
-                    outfile.write(struct.pack(">I", 0x0000003c)) # Rect points offset
-
-                    texture_point_offset = outfile.tell()
-                    outfile.write(struct.pack(">I", 0x0000005c)) # Texture points offset
-                    outfile.write(struct.pack(">I", 0x00000000)) # Unknown offset
-
-                    strings_offset = outfile.tell()
-                    outfile.write(struct.pack(">I", 0x00000034)) # Label/strings offset offset
-
-                    unk_data_offset = outfile.tell()
-                    outfile.write(struct.pack(">I", 0x0000007c)) # Unknown data offset
-
-                    new_strings_offset = outfile.tell()
-                    outfile.write(struct.pack(">I", outfile.tell() + 4)) # Label string offset
-                    outfile.write(os.path.splitext(image_name)[0].encode('ascii'))
-
-                    while (outfile.tell() % 4) != 0:
-                        outfile.write(struct.pack("<B", 0))
-
-                    new_rect_point_offset = outfile.tell()
-                    for p in image_info[image_name]['rect']:
-                        outfile.write(struct.pack(">ff", *p))
-
-                    new_texture_point_offset = outfile.tell()
-                    for p in image_info[image_name]['uv']:
-                        outfile.write(struct.pack(">ff", *p))
-
-                    new_unk_data_offset = outfile.tell()
-                    outfile.write(struct.pack(">I", 0x040300ff))
-                    outfile.write(struct.pack(">I", 0x00060000))
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write(struct.pack(">I", outfile.tell() + 4)) # Some offset?
-                    outfile.write(struct.pack(">I", 0x00000001)) # Some offset's data?
-                    outfile.write(struct.pack(">I", 0x00020002))
-                    outfile.write(struct.pack(">I", 0x00010003))
-
-                    new_filesize = outfile.tell()
-                    outfile.seek(filesize_offset, 0)
-                    outfile.write(struct.pack(">I", new_filesize))
-
-                    outfile.seek(rect_point_offset, 0)
-                    outfile.write(struct.pack(">I", new_rect_point_offset))
-
-                    outfile.seek(texture_point_offset, 0)
-                    outfile.write(struct.pack(">I", new_texture_point_offset))
-
-                    outfile.seek(strings_offset, 0)
-                    outfile.write(struct.pack(">I", new_strings_offset))
-
-                    outfile.seek(unk_data_offset, 0)
-                    outfile.write(struct.pack(">I", new_unk_data_offset))
-
-                with open(os.path.join(temp_folder, "afp", "%s" % animation['label']), "wb") as outfile:
-                    frame_count = len(animation['frames'])
-
-                    outfile.write(struct.pack(">I", 0xc1d0b208)) # AP2
-                    outfile.write(struct.pack(">I", 0)) # filesize
-                    outfile.write(struct.pack(">I", 0x00020400))
-                    outfile.write(struct.pack(">I", 0xc7000000))
-                    outfile.write(struct.pack(">I", 0x00003001))
-                    outfile.write(struct.pack(">I", 0x0000a001))
-                    outfile.write(struct.pack(">I", 0x00780000))
-                    outfile.write(struct.pack(">I", 0x000000ff))
-
-                    outfile.write(struct.pack(">I", 0x03000100))
-                    outfile.write(struct.pack(">I", 0x60000000))
-                    outfile.write(struct.pack(">I", 0x3c000000))
-                    outfile.write(struct.pack(">I", 0x48000000))
-
-                    string_table_offset = outfile.tell()
-                    outfile.write(struct.pack("<I", 0)) # string table offset
-                    outfile.write(struct.pack("<I", 0x38)) # string table size
-                    outfile.write(struct.pack(">I", 0x50000000))
-                    outfile.write(struct.pack(">I", 0x82000400))
-                    outfile.write(struct.pack(">I", 0x06000800))
-                    outfile.write(struct.pack(">I", 0x03001800))
-                    outfile.write(struct.pack(">I", 0x24000100))
-                    outfile.write(struct.pack(">I", 0x02002400))
-                    outfile.write(struct.pack(">I", 0x00000100))
-                    outfile.write(struct.pack(">I", 0x02000000))
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write(struct.pack(">I", 0x00000000))
-
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write(struct.pack("<I", frame_count))
-                    outfile.write(struct.pack("<I", frame_count + 6))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack("<I", (frame_count + 6) * 4))
-                    outfile.write(struct.pack("<H", 0))
-                    outfile.write(struct.pack("<H", (frame_count + 6) * 16))
-
-                    for i in range(1, frame_count):
-                        outfile.write(struct.pack("<I", frame_count + 6))
-
-                    outfile.write(struct.pack(">I", 0x3400401e))
-                    outfile.write(struct.pack(">I", 0x01000300))
-                    outfile.write(struct.pack(">I", 0x08000000))
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write(struct.pack(">I", 0x01000000))
-                    outfile.write(struct.pack(">I", 0x01000000))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack(">I", 0x1c000000))
-                    outfile.write(struct.pack(">I", 0x00001000))
-                    outfile.write(struct.pack(">I", 0x0c00c01f))
-                    outfile.write(struct.pack(">I", 0x06000000))
-                    outfile.write(struct.pack(">I", 0x00000100))
-                    outfile.write(struct.pack(">I", 0x02000000))
-                    outfile.write(struct.pack(">I", 0x04000021))
-                    outfile.write(struct.pack(">I", 0x00000500))
-
-                    outfile.write(struct.pack(">I", 0x3400401e))
-                    outfile.write(struct.pack(">I", 0x01000600))
-                    outfile.write(struct.pack(">I", 0x08000000))
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write(struct.pack(">I", 0x01000000))
-                    outfile.write(struct.pack(">I", 0x01000000))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack(">I", 0x1c000000))
-                    outfile.write(struct.pack(">I", 0x00001000))
-                    outfile.write(struct.pack(">I", 0x0c00c01f))
-                    outfile.write(struct.pack(">I", 0x06000000))
-
-                    # First blank frame??
-                    outfile.write(struct.pack(">I", 0x01000100))
-                    outfile.write(struct.pack(">I", 0x05000000))
-
-                    for i in range(0, frame_count):
-                        outfile.write(struct.pack(">IH", 0x04000021, 0x0200))
-                        outfile.write(struct.pack("<H", 10 + i * 3))
-
-                    outfile.write(struct.pack("<H", 0x20 + (frame_count * 0x10) + (frame_count * 0x04)))
-                    outfile.write(struct.pack(">H", 0x401e))
-                    outfile.write(struct.pack(">I", 0x01008000))
-                    outfile.write(struct.pack(">I", 0x08000000))
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write(struct.pack("<I", frame_count))
-                    outfile.write(struct.pack("<I", frame_count))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack("<I", (frame_count + 6) * 4))
-
-                    for i in range(0, frame_count):
-                        outfile.write(struct.pack("<HH", i, 0x10))
-
-                    for i in range(0, frame_count):
-                        outfile.write(struct.pack(">I", 0x0c00c01f))
-                        outfile.write(struct.pack(">I", 0x06000000 if i == 0 else 0x03000000))
-                        outfile.write(struct.pack(">H", 0x0100))
-                        outfile.write(struct.pack("<H", frame_count))
-                        outfile.write(struct.pack("<I", 10 + i * 3))
-
-                    outfile.write(struct.pack("<H", 0x48 + (frame_count * 4)))
-                    outfile.write(struct.pack(">H", 0x401e))
-                    outfile.write(struct.pack(">I", 0x01008200))
-                    outfile.write(struct.pack(">I", 0x08000000))
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write(struct.pack("<I", frame_count))
-                    outfile.write(struct.pack(">I", 0x01000000))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack(">I", 0x18000000))
-                    outfile.write(struct.pack("<I", (frame_count + 6) * 4))
-                    outfile.write(struct.pack(">I", 0x00001000))
-
-                    for i in range(1, frame_count):
-                        outfile.write(struct.pack("<I", 1))
-
-                    outfile.write(struct.pack(">I", 0x2400c01f))
-                    outfile.write(struct.pack(">I", 0x06050001))
-                    outfile.write(struct.pack(">H", 0x0200))
-                    outfile.write(struct.pack("<H", frame_count))
-                    outfile.write(struct.pack(">I", 0x80000000))
-                    outfile.write(struct.pack(">I", 0x00040000))
-                    outfile.write(struct.pack(">I", 0x00080000))
-                    outfile.write(struct.pack(">I", 0xe00b0000))
-                    outfile.write(struct.pack(">I", 0x40100000))
-                    outfile.write(struct.pack(">I", 0xe00b0000))
-                    outfile.write(struct.pack(">I", 0x20080000))
-                    outfile.write(struct.pack(">I", 0x2400c01f))
-                    outfile.write(struct.pack(">I", 0x06050001))
-                    outfile.write(struct.pack(">H", 0x0200))
-                    outfile.write(struct.pack("<H", frame_count))
-                    outfile.write(struct.pack(">I", 0x80000000))
-                    outfile.write(struct.pack(">I", 0x00040000))
-                    outfile.write(struct.pack(">I", 0x00080000))
-                    outfile.write(struct.pack(">I", 0xe00b0000))
-                    outfile.write(struct.pack(">I", 0x40100000))
-                    outfile.write(struct.pack(">I", 0xe00b0000))
-                    outfile.write(struct.pack(">I", 0x20080000))
-
-                    new_string_table_offset = outfile.tell()
-                    outfile.write(struct.pack(">I", 0x00000000))
-                    outfile.write("{}\0\0".format(animation['label']).encode('ascii')) # Name of afp file?
-                    outfile.write("aep_mask_dummy\0\0".encode('ascii'))
-                    outfile.write("aeplibset\0\0\0".encode('ascii'))
-                    outfile.write("aeplib\0\0".encode('ascii'))
-                    outfile.write("aep_dummy\0\0\0".encode('ascii'))
-
-                    curlen = outfile.tell()
-                    outfile.seek(0x04, 0)
-                    outfile.write(struct.pack(">I", curlen))
-
-                    outfile.seek(string_table_offset, 0)
-                    outfile.write(struct.pack("<I", new_string_table_offset))
-
-                with open(os.path.join(temp_folder, "afp", "bsi", "%s" % animation['label']), "wb") as outfile:
-                    outfile.write(struct.pack(">I", 0x80400000)) # Swap 2 ints
-
-        # Create afplist.xml
-        afplist = E.afplist(
-            *[E.afp(
-                E.geo(
-                    " ".join(["%d" % x for x in afp_info[k]]),
-                    __type="u16",
-                    __count="{}".format(len(afp_info[k]))
-                ),
-                name=k
-            ) for k in afp_info]
+    # Anything that hasn't changed since the last build is taken from the previous output instead of built again.
+    manifest_filename = default_manifest_filename(output_filename)
+    previous, previous_files = BuildManifest(), {}
+    if incremental and os.path.exists(output_filename):
+        previous = BuildManifest.load(manifest_filename)
+        try:
+            previous_files = read_ifs(output_filename)
+        except (IfsBuildError, OSError, ValueError, struct.error) as e:
+            print("Couldn't read the previous build, building everything:", e)
+
+    build = IncrementalBuild(previous, previous_files, {'format': texture_format})
+    build.add_input("animation.json", animation_json)
+    for image in sorted(set(all_images)):
+        build.add_input(image, os.path.join(input_folder, image))
+
+    def select_format(size, sprites):
+        # auto picks dxt5 or argb8888rev for each canvas, unless the canvas is the same as last time
+        key = [size, sorted([build.manifest.inputs[os.path.relpath(filename, input_folder)], x, y] for filename, x, y in sprites)]
+        return build.canvas_format(key, lambda: choose_canvas_format(size, sprites))
+
+    # Images with the same pixels are packed once, under the first of their names
+    with stats.timer("dedupe_images"):
+        canonical = dedupe_images(input_folder, all_images)
+    duplicates = sorted(name for name in canonical if canonical[name] != name)
+
+    with stats.timer("create_texturelist"):
+        canvas_sizes, xml_data, image_info = create_texturelist(
+            input_folder, list(canonical.values()), select_format if texture_format == "auto" else None, build.previous_placements()
         )
+    build.manifest.placements = {k: list(v) for k, v in image_info.items()}
 
+    jobs = canvas_jobs(input_folder, canvas_sizes, image_info)
+    if canvas_folder is not None:
+        written, errors = write_canvases(jobs, canvas_folder)
+        for name, error in errors:
+            print("Failed to write %s: %s" % (name, error))
+        print("Wrote %d canvases to %s" % (len(written), canvas_folder))
 
-        with open(os.path.join(temp_folder, "afp", "afplist.xml"), "wb") as outfile:
-            outfile.write(etree.tostring(afplist, pretty_print=True))
+    # Cell area that would have gone to duplicates
+    area_saved = 0
+    for name in duplicates:
+        cell = image_info[canonical[name]][0]
+        area_saved += (cell[2] - cell[0]) * (cell[3] - cell[1])
 
-        # Copy all textures to tex folder and save texturelist.xml
-        for filename in all_images:
-            shutil.copyfile(os.path.join(input_folder, filename), os.path.join(temp_folder, "tex", filename))
+    for k in image_info:
+        cell, image_size, canvas = image_info[k]
+        canvas_width, canvas_height = canvas_sizes[canvas]
 
-        with open(os.path.join(temp_folder, "tex", "texturelist.xml"), "wb") as outfile:
-            outfile.write(xml_data)
+        # The image sits inside its cell's gutter
+        left, top = (cell[0] + GUTTER) / canvas_width, (cell[1] + GUTTER) / canvas_height
+        right, bottom = (cell[0] + GUTTER + image_size[0]) / canvas_width, (cell[1] + GUTTER + image_size[1]) / canvas_height
+        image_info[k] = {
+            'rect':  ((0.0, 0.0), (image_size[0], 0.0), (0.0, image_size[1]), (image_size[0], image_size[1])),
+            'uv': ((left, top), (right, top), (left, bottom), (right, bottom)),
+            'texture_size': canvas_sizes[canvas],
+        }
+
+    ifs = IfsBuilder()
+    ifs.add_file("c_version", build.artifact("c_version", "1.3.71", lambda: b"1.3.71\0"))
+    ifs.add_file("magic", build.artifact("magic", "NGPF", lambda: b"NGPF"))
 
-        ifs = ifstools.IFS(temp_folder)
-        ifs.repack(path=output_filename, use_cache=False)
+    afp_info = {}
+    geo_bytes_saved = 0
+    shared_frames = 0
+    for animation in animation_metadata['animations']:
+        label = animation['label']
+        afp_info[label] = [5]
+
+        # I'm not sure what the purpose of this blank frame is for, but create it anyway
+        ifs.add_file("geo/%s_shape5" % label, build.artifact(
+            "geo/%s_shape5" % label, ["blank_geo", canvas_sizes[0][0]], lambda: build_blank_geo(canvas_sizes[0][0])
+        ))
+
+        # Create a geo file for every distinct image. Frames showing the same image share its shape.
+        shapes = {}
+        frame_shapes = []
+        for image_name in animation['frames']:
+            image_name = canonical[image_name]
+            if image_name in shapes:
+                geo_bytes_saved += len(ifs.files["geo/%s_shape%d" % (label, shapes[image_name])])
+                shared_frames += 1
+                frame_shapes.append(shapes[image_name])
+                continue
+
+            shape_id = shapes[image_name] = 10 + len(shapes) * 3
+            afp_info[label].append(shape_id)
+            frame_shapes.append(shape_id)
+
+            info = image_info[image_name]
+            name = os.path.splitext(image_name)[0]
+            ifs.add_file("geo/%s_shape%d" % (label, shape_id), build.artifact(
+                "geo/%s_shape%d" % (label, shape_id),
+                ["image_geo", LAYOUT_VERSION, name, info['texture_size'], info['rect'], info['uv']],
+                lambda: build_image_geo(name, info['texture_size'], info['rect'], info['uv'])
+            ))
+
+        ifs.add_file("afp/%s" % label, build.artifact(
+            "afp/%s" % label, ["afp", LAYOUT_VERSION, label, frame_shapes], lambda: build_afp(label, frame_shapes)
+        ))
+        ifs.add_file("afp/bsi/%s" % label, build.artifact(
+            "afp/bsi/%s" % label, "bsi", lambda: AFP_BSI
+        ))
+
+    # Create afplist.xml
+    afplist = E.afplist(
+        *[E.afp(
+            E.geo(
+                " ".join(["%d" % x for x in afp_info[k]]),
+                __type="u16",
+                __count="{}".format(len(afp_info[k]))
+            ),
+            name=k
+        ) for k in afp_info]
+    )
+    afplist = etree.tostring(afplist, pretty_print=True)
+    ifs.add_file("afp/afplist.xml", build.artifact(
+        "afp/afplist.xml", afplist.decode('utf-8'), lambda: binary_xml(afplist)
+    ))
+    ifs.add_file("tex/texturelist.xml", build.artifact(
+        "tex/texturelist.xml", xml_data.decode('utf-8'), lambda: binary_xml(xml_data)
+    ))
+
+    # Textures are cut out of their canvases and encoded straight into the IFS, one canvas at a time. Images that
+    # are encoded the same as last time are copied over, and canvases without any changed image are never built.
+    image_files = {os.path.splitext(os.path.basename(k))[0]: k for k in image_info}
+    texturelist = etree.fromstring(xml_data)
+    texture_keys = {}
+    encoded = {}
+    for texture in texturelist.iterchildren("texture"):
+        for image in texture.iterchildren("image"):
+            name = image.attrib['name']
+            texture_keys[name] = [
+                "texture", build.manifest.inputs[image_files[name]], image.find("imgrect").text,
+                texture.attrib['format'], texturelist.attrib.get('compress')
+            ]
+            data = build.reusable("tex/%s.png" % name, texture_keys[name])
+            if data is not None:
+                encoded[name] = data
+
+    canvas_lookup = {name: (size, sprites) for name, size, sprites in jobs}
+    with stats.timer("add_textures"):
+        ifs.add_textures(xml_data, lambda name: composite_canvas(*canvas_lookup[name]), encoded)
+    for name, key in texture_keys.items():
+        build.record("tex/%s.png" % name, key, ifs.files["tex/%s.png" % name], reused=name in encoded)
+
+    texture_bytes_saved = sum(len(ifs.files["tex/%s.png" % os.path.splitext(os.path.basename(canonical[name]))[0]]) for name in duplicates)
+    print("Deduplicated %d images and %d frames: %d px of texture area, %d bytes of textures and %d bytes of geo saved" % (
+        len(duplicates), shared_frames, area_saved, texture_bytes_saved, geo_bytes_saved
+    ))
+
+    stats.count("files_built", len(build.built))
+    stats.count("files_reused", len(build.reused))
+
+    if build.unchanged:
+        print("Nothing changed since the last build of", output_filename)
+        return
+
+    ifs.write(output_filename)
+    build.manifest.save(manifest_filename)
+    print("Built %d files, reused %d from the last build" % (len(build.built), len(build.reused)))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', help='Input images folder', required=True)
     parser.add_argument('--output', help='Output IFS file', required=True)
+    parser.add_argument('--canvases', help='Also write the packed _canvas_texNNN.png atlases to this folder')
+    parser.add_argument('--format', choices=['auto', 'argb8888rev'], default='auto', help='Texture format. auto picks dxt5 for canvases that compress well.')
+    parser.add_argument('--full', action='store_true', help="Build everything again instead of reusing what didn't change since the last build")
+    stats.add_arguments(parser)
     args = parser.parse_args()
 
-    parse_animation(args.input, args.output)
+    with stats.session(args.stats, args.profile):
+        parse_animation(args.input, args.output, args.canvases, args.format, not args.full)
@@ -0,0 +1,280 @@
+import argparse
+import mmap
+import os
+import re
+import struct
+import time
+
+import numpy as np
+
+from georeader import GeoParseError, read_geo
+
+"""
+Indexes every shape geo file in a geo folder, so finding which movie and shape id use a texture doesn't need grep.
+The index is kept in a .npz file next to the geo folder, and only files whose mtime or size changed are parsed
+again when it's loaded.
+"""
+
+GEO_FILENAME = re.compile(r'^(?P<movie>.+)_shape(?P<shape_id>\d+)$')
+
+SHAPE_DTYPE = np.dtype([
+    ('file', np.int32),             # Index into files
+    ('movie', np.int32),            # Index into movies
+    ('shape_id', np.int32),
+    ('label', np.int32),            # Index into labels, or -1 if the shape has no texture
+    ('texture_width', np.uint16),
+    ('texture_height', np.uint16),
+    ('has_rects', np.bool_),
+    ('has_texture_rects', np.bool_),
+    ('rects', np.float32, (4, 2)),
+    ('texture_rects', np.float32, (4, 2)),
+])
+
+# Bump when SHAPE_DTYPE or the way files are parsed changes, so old indexes get rebuilt.
+INDEX_VERSION = 2
+
+
+def default_index_filename(geo_folder):
+    return os.path.normpath(geo_folder) + "_index.npz"
+
+
+def scan_geo_folder(geo_folder):
+    # (filename, movie, shape id, mtime, size) of every shape geo file in the folder.
+    files = []
+    with os.scandir(geo_folder) as entries:
+        for entry in entries:
+            match = GEO_FILENAME.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            files.append((entry.name, match.group('movie'), int(match.group('shape_id')), stat.st_mtime_ns, stat.st_size))
+
+    files.sort()
+    return files
+
+
+def read_geo_file(filename):
+    with open(filename, "rb") as infile:
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return read_geo(data)
+
+
+class GeoIndex(object):
+    """
+    Every shape in a geo folder as a structured array of SHAPE_DTYPE, plus the filenames, movie names and labels
+    (texture names) its rows point to.
+    """
+    def __init__(self, files, mtimes, sizes, movies, labels, shapes, errors=None):
+        self.files = files
+        self.mtimes = mtimes
+        self.sizes = sizes
+        self.movies = movies
+        self.labels = labels
+        self.shapes = shapes
+        self.errors = errors or []
+
+        self._label_lookup = None
+        self._shape_lookup = None
+
+    @classmethod
+    def build(cls, geo_folder, previous=None):
+        """
+        Indexes a geo folder. Rows for files that haven't changed since the previous index are reused.
+        """
+        reusable = {}
+        if previous is not None:
+            for row in previous.shapes:
+                file_index = row['file']
+                reusable[previous.files[file_index]] = (previous.mtimes[file_index], previous.sizes[file_index], row)
+
+        files, mtimes, sizes = [], [], []
+        movies, movie_lookup = [], {}
+        labels, label_lookup = [], {}
+        shapes = np.zeros(0, dtype=SHAPE_DTYPE)
+        rows = []
+        errors = []
+
+        def intern(strings, lookup, value):
+            index = lookup.get(value)
+            if index is None:
+                index = lookup[value] = len(strings)
+                strings.append(value)
+            return index
+
+        for filename, movie, shape_id, mtime, size in scan_geo_folder(geo_folder):
+            # Files that fail to parse are still listed, so they don't make the index look out of date. Their errors
+            # are saved with the index, to be reported again when it's loaded.
+            file_index = len(files)
+            files.append(filename)
+            mtimes.append(mtime)
+            sizes.append(size)
+
+            row = np.zeros((), dtype=SHAPE_DTYPE)
+            old = reusable.get(filename)
+
+            if old is not None and old[0] == mtime and old[1] == size:
+                row[()] = old[2]
+                label = previous.labels[old[2]['label']] if old[2]['label'] >= 0 else None
+            else:
+                try:
+                    geo = read_geo_file(os.path.join(geo_folder, filename))
+                except (GeoParseError, OSError, ValueError, struct.error) as e:
+                    errors.append((filename, str(e)))
+                    continue
+
+                row['texture_width'] = geo['texture_width']
+                row['texture_height'] = geo['texture_height']
+                if geo['rects'] is not None:
+                    row['has_rects'] = True
+                    row['rects'] = geo['rects']
+                if geo['texture_rects'] is not None:
+                    row['has_texture_rects'] = True
+                    row['texture_rects'] = geo['texture_rects']
+                label = geo['label']
+
+            row['file'] = file_index
+            row['movie'] = intern(movies, movie_lookup, movie)
+            row['shape_id'] = shape_id
+            row['label'] = intern(labels, label_lookup, label) if label is not None else -1
+            rows.append(row)
+
+        if rows:
+            shapes = np.array(rows, dtype=SHAPE_DTYPE)
+
+        return cls(
+            np.array(files, dtype=str), np.array(mtimes, dtype=np.int64), np.array(sizes, dtype=np.int64),
+            np.array(movies, dtype=str), np.array(labels, dtype=str), shapes, errors
+        )
+
+    def save(self, index_filename):
+        # Written to a temporary file first, so an interrupted save never leaves a broken index behind.
+        temp_filename = index_filename + ".tmp.npz"
+        error_files = [filename for filename, _ in self.errors]
+        error_messages = [message for _, message in self.errors]
+        np.savez(
+            temp_filename, version=INDEX_VERSION, files=self.files, mtimes=self.mtimes, sizes=self.sizes,
+            movies=self.movies, labels=self.labels, shapes=self.shapes, error_files=np.array(error_files, dtype=str),
+            error_messages=np.array(error_messages, dtype=str)
+        )
+        os.replace(temp_filename, index_filename)
+
+    @classmethod
+    def load(cls, index_filename):
+        with np.load(index_filename) as index:
+            if int(index['version']) != INDEX_VERSION:
+                return None
+            errors = list(zip(index['error_files'].tolist(), index['error_messages'].tolist()))
+            return cls(
+                index['files'], index['mtimes'], index['sizes'], index['movies'], index['labels'], index['shapes'],
+                errors
+            )
+
+    @classmethod
+    def open(cls, geo_folder, index_filename=None, rebuild=False):
+        """
+        Loads the index of a geo folder, updating it first if any file was added, removed or changed.
+        """
+        if index_filename is None:
+            index_filename = default_index_filename(geo_folder)
+
+        previous = None
+        if not rebuild and os.path.exists(index_filename):
+            try:
+                previous = cls.load(index_filename)
+            except (OSError, ValueError, KeyError):
+                previous = None
+
+        if previous is not None and previous.is_current(geo_folder):
+            return previous
+
+        index = cls.build(geo_folder, previous)
+        index.save(index_filename)
+        return index
+
+    def is_current(self, geo_folder):
+        files = scan_geo_folder(geo_folder)
+        if len(files) != len(self.files):
+            return False
+
+        filenames, _, _, mtimes, sizes = zip(*files) if files else ((), (), (), (), ())
+        return (
+            np.array_equal(np.array(filenames, dtype=str), self.files) and
+            np.array_equal(np.array(mtimes, dtype=np.int64), self.mtimes) and
+            np.array_equal(np.array(sizes, dtype=np.int64), self.sizes)
+        )
+
+    def _shape_info(self, rows):
+        return [
+            {
+                'movie': str(self.movies[row['movie']]),
+                'shape_id': int(row['shape_id']),
+                'label': str(self.labels[row['label']]) if row['label'] >= 0 else None,
+                'rects': row['rects'].tolist() if row['has_rects'] else None,
+                'texture_rects': row['texture_rects'].tolist() if row['has_texture_rects'] else None,
+            }
+            for row in rows
+        ]
+
+    def find_texture(self, texture_name):
+        """
+        Every shape that uses a texture, as dicts of the movie, shape id, label, rects and texture rects.
+        """
+        if self._label_lookup is None:
+            # Rows sorted by label, and where each label's rows start.
+            order = np.argsort(self.shapes['label'], kind='stable')
+            starts = np.searchsorted(self.shapes['label'][order], np.arange(len(self.labels) + 1))
+            self._label_lookup = ({str(label): i for i, label in enumerate(self.labels)}, order, starts)
+
+        label_indices, order, starts = self._label_lookup
+        label = label_indices.get(texture_name)
+        if label is None:
+            return []
+
+        return self._shape_info(self.shapes[order[starts[label]:starts[label + 1]]])
+
+    def search(self, text):
+        """
+        Like find_texture, for every texture whose name contains text. Case insensitive.
+        """
+        matches = np.flatnonzero(np.char.find(np.char.lower(self.labels), text.lower()) >= 0)
+        return self._shape_info(self.shapes[np.isin(self.shapes['label'], matches)])
+
+    def shape(self, movie, shape_id):
+        if self._shape_lookup is None:
+            self._shape_lookup = {
+                (str(self.movies[row['movie']]), int(row['shape_id'])): i for i, row in enumerate(self.shapes)
+            }
+
+        index = self._shape_lookup.get((movie, shape_id))
+        if index is None:
+            return None
+        return self._shape_info(self.shapes[index:index + 1])[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('geo', help='Input geo folder')
+    parser.add_argument('textures', nargs='*', help='Texture names to look up')
+    parser.add_argument('-search', help='Look up every texture whose name contains this text')
+    parser.add_argument('-index', help="Index filename. Defaults to <geo folder>_index.npz")
+    parser.add_argument('-rebuild', action='store_true', help="Parse every file again instead of updating the index")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    index = GeoIndex.open(args.geo, args.index, args.rebuild)
+    print("Indexed %d shapes, %d textures in %.3fs" % (len(index.shapes), len(index.labels), time.perf_counter() - start_time))
+
+    for filename, error in index.errors:
+        print("Failed to read %s: %s" % (filename, error))
+
+    results = []
+    for texture_name in args.textures:
+        results.extend(index.find_texture(texture_name))
+    if args.search is not None:
+        results.extend(index.search(args.search))
+
+    for shape in results:
+        print("\"%s\": movie %s shape %d rects:%s texture rects:%s" % (
+            shape['label'], shape['movie'], shape['shape_id'], shape['rects'], shape['texture_rects']
+        ))
@@ -1,84 +1,107 @@
 import argparse
 import struct
 
+import stats
+
 """
 This file is ok for reading the rects and the label (texture name associated with this shape). 
 If you need something more complete though, use bemaniutils/afputils.
 """
 
-def read_filename(infile, offset):
+class GeoParseError(Exception):
+    pass
+
+
+def read_filename(data, offset):
     if offset == 0:
         return None
 
-    infile.seek(offset, 0)
+    offset = struct.unpack_from(">I", data, offset)[0]
 
-    offset = struct.unpack(">I", infile.read(4))[0]
-    infile.seek(offset, 0)
+    end = data.find(b'\0', offset)
+    return bytes(data[offset:end if end >= 0 else len(data)]).decode('shift-jis')
 
-    filename = []
-    while True:
-        c = infile.read(1)
 
-        if c == b'\0':
-            break
+def read_geo(data):
+    """
+    Parses a GE2D geo file from anything that supports the buffer protocol and find() (bytes, mmap).
+    Returns a dict with the texture size, offsets, label, rect points, texture rect points and unknown data.
+    """
+    if data[0:4] != b'GE2D':
+        raise GeoParseError("Not a GE2D geo file")
 
-        filename.append(c)
+    stats.count("geo_files_parsed")
+    stats.count("geo_bytes_parsed", len(data))
 
-    return b"".join(filename).decode('shift-jis')
+    texture_width, texture_height = struct.unpack_from("<HH", data, 0x14)
+    offsets = struct.unpack_from(">IIIII", data, 0x20)
 
+    if offsets[2] != 0:
+        raise GeoParseError("Found unknown offset 2: %s" % (offsets,))
 
-def parse_geo(input_filename):
-    with open(input_filename, "rb") as infile:
-        if infile.read(4) != b'GE2D':
-            print("Not a GE2D geo file")
-            exit(1)
+    geo = {
+        'texture_width': texture_width,
+        'texture_height': texture_height,
+        'offsets': offsets,
+        'label': None,
+        'rects': None,
+        'texture_rects': None,
+        'unk': None,
+    }
 
-        infile.seek(0x14, 0)
-        texture_width, texture_height = struct.unpack("<HH", infile.read(4))
-        print(f'{texture_width=}, {texture_height=}')
+    # Read layer label
+    if offsets[3] != 0:
+        geo['label'] = read_filename(data, offsets[3])
 
-        infile.seek(0x20, 0)
+    if offsets[0] != 0:
+        # Read rect points
+        rect_points = struct.unpack_from(">ffffffff", data, offsets[0])
+        rect_points = [x * 2 for x in rect_points]
+        geo['rects'] = list(zip(rect_points[0::2], rect_points[1::2]))
 
-        offsets = struct.unpack(">IIIII", infile.read(0x14))
+    if offsets[1] != 0:
+        # Read texture points
+        text_points = struct.unpack_from(">ffffffff", data, offsets[1])
+        text_points = [x * texture_width * 2 for x in text_points]
+        geo['texture_rects'] = list(zip(text_points[0::2], text_points[1::2]))
 
-        if offsets[2] != 0:
-            print("Found unknown offset 2 in", input_filename)
-            print(offsets)
+    # Not sure what this is for
+    if offsets[4] != 0:
+        geo['unk'] = struct.unpack_from("<iii", data, offsets[4])
+
+    return geo
+
+
+def parse_geo(input_filename):
+    with open(input_filename, "rb") as infile:
+        try:
+            geo = read_geo(infile.read())
+        except GeoParseError as e:
+            print(e, "in", input_filename)
             exit(1)
 
-        print("Offsets:", ["%08x" % x for x in offsets])
+    texture_width, texture_height = geo['texture_width'], geo['texture_height']
+    print(f'{texture_width=}, {texture_height=}')
+    print("Offsets:", ["%08x" % x for x in geo['offsets']])
 
-        # Read layer label
-        if offsets[3] != 0:
-            label = read_filename(infile, offsets[3])
-            print("Label: \"%s\"" % label)
+    if geo['label'] is not None:
+        print("Label: \"%s\"" % geo['label'])
 
-        if offsets[0] != 0:
-            # Read rect points
-            infile.seek(offsets[0], 0)
-            rect_points = struct.unpack(">ffffffff", infile.read(0x20))
-            rect_points = [x * 2 for x in rect_points]
-            rect_points = list(zip(rect_points[0::2], rect_points[1::2]))
-            print("Rects", rect_points)
+    if geo['rects'] is not None:
+        print("Rects", geo['rects'])
 
-        if offsets[1] != 0:
-            # Read texture points
-            infile.seek(offsets[1], 0)
-            text_points = struct.unpack(">ffffffff", infile.read(0x20))
-            text_points = [x * texture_width * 2 for x in text_points]
-            text_points = list(zip(text_points[0::2], text_points[1::2]))
-            print("Texture rects", text_points)
+    if geo['texture_rects'] is not None:
+        print("Texture rects", geo['texture_rects'])
 
-        # Not sure what this is for
-        if offsets[4] != 0:
-            infile.seek(offsets[4], 0)
-            points2 = struct.unpack("<iii", infile.read(0x0c))
-            print("Unk", points2)
+    if geo['unk'] is not None:
+        print("Unk", geo['unk'])
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('input_geo', help='Input AFP file')
+    stats.add_arguments(parser)
     args = parser.parse_args()
 
-    parse_geo(args.input_geo)
+    with stats.session(args.stats, args.profile):
+        parse_geo(args.input_geo)
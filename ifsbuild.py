@@ -0,0 +1,247 @@
+import hashlib
+import struct
+import time
+
+import numpy as np
+from ifstools.handlers import lz77
+from ifstools.handlers.node import Node
+from kbinxml import KBinXML
+from lxml import etree
+
+import stats
+from dxt import encode_dxt5
+
+"""
+Builds an IFS file from memory, without a folder for ifstools to read back. Files are added as bytes by their path
+in the IFS, and textures as the canvases they're cut from. Everything is encoded up front, so the manifest's offsets
+and sizes are known before anything is written, and the file is written in one pass.
+
+The layout follows ifstools' repack: the manifest is binary XML with every folder and file in it, file data is 16
+byte aligned, and afp, bsi, geo and tex files are stored under the md5 of their names as listed in afplist.xml and
+texturelist.xml.
+"""
+
+IFS_SIGNATURE = 0x6CAD8F89
+
+# ManifestHasTimestamps | HasMD5
+IFS_FLAGS = 3
+
+# Signature, flags, inverted flags, timestamp, manifest memory size, end of manifest. The manifest's md5 follows.
+IFS_HEADER = ">IHHIII"
+
+# Encoding names are hashed in, same as the binary XML they're listed in.
+NAME_ENCODING = "cp932"
+
+
+class IfsBuildError(Exception):
+    pass
+
+
+def _hashed_name(name):
+    return hashlib.md5(name.encode(NAME_ENCODING)).hexdigest()
+
+
+def binary_xml(data):
+    if KBinXML.is_binary_xml(data):
+        return data
+    return KBinXML(data).to_binary()
+
+
+def encode_texture(pixels, texture_format, compress=None):
+    """
+    Encodes a (height, width, 4) RGBA array the way an IFS stores one texturelist image.
+    """
+    if texture_format == "argb8888rev":
+        data = np.ascontiguousarray(pixels[:, :, [2, 1, 0, 3]]).tobytes()
+    elif texture_format == "dxt5":
+        data = encode_dxt5(pixels, ifs_order=True)
+    else:
+        raise IfsBuildError("Can't encode %s textures" % texture_format)
+
+    if compress == "avslz":
+        compressed = lz77.compress(data)
+        data = struct.pack(">II", len(data), len(compressed)) + compressed
+
+    return data
+
+
+def get_packed_names(files):
+    """
+    Returns path -> name in the manifest for the files ifstools stores under a hash, given the {path: data} of an
+    IFS's files.
+    """
+    packed = {}
+
+    afplist = files.get("afp/afplist.xml")
+    if afplist is not None:
+        for afp in KBinXML(afplist).xml_doc.iter("afp"):
+            name = afp.attrib["name"]
+            packed["afp/%s" % name] = packed["afp/bsi/%s" % name] = _hashed_name(name)
+            for geo in afp.iter("geo"):
+                for shape in geo.text.split():
+                    shape_name = "%s_shape%s" % (name, shape)
+                    packed["geo/%s" % shape_name] = _hashed_name(shape_name)
+
+    texturelist = files.get("tex/texturelist.xml")
+    if texturelist is not None:
+        for image in KBinXML(texturelist).xml_doc.iter("image"):
+            packed["tex/%s.png" % image.attrib["name"]] = _hashed_name(image.attrib["name"])
+
+    return packed
+
+
+def read_ifs(filename):
+    """
+    Reads every file of an IFS into {path: data}, with the data as stored (binary XML, encoded textures) and hashed
+    names resolved back to their real names.
+    """
+    with open(filename, "rb") as infile:
+        data = infile.read()
+
+    header_size = struct.calcsize(IFS_HEADER)
+    if len(data) < header_size or struct.unpack_from(">I", data, 0)[0] != IFS_SIGNATURE:
+        raise IfsBuildError("%s is not an IFS file" % filename)
+
+    flags = struct.unpack_from(">H", data, 4)[0]
+    manifest_end = struct.unpack_from(">I", data, 16)[0]
+    manifest_start = header_size + (16 if flags & 2 else 0)
+    manifest = KBinXML(data[manifest_start:manifest_end]).xml_doc
+
+    files = {}
+    def walk(element, path):
+        for child in element.iterchildren(tag=etree.Element):
+            name = Node.fix_name(child.tag)
+            if name in ("_info_", "_super_"):
+                continue
+
+            child_path = path + "/" + name if path else name
+            values = (child.text or "").split()
+            if len(child) or len(values) < 2:
+                walk(child, child_path)
+            else:
+                offset, size = int(values[0]), int(values[1])
+                files[child_path] = data[manifest_end + offset:manifest_end + offset + size]
+    walk(manifest, "")
+
+    # Swap the hashed names for the real ones.
+    real_names = {}
+    for path, packed_name in get_packed_names(files).items():
+        real_names[path.rpartition("/")[0] + "/" + packed_name] = path
+    return {real_names.get(path, path): data for path, data in files.items()}
+
+
+class IfsBuilder(object):
+    """
+    An IFS being built in memory. Paths use / and are relative to the root of the IFS, e.g. "afp/bsi/00".
+    """
+    def __init__(self, timestamp=None):
+        self.timestamp = int(time.time()) if timestamp is None else timestamp
+        self.files = {}
+
+    def add_file(self, path, data):
+        # XML files are stored as binary XML.
+        if path.endswith(".xml"):
+            data = binary_xml(data)
+        self.files[path] = bytes(data)
+
+    def add_textures(self, texturelist_xml, canvases, encoded=None):
+        """
+        Adds tex/texturelist.xml and every image it lists. canvases is called with each texture's name and returns
+        its (height, width, 4) RGBA pixels, so only one canvas needs to be in memory at a time. Each image is cut
+        from its imgrect and encoded in its texture's format. encoded can map image names to data that's already
+        encoded, and canvases whose images are all in it are never built.
+        """
+        encoded = encoded or {}
+        texturelist = etree.fromstring(texturelist_xml)
+        compress = texturelist.attrib.get("compress")
+
+        for texture in texturelist.iterchildren("texture"):
+            pixels = None
+            for image in texture.iterchildren("image"):
+                name = image.attrib["name"]
+                if name in encoded:
+                    self.files["tex/%s.png" % name] = encoded[name]
+                    stats.count("textures_reused")
+                    continue
+
+                if pixels is None:
+                    with stats.timer("ifs_composite_canvas"):
+                        pixels = canvases(texture.attrib["name"])
+                left, right, top, bottom = [int(x) // 2 for x in image.find("imgrect").text.split()]
+                with stats.timer("ifs_encode_texture"):
+                    self.files["tex/%s.png" % name] = encode_texture(
+                        pixels[top:bottom, left:right], texture.attrib["format"], compress
+                    )
+                stats.count("textures_encoded")
+
+        self.add_file("tex/texturelist.xml", texturelist_xml)
+
+    def layout(self):
+        """
+        Returns the manifest and the (offset, data) of every file in the data section.
+        """
+        packed_names = get_packed_names(self.files)
+
+        manifest = etree.Element("imgfs")
+        info = etree.SubElement(manifest, "_info_")
+
+        folders = {"": manifest}
+        def folder(path):
+            element = folders.get(path)
+            if element is None:
+                parent, _, name = path.rpartition("/")
+                element = folders[path] = etree.SubElement(folder(parent), Node.sanitize_name(name))
+                element.attrib["__type"] = "s32"
+                element.text = str(self.timestamp)
+            return element
+
+        # Folders first, like ifstools, so readers see every folder before the files next to it.
+        for path in sorted(self.files):
+            folder(path.rpartition("/")[0])
+
+        chunks = []
+        offset = 0
+        data_md5 = hashlib.md5()
+        for path in sorted(self.files):
+            data = self.files[path]
+            parent, _, name = path.rpartition("/")
+
+            element = etree.SubElement(folder(parent), Node.sanitize_name(packed_names.get(path, name)))
+            element.attrib["__type"] = "3s32"
+            element.text = "%d %d %d" % (offset, len(data), self.timestamp)
+
+            padding = b"\0" * (-len(data) % 16)
+            chunks.append((offset, data + padding))
+            data_md5.update(data)
+            data_md5.update(padding)
+            offset += len(data) + len(padding)
+
+        md5 = etree.SubElement(info, "md5")
+        md5.attrib["__type"] = "bin"
+        md5.attrib["__size"] = "16"
+        md5.text = data_md5.hexdigest()
+
+        size = etree.SubElement(info, "size")
+        size.attrib["__type"] = "u32"
+        size.text = str(offset)
+
+        return KBinXML(manifest), chunks
+
+    def write(self, output_filename):
+        with stats.timer("ifs_repack"):
+            manifest, chunks = self.layout()
+            manifest_data = manifest.to_binary()
+
+            header_size = struct.calcsize(IFS_HEADER) + 16
+            header = struct.pack(
+                IFS_HEADER, IFS_SIGNATURE, IFS_FLAGS, IFS_FLAGS ^ 0xFFFF, self.timestamp, manifest.mem_size,
+                header_size + len(manifest_data)
+            ) + hashlib.md5(manifest_data).digest()
+
+            with open(output_filename, "wb") as outfile:
+                outfile.write(header)
+                outfile.write(manifest_data)
+                for _, data in chunks:
+                    outfile.write(data)
+
+            return header_size + len(manifest_data) + sum(len(data) for _, data in chunks)
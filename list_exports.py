@@ -0,0 +1,88 @@
+import argparse
+import struct
+
+from decode_afp import AfpDecodeError, AfpRangeReader, find_afp_files, find_bsi, run_in_pool
+
+"""
+Lists the movie name, exported assets, frame labels and funcnames of afp files straight from the obfuscated afp/bsi
+pairs. Only the header, exported tags, root TagsBaseHeader, labels and string table are decoded, so this only reads
+a few KB per file.
+"""
+
+def read_string(string_table, offset):
+    end = string_table.find(b'\0', offset)
+    return string_table[offset:end if end >= 0 else len(string_table)].decode('shift-jis', errors='replace')
+
+
+def read_exports(input_afp_filename, input_bsi_filename):
+    with AfpRangeReader(input_afp_filename, input_bsi_filename) as reader:
+        header = reader.read(0, 0x40)
+        name_offset, flags = struct.unpack_from("<HI", header, 0x0a)
+
+        # fps, then the bg color if flags & 0x1
+        attributes_offset = 0x1c + (4 if flags & 0x1 else 0)
+        num_exported_assets, imported_tags_count, tags_base_offset, exported_tags_offset, imported_tags_offset, \
+            string_table_offset, string_table_size = struct.unpack_from("<HhIIIII", header, attributes_offset)
+
+        string_table = reader.read(string_table_offset, string_table_offset + string_table_size)
+
+        exported_tags = reader.read(exported_tags_offset, exported_tags_offset + num_exported_assets * 4)
+        exports = [
+            (read_string(string_table, string_offset), tag_id)
+            for tag_id, string_offset in struct.iter_unpack("<HH", exported_tags)
+        ]
+
+        tags_base_header = reader.read(tags_base_offset, tags_base_offset + 0x1a)
+        name_reference_flags, frame_label_count, frame_count, tags_count, frame_labels_offset = \
+            struct.unpack_from("<HHIII", tags_base_header, 0)
+        funcname_count = struct.unpack_from("<H", tags_base_header, 0x18)[0] if name_reference_flags & 4 else 0
+
+        # Funcnames follow right after the frame labels.
+        labels_offset = tags_base_offset + frame_labels_offset
+        labels = [
+            (read_string(string_table, string_offset), frameno)
+            for frameno, string_offset in struct.iter_unpack("<HH", reader.read(labels_offset, labels_offset + (frame_label_count + funcname_count) * 4))
+        ]
+
+    return {
+        'name': read_string(string_table, name_offset),
+        'exports': exports,
+        'labels': labels[:frame_label_count],
+        'funcnames': labels[frame_label_count:],
+    }
+
+
+def _read_exports_file(afp_filename):
+    bsi_filename = find_bsi(afp_filename)
+    if bsi_filename is None:
+        return afp_filename, None, "Could not find BSI"
+
+    try:
+        return afp_filename, read_exports(afp_filename, bsi_filename), None
+    except (AfpDecodeError, OSError, struct.error, IndexError) as e:
+        return afp_filename, None, str(e)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('afp', help='Input AFP file, folder or glob pattern')
+    parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes. Defaults to the CPU count.")
+    args = parser.parse_args()
+
+    afp_filenames = find_afp_files(args.afp)
+    if not afp_filenames:
+        print("No afp files found in", args.afp)
+        exit(1)
+
+    for afp_filename, info, error in run_in_pool(_read_exports_file, [(x,) for x in afp_filenames], args.jobs):
+        if error is not None:
+            print("Failed to read %s: %s" % (afp_filename, error))
+            continue
+
+        print("%s: \"%s\"" % (afp_filename, info['name']))
+        for name, tag_id in info['exports']:
+            print("  export \"%s\" id:%d" % (name, tag_id))
+        for name, frameno in info['labels']:
+            print("  label \"%s\" frame %d" % (name, frameno))
+        for name, frameno in info['funcnames']:
+            print("  funcname \"%s\" frame %d" % (name, frameno))
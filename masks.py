@@ -0,0 +1,259 @@
+import argparse
+import time
+
+import numpy as np
+
+from afpreader import AfpFile
+from playback import Playback
+
+"""
+Builds the geometry of vector masks (flags2 & 0x8 and the mask part of flags2 & 0x40), see VECTOR_MASK.md.
+Every slot is a closed path. Bezier segments are flattened with a subdivision count picked per segment from its
+curvature, and each path is fan triangulated into 3*(n-2) indices like the game does. All the masks given to
+MaskGeometryBuilder.build are decoded and flattened together in one NumPy pass, and the results are cached by
+payload since wipes repeat the same shapes over many frames.
+
+Tangent handles are assumed to be relative to their anchor, like After Effects mask paths.
+"""
+
+# Most subdivisions a single bezier segment is flattened into.
+MAX_SUBDIVISIONS = 64
+
+
+class MaskGeometry(object):
+    """
+    Flattened and triangulated slots of one vector mask. points is an (n, 2) array in pixels, and the points of
+    slot slots[i] are points[offsets[i]:offsets[i+1]]. triangles is an (n, 3) array of indices into points.
+    """
+    __slots__ = ('slots', 'offsets', 'points', 'triangles')
+
+    def __init__(self, slots, offsets, points, triangles):
+        self.slots = slots
+        self.offsets = offsets
+        self.points = points
+        self.triangles = triangles
+
+    def __repr__(self):
+        return "<%s slots:%d points:%d triangles:%d>" % (
+            self.__class__.__name__, len(self.slots), len(self.points), len(self.triangles)
+        )
+
+    @property
+    def bbox(self):
+        if not len(self.points):
+            return None
+        return self.points.min(axis=0), self.points.max(axis=0)
+
+
+def decode_slots(mask):
+    """
+    Decodes every slot of a VectorMask into (slot index, anchors, tangents in, tangents out), as (n, 2) arrays in
+    pixels. Straight slots get zero tangents.
+    """
+    slots = []
+    data = memoryview(mask.data)
+    offset = 0
+
+    for slot in range(32):
+        if not mask.bitmask & (1 << slot):
+            continue
+
+        vertex_flags, vertex_count = np.frombuffer(data, dtype='<u2', count=2, offset=offset)
+        offset += 4
+
+        stride = 6 if vertex_flags & 0x10 else 2
+        dtype = '<i4' if vertex_flags & 0x1 else '<i2'
+        coords = np.frombuffer(data, dtype=dtype, count=int(vertex_count) * stride, offset=offset)
+        offset += coords.nbytes
+
+        coords = coords.reshape(-1, stride) / 20.0
+        if stride == 6:
+            slots.append((slot, coords[:, 0:2], coords[:, 2:4], coords[:, 4:6]))
+        else:
+            zeros = np.zeros_like(coords)
+            slots.append((slot, coords, zeros, zeros))
+
+    return slots
+
+
+def flatten_segments(p0, p1, p2, p3, tolerance):
+    """
+    Flattens cubic beziers given as (n, 2) arrays of control points. Each segment is split into enough pieces to
+    stay within tolerance of the curve. Returns the points, without each segment's end point, and the number of
+    points each segment produced.
+    """
+    # The largest second difference of the control points bounds how far the curve strays from a line, and the
+    # error of n equal pieces shrinks with n squared.
+    deviation = np.maximum(
+        np.linalg.norm(p0 - 2 * p1 + p2, axis=1),
+        np.linalg.norm(p1 - 2 * p2 + p3, axis=1),
+    )
+    counts = np.ceil(np.sqrt(deviation * 0.75 / tolerance)).astype(np.int64)
+    counts = np.clip(counts, 1, MAX_SUBDIVISIONS)
+
+    # Segments without tangent handles are straight lines, however far apart their anchors are.
+    counts[np.all(p1 == p0, axis=1) & np.all(p2 == p3, axis=1)] = 1
+
+    segment = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    t = ((np.arange(counts.sum()) - starts[segment]) / counts[segment])[:, None]
+    mt = 1.0 - t
+
+    points = (
+        mt * mt * mt * p0[segment] +
+        3.0 * mt * mt * t * p1[segment] +
+        3.0 * mt * t * t * p2[segment] +
+        t * t * t * p3[segment]
+    )
+    return points, counts
+
+
+def fan_triangles(offsets):
+    """
+    Triangle indices fanning out from the first point of every path, given the start offsets of the paths and the
+    total point count as the last offset. Paths with fewer than 3 points get no triangles.
+    """
+    sizes = np.diff(offsets)
+    triangle_counts = np.maximum(sizes - 2, 0)
+    path = np.repeat(np.arange(len(sizes)), triangle_counts)
+    first = offsets[:-1][path]
+    step = np.arange(triangle_counts.sum()) - (np.cumsum(triangle_counts) - triangle_counts)[path]
+
+    return np.stack([first, first + step + 1, first + step + 2], axis=1).astype(np.int32)
+
+
+class MaskGeometryBuilder(object):
+    """
+    Builds and caches MaskGeometry. tolerance is the largest distance in pixels allowed between a curve and the
+    lines it's flattened into.
+    """
+    def __init__(self, tolerance=0.25):
+        self.tolerance = tolerance
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(mask):
+        return mask.bitmask, bytes(mask.data)
+
+    def build(self, masks):
+        """
+        Returns the MaskGeometry of each VectorMask in masks. Identical masks share one MaskGeometry.
+        """
+        keys = [self._key(mask) for mask in masks]
+
+        pending = {}
+        for key, mask in zip(keys, masks):
+            if key in self.cache:
+                self.hits += 1
+            elif key not in pending:
+                self.misses += 1
+                pending[key] = mask
+            else:
+                self.hits += 1
+
+        if pending:
+            self._build_pending(pending)
+
+        return [self.cache[key] for key in keys]
+
+    def _build_pending(self, pending):
+        # Every segment of every path of every pending mask, in order. A path's last segment closes it back to its
+        # first anchor.
+        p0, p1, p2, p3 = [], [], [], []
+        path_segments = []
+        mask_paths = []
+
+        for key, mask in pending.items():
+            slot_indices = []
+            for slot, anchors, tangents_in, tangents_out in decode_slots(mask):
+                slot_indices.append(slot)
+                path_segments.append(len(anchors))
+                if not len(anchors):
+                    continue
+
+                next_anchors = np.roll(anchors, -1, axis=0)
+                p0.append(anchors)
+                p1.append(anchors + tangents_out)
+                p2.append(next_anchors + np.roll(tangents_in, -1, axis=0))
+                p3.append(next_anchors)
+
+            mask_paths.append((key, slot_indices))
+
+        if p0:
+            points, counts = flatten_segments(
+                np.concatenate(p0), np.concatenate(p1), np.concatenate(p2), np.concatenate(p3), self.tolerance
+            )
+        else:
+            points, counts = np.zeros((0, 2)), np.zeros(0, dtype=np.int64)
+
+        # Points produced by each path, and where each path starts in points.
+        segment_offsets = np.concatenate([[0], np.cumsum(path_segments)])
+        count_sums = np.concatenate([[0], np.cumsum(counts)])
+        path_offsets = count_sums[segment_offsets]
+        triangles = fan_triangles(path_offsets)
+        path_triangles = np.concatenate([[0], np.cumsum(np.maximum(np.diff(path_offsets) - 2, 0))])
+
+        points = points.astype(np.float32)
+        path = 0
+        for key, slot_indices in mask_paths:
+            first, last = path, path + len(slot_indices)
+            point_start = path_offsets[first]
+            self.cache[key] = MaskGeometry(
+                slot_indices,
+                path_offsets[first:last + 1] - point_start,
+                points[point_start:path_offsets[last]],
+                triangles[path_triangles[first]:path_triangles[last]] - point_start,
+            )
+            path = last
+
+
+def slot_colors(colored_mask):
+    """
+    RGBA colors, 0.0-1.0, of every slot of a ColoredVectorMask's mask, looked up in its palette. None if it has no
+    palette.
+    """
+    if colored_mask.mask is None or colored_mask.palette is None:
+        return None
+
+    palette = np.array(colored_mask.palette, dtype='<u4').view(np.uint8).reshape(-1, 4) / 255.0
+    slot_count = bin(colored_mask.mask.bitmask).count("1")
+    if colored_mask.color_indices is None:
+        # Without per slot indices, every slot uses the first entry.
+        indices = np.zeros(slot_count, dtype=np.int64)
+    else:
+        indices = np.frombuffer(colored_mask.color_indices, dtype=np.uint8).astype(np.int64)
+
+    return palette[np.minimum(indices, len(palette) - 1)]
+
+
+def collect_masks(states):
+    # Every vector mask on the display lists of a list of ClipStates.
+    masks = []
+    for state in states:
+        for _, placement in state.walk():
+            if placement.vector_mask is not None:
+                masks.append(placement.vector_mask)
+            if placement.colored_vector_mask is not None and placement.colored_vector_mask.mask is not None:
+                masks.append(placement.colored_vector_mask.mask)
+    return masks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_afp', help='Input decoded AFP file')
+    parser.add_argument('-tolerance', type=float, default=0.25, help='Flattening tolerance in pixels')
+    args = parser.parse_args()
+
+    playback = Playback(AfpFile.from_file(args.input_afp))
+    masks = collect_masks(playback.play(playback.frame_count))
+
+    start_time = time.perf_counter()
+    builder = MaskGeometryBuilder(args.tolerance)
+    geometry = builder.build(masks)
+    elapsed = time.perf_counter() - start_time
+
+    print("%d masks over %d frames, %d unique, built in %.3fs" % (len(masks), playback.frame_count, builder.misses, elapsed))
+    for mask_geometry in builder.cache.values():
+        print(" ", mask_geometry, mask_geometry.bbox)
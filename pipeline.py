@@ -0,0 +1,464 @@
+import argparse
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+from afpindex import AfpIndex, PARSE_ERRORS, default_database_filename, find_ifs_folders, parse_rows, read_file, scan_dump
+from decode_afp import AfpDecodeError, decode_afp_data, is_up_to_date
+
+"""
+Runs a dump through read -> decode -> (write) -> parse -> index as one streaming pipeline, instead of decoding
+everything to disk and reading it all back for each tool. Every stage runs at the same time: reading and writing
+happen on threads, decoding and parsing on a process pool, and the stages are connected by bounded queues, so a
+slow stage holds back the ones before it and memory stays flat no matter how big the dump is. Each file is read
+once and its buffer is handed from stage to stage.
+
+The index (afpindex.py) is the checkpoint. It commits every 1000 files (afpindex.COMMIT_EVERY), and files it already
+has at the same mtime and size are never read again, so an interrupted run loses at most the files since the last
+commit.
+"""
+
+# How many items can wait in front of each stage.
+QUEUE_SIZE = 16
+
+# Most items of a dump are small geo files, so process stages send them to the pool in batches.
+PROCESS_BATCH = 16
+
+# Stop marker passed down the queues once the source runs out.
+_DONE = object()
+
+
+class Stage(object):
+    """
+    One step of a Pipeline. func takes an item and returns the item to pass on, or None to drop it. Thread stages
+    run func on workers threads. Process stages run it on the pipeline's process pool, so func and the items must
+    pickle; accepts can pick out the items that need the pool, the rest skip straight past. Up to batch items that
+    are ready together go to the pool as one task, which saves a round trip per item on small files. close is
+    called once the stage has seen every item.
+    """
+    def __init__(self, name, func, kind="thread", workers=1, accepts=None, close=None, batch=1):
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.workers = workers
+        self.accepts = accepts
+        self.close = close
+        self.batch = batch
+
+        self.inbox = queue.Queue(QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.depth_samples = 0
+
+    def record(self, item, elapsed):
+        with self.lock:
+            self.items += 1
+            self.bytes += getattr(item, "size", 0)
+            self.busy += elapsed
+
+    def sample_depth(self):
+        depth = self.inbox.qsize()
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+        self.depth_samples += 1
+
+
+def _timed_batch(func, items):
+    results = []
+    for item in items:
+        start_time = time.perf_counter()
+        result = func(item)
+        results.append((result, time.perf_counter() - start_time))
+    return results
+
+
+class Pipeline(object):
+    def __init__(self, stages, jobs=None):
+        self.stages = stages
+        self.jobs = jobs or os.cpu_count()
+        self.outbox = queue.Queue()
+        self.stopped = threading.Event()
+        self.errors = []
+        self.elapsed = 0.0
+
+    def _get(self, inbox, block=True):
+        # The next item, _DONE once the pipeline is stopped, or None when block is False and nothing is waiting.
+        while not self.stopped.is_set():
+            try:
+                return inbox.get(timeout=0.1) if block else inbox.get_nowait()
+            except queue.Empty:
+                if not block:
+                    return None
+        return _DONE
+
+    def _put(self, outbox, item):
+        # Blocks while the next stage is full. That's the backpressure.
+        while not self.stopped.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _fail(self, stage, item, e):
+        self.errors.append((stage.name, getattr(item, "path", None), "%s: %s" % (e.__class__.__name__, e)))
+
+    def _run_thread(self, stage, outbox, finished):
+        while True:
+            item = self._get(stage.inbox)
+            if item is _DONE:
+                # Let the other workers of this stage see it too. Once stopped they see it anyway.
+                if not self.stopped.is_set():
+                    stage.inbox.put(_DONE)
+                break
+
+            start_time = time.perf_counter()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                self._fail(stage, item, e)
+                result = None
+            stage.record(item, time.perf_counter() - start_time)
+
+            if result is not None:
+                self._put(outbox, result)
+
+        # The last worker out passes the stop marker on.
+        with stage.lock:
+            finished[0] += 1
+            last = finished[0] == stage.workers
+        if last:
+            self._finish(stage, outbox)
+
+    def _run_process(self, stage, outbox, executor):
+        # Keeps a couple of tasks per process in flight, and passes results on in the order they finish.
+        max_pending = self.jobs * 2
+        pending = {}
+        batch = []
+        source_done = False
+
+        while pending or batch or not source_done:
+            while not source_done and len(pending) < max_pending:
+                # Only wait for items when there's nothing else to do.
+                item = self._get(stage.inbox, block=not pending and not batch)
+                if item is _DONE:
+                    source_done = True
+                elif item is not None:
+                    if stage.accepts is not None and not stage.accepts(item):
+                        self._put(outbox, item)
+                        continue
+                    batch.append(item)
+                    if len(batch) < stage.batch:
+                        continue
+
+                if not batch:
+                    break
+                try:
+                    pending[executor.submit(_timed_batch, stage.func, batch)] = batch
+                except RuntimeError:
+                    # The pool was shut down by Ctrl+C.
+                    source_done = True
+                batch = []
+
+            if not pending:
+                continue
+
+            done, _ = concurrent.futures.wait(pending, timeout=0.05, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                items = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    if not self.stopped.is_set():
+                        for item in items:
+                            self._fail(stage, item, e)
+                    continue
+                for result, elapsed in results:
+                    stage.record(result, elapsed)
+                    if result is not None:
+                        self._put(outbox, result)
+
+        self._finish(stage, outbox)
+
+    def _finish(self, stage, outbox):
+        if stage.close is not None:
+            try:
+                stage.close()
+            except Exception as e:
+                self._fail(stage, None, e)
+        self._put(outbox, _DONE)
+
+    def _monitor(self, progress_interval):
+        last_report = time.perf_counter()
+        while not self.stopped.wait(0.1):
+            for stage in self.stages:
+                stage.sample_depth()
+            if progress_interval and time.perf_counter() - last_report >= progress_interval:
+                last_report = time.perf_counter()
+                print("  ".join("%s:%d q:%d" % (stage.name, stage.items, stage.inbox.qsize()) for stage in self.stages))
+
+    def run(self, source, progress_interval=None):
+        """
+        Feeds every item of source through the stages and waits until the last one is done. Returns False if the
+        run was stopped early with Ctrl+C.
+        """
+        start_time = time.perf_counter()
+        threads = []
+        monitor = None
+        interrupted = False
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            try:
+                for i, stage in enumerate(self.stages):
+                    outbox = self.stages[i + 1].inbox if i + 1 < len(self.stages) else self.outbox
+                    if stage.kind == "process":
+                        threads.append(threading.Thread(target=self._run_process, args=(stage, outbox, executor), daemon=True))
+                    else:
+                        finished = [0]
+                        threads += [
+                            threading.Thread(target=self._run_thread, args=(stage, outbox, finished), daemon=True)
+                            for _ in range(stage.workers)
+                        ]
+                for thread in threads:
+                    thread.start()
+
+                monitor = threading.Thread(target=self._monitor, args=(progress_interval,), daemon=True)
+                monitor.start()
+
+                first = self.stages[0].inbox
+                for item in source:
+                    if self.stopped.is_set():
+                        break
+                    self._put(first, item)
+                self._put(first, _DONE)
+
+                while self.outbox.get() is not _DONE:
+                    pass
+
+            except KeyboardInterrupt:
+                # Stages drop what they're holding, but each one still closes, so the last can commit its work.
+                interrupted = True
+                self.stopped.set()
+                executor.shutdown(cancel_futures=True)
+
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            if monitor is not None:
+                monitor.join()
+
+        self.elapsed = time.perf_counter() - start_time
+        return not interrupted
+
+    def report(self):
+        """
+        Per stage: items, MB, seconds spent working (summed across workers), what that works out to per second of
+        work, and the average and peak queue depth in front of it. A stage whose queue stays full is the bottleneck.
+        """
+        print("%-8s %8s %10s %10s %12s %10s %10s" % ("stage", "items", "MB", "busy s", "items/busy s", "avg queue", "max queue"))
+        for stage in self.stages:
+            print("%-8s %8d %10.2f %10.2f %12.1f %10.1f %10d" % (
+                stage.name, stage.items, stage.bytes / 1024 / 1024, stage.busy, stage.items / max(stage.busy, 1e-9),
+                stage.depth_total / max(stage.depth_samples, 1), stage.depth_max
+            ))
+
+        items = self.stages[-1].items if self.stages else 0
+        print("%d items in %.2fs wall: %.1f items/sec" % (items, self.elapsed, items / max(self.elapsed, 1e-9)))
+
+
+class DumpItem(object):
+    """
+    One file of a dump on its way through the pipeline. data is dropped once nothing further down needs it.
+    """
+    __slots__ = (
+        'path', 'archive', 'kind', 'bsi_filename', 'mtime', 'size', 'known_sha1', 'sha1', 'data', 'bsi_data',
+        'rows', 'error',
+    )
+
+    def __init__(self, path, archive, kind, bsi_filename, mtime, size, known_sha1=None):
+        self.path = path
+        self.archive = archive
+        self.kind = kind
+        self.bsi_filename = bsi_filename
+        self.mtime = mtime
+        self.size = size
+        self.known_sha1 = known_sha1
+        self.sha1 = None
+        self.data = None
+        self.bsi_data = None
+        self.rows = {}
+        self.error = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+def read_stage(item):
+    try:
+        item.data, item.bsi_data, item.sha1 = read_file(item.path, item.bsi_filename)
+    except OSError as e:
+        item.error = str(e)
+        return item
+
+    if item.sha1 == item.known_sha1:
+        # Touched but not changed, so there's nothing to parse.
+        item.data = item.bsi_data = item.rows = None
+    return item
+
+
+def decode_stage(item):
+    try:
+        decode_afp_data(item.data, item.bsi_data)
+    except AfpDecodeError as e:
+        item.error = str(e)
+        item.data = None
+    item.bsi_data = None
+    return item
+
+
+def parse_stage(item):
+    try:
+        item.rows = parse_rows(item.path, item.kind, item.data)
+    except PARSE_ERRORS as e:
+        item.error = str(e)
+    item.data = None
+    return item
+
+
+def _needs_decoding(item):
+    return item.error is None and item.bsi_data is not None
+
+
+def _needs_parsing(item):
+    return item.error is None and item.data is not None
+
+
+class DecodedWriter(object):
+    """
+    Writes decoded afps to output_folder/<archive>/<movie>, like decode_afp.py does for a batch.
+    """
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+
+    def output_filename(self, path, archive):
+        return os.path.join(self.output_folder, archive, os.path.basename(path))
+
+    def is_up_to_date(self, path, archive, bsi_filename):
+        return is_up_to_date(self.output_filename(path, archive), path, *([bsi_filename] if bsi_filename else []))
+
+    def __call__(self, item):
+        if item.kind == "afp" and item.data is not None and item.error is None:
+            output_filename = self.output_filename(item.path, item.archive)
+            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+            with open(output_filename, "wb") as outfile:
+                outfile.write(item.data)
+        return item
+
+
+class IndexWriter(object):
+    """
+    The last stage: writes each file's rows into the index. It's the only stage that touches the database.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.index.begin()
+        self.parsed = 0
+        self.unchanged = 0
+        self.errors = []
+
+    def __call__(self, item):
+        self.index.write_file(item.path, item.archive, item.kind, item.mtime, item.size, item.sha1, item.rows, item.error)
+        if item.rows is None:
+            self.unchanged += 1
+        elif item.error is not None:
+            self.errors.append((item.path, item.error))
+        else:
+            self.parsed += 1
+        return None
+
+    def close(self):
+        self.index.commit()
+
+
+def dump_pipeline(index, decoded_writer=None, io_threads=2, jobs=None):
+    writer = IndexWriter(index)
+    stages = [
+        Stage("read", read_stage, workers=io_threads),
+        Stage("decode", decode_stage, "process", accepts=_needs_decoding, batch=PROCESS_BATCH),
+    ]
+    if decoded_writer is not None:
+        stages.append(Stage("write", decoded_writer, workers=io_threads))
+    stages += [
+        Stage("parse", parse_stage, "process", accepts=_needs_parsing, batch=PROCESS_BATCH),
+        Stage("index", writer, close=writer.close),
+    ]
+    return Pipeline(stages, jobs), writer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dump', help='Extracted dump folder of *_ifs folders, one IFS folder or a glob pattern of them')
+    parser.add_argument('-db', default=default_database_filename(), help="Index database filename, see afpindex.py. Defaults to afpindex.db")
+    parser.add_argument('-output', help='Also write the decoded afps to this folder, under their IFS folder names')
+    parser.add_argument('-rebuild', action='store_true', help="Process every file again instead of resuming/updating")
+    parser.add_argument('-io-threads', type=int, default=2, help="Threads for reading and writing files")
+    parser.add_argument('-progress', type=float, default=5.0, help="Seconds between progress lines, 0 for none")
+    parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes. Defaults to the CPU count.")
+    args = parser.parse_args()
+
+    ifs_folders = find_ifs_folders(args.dump)
+    if not ifs_folders:
+        print("No IFS folders found in", args.dump)
+        exit(1)
+
+    index = AfpIndex(args.db)
+    index.load_known()
+
+    decoded_writer = DecodedWriter(args.output) if args.output is not None else None
+
+    scanned = set()
+    skipped = [0]
+    def source():
+        for path, archive, kind, bsi_filename, mtime, size in scan_dump(ifs_folders):
+            scanned.add(path)
+
+            # An afp whose decoded copy is missing or stale has to go through even if the index is current.
+            needs_output = decoded_writer is not None and kind == "afp" and not decoded_writer.is_up_to_date(path, archive, bsi_filename)
+            if not args.rebuild and not needs_output and index.is_current(path, mtime, size):
+                skipped[0] += 1
+                continue
+            yield DumpItem(path, archive, kind, bsi_filename, mtime, size, None if args.rebuild or needs_output else index.known_sha1(path))
+
+    pipeline, writer = dump_pipeline(index, decoded_writer, args.io_threads, args.jobs)
+    completed = pipeline.run(source(), args.progress)
+
+    removed = 0
+    if completed:
+        index.begin()
+        removed = index.remove_missing(scanned)
+        index.commit()
+
+    for path, error in writer.errors:
+        print("Failed to index %s: %s" % (path, error))
+    for stage_name, path, error in pipeline.errors:
+        print("%s failed on %s: %s" % (stage_name, path, error))
+
+    pipeline.report()
+    print("Indexed %d files (%d up to date, %d unchanged, %d removed, %d failed)" % (
+        writer.parsed, skipped[0], writer.unchanged, removed, len(writer.errors) + len(pipeline.errors)
+    ))
+    if not completed:
+        print("Interrupted. Everything up to the last commit is kept, run again to resume.")
+
+    index.close()
+    exit(0 if completed and not writer.errors and not pipeline.errors else 1)
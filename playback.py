@@ -0,0 +1,277 @@
+import argparse
+import collections
+
+from afpreader import AP2_DEFINE_SPRITE, AP2_IMAGE, AP2_PLACE_OBJECT, AP2_REMOVE_OBJECT, AP2_SHAPE, AfpFile, PlaceObjectTag
+
+"""
+Plays the frames of an afp file and keeps track of the display list, as described in the Playback section of
+AFP_FORMAT.MD. Every frame's display list is an immutable ClipState, so keyframe snapshots are just references to
+old states and seeking never replays more than one snapshot interval. Frames that don't change a clip's display list
+share it with the frame before. DoAction bytecode is not interpreted, so movies always loop.
+
+Sprites play one frame of their own for every frame of their parent, and keep playing when their parent loops as long
+as it places the same character at the same depth again. What a sprite shows depends on how many frames have been
+played in total (the tick), not just on the root's frame number, so snapshots are kept by tick.
+"""
+
+# Everything a place object can set on a placed object. An update only replaces the fields it has.
+PLACEMENT_FIELDS = [
+    name for name in PlaceObjectTag.__slots__ if name not in ('flags1', 'flags2', 'depth', 'name_offset')
+]
+
+# One object on the display list. perspective is flags1 & 0x4000000 of the last place object for it, definition is
+# the tag index of the shape, image or sprite that src_tag_id refers to (None if it's imported or unknown), and
+# child is the ClipState of a placed sprite.
+Placement = collections.namedtuple('Placement', ['depth'] + PLACEMENT_FIELDS + ['perspective', 'definition', 'child'])
+EMPTY_PLACEMENT = Placement(*([None] * len(Placement._fields)))
+
+
+class ClipState(object):
+    """
+    The display list of a clip after playing a frame. Never modified once built.
+    """
+    __slots__ = ('clip', 'frame', 'display_list')
+
+    def __init__(self, clip, frame, display_list):
+        self.clip = clip
+        self.frame = frame
+        self.display_list = display_list
+
+    def __repr__(self):
+        return "<%s %r frame:%d objects:%d>" % (self.__class__.__name__, self.clip, self.frame, len(self.display_list))
+
+    def walk(self, nesting=0):
+        # (nesting level, placement) for every placed object in depth order, with each sprite followed by its children.
+        for depth in sorted(self.display_list):
+            placement = self.display_list[depth]
+            yield nesting, placement
+            if placement.child is not None:
+                yield from placement.child.walk(nesting + 1)
+
+
+class Playback(object):
+    """
+    Plays the root clip of an afp. A snapshot of the display list is kept every snapshot_interval frames. When there
+    would be more than max_snapshots of them, the interval is doubled and every other snapshot is dropped.
+    """
+    def __init__(self, afp, snapshot_interval=30, max_snapshots=256):
+        self.afp = afp
+        self.snapshot_interval = max(1, snapshot_interval)
+        self.max_snapshots = max(1, max_snapshots)
+        self.snapshots = {}
+
+        # Parsed place objects and the frame list of each clip, since looping plays them over and over.
+        self._place_objects = {}
+        self._frames = {}
+
+        # Character id -> tag index of its definition
+        self.definitions = {}
+        for index in range(len(afp)):
+            if afp.tag_types[index] in (AP2_SHAPE, AP2_IMAGE, AP2_DEFINE_SPRITE):
+                self.definitions[afp.parse_tag(index).id] = index
+
+        # Frames played since the start, 0 on the first one.
+        self.tick = -1
+        self.state = self._initial_state(afp.root)
+
+    @property
+    def frame(self):
+        return self.state.frame
+
+    @property
+    def frame_count(self):
+        return self.afp.root.frame_count
+
+    @property
+    def display_list(self):
+        return self.state.display_list
+
+    def _initial_state(self, clip):
+        # The state before the first frame has been played.
+        return ClipState(clip, -1, {})
+
+    def _clip_frames(self, clip):
+        frames = self._frames.get(id(clip))
+        if frames is None:
+            frames = self._frames[id(clip)] = clip.frames
+        return frames
+
+    def _place_object(self, index):
+        tag = self._place_objects.get(index)
+        if tag is None:
+            tag = self._place_objects[index] = self.afp.parse_tag(index)
+        return tag
+
+    def _new_placement(self, tag):
+        definition = self.definitions.get(tag.src_tag_id)
+        child = None
+        if definition is not None and self.afp.tag_types[definition] == AP2_DEFINE_SPRITE:
+            child = self._initial_state(self.afp.clips[self.afp.sprite_clips[definition]])
+
+        return EMPTY_PLACEMENT._replace(depth=tag.depth, definition=definition, child=child)
+
+    def _apply_place_object(self, display_list, tag):
+        placement = display_list.get(tag.depth)
+
+        if not tag.update or placement is None:
+            placement = self._new_placement(tag)
+        elif tag.src_tag_id is not None and tag.src_tag_id != placement.src_tag_id:
+            # An update that swaps out the character keeps the transforms, but starts the new character from scratch.
+            replacement = self._new_placement(tag)
+            placement = placement._replace(definition=replacement.definition, child=replacement.child)
+
+        changes = {'perspective': bool(tag.flags1 & 0x4000000)}
+        for name in PLACEMENT_FIELDS:
+            value = getattr(tag, name)
+            if value is not None:
+                changes[name] = value
+        if tag.reset_rot_origin:
+            changes.update(rot_origin_x=0.0, rot_origin_y=0.0, rot_origin_z=0.0)
+
+        display_list[tag.depth] = placement._replace(**changes)
+
+    def _advance(self, state):
+        clip = state.clip
+        frames = self._clip_frames(clip)
+        if not frames:
+            return state
+
+        frame = state.frame + 1
+        if frame >= len(frames):
+            frame = 0
+
+        # The previous frame's display list is shared, and only copied once something on it changes.
+        display_list = state.display_list
+        copied = False
+
+        # A clip with one frame plays it again from an empty display list every time, which places what's already
+        # there, so only its sprites need to move on.
+        if frame != state.frame:
+            # Looping back to the start plays the first frame from an empty display list, so a frame places the same
+            # objects no matter how it was reached.
+            if frame == 0 and display_list:
+                display_list, copied = {}, True
+
+            start, count = frames[frame]
+            first = clip.first_tag + start
+            for index in range(first, min(first + count, clip.first_tag + clip.tags_count)):
+                tag_type = self.afp.tag_types[index]
+                if tag_type != AP2_PLACE_OBJECT and tag_type != AP2_REMOVE_OBJECT:
+                    continue
+
+                if not copied:
+                    display_list, copied = dict(display_list), True
+                if tag_type == AP2_PLACE_OBJECT:
+                    self._apply_place_object(display_list, self._place_object(index))
+                else:
+                    display_list.pop(self.afp.parse_tag(index).depth, None)
+
+            # Sprites placed again at the same depth after a loop keep playing instead of starting over.
+            if frame == 0 and state.display_list:
+                for depth, placement in display_list.items():
+                    previous = state.display_list.get(depth)
+                    if (placement.child is not None and previous is not None and previous.child is not None and
+                            previous.definition == placement.definition):
+                        display_list[depth] = placement._replace(child=previous.child)
+
+        # Sprites play one frame of their own for every frame of their parent, starting with the one they're placed on.
+        children = [
+            (depth, placement, self._advance(placement.child))
+            for depth, placement in display_list.items() if placement.child is not None
+        ]
+        for depth, placement, child in children:
+            if child is not placement.child:
+                if not copied:
+                    display_list, copied = dict(display_list), True
+                display_list[depth] = placement._replace(child=child)
+
+        if not copied and frame == state.frame:
+            return state
+        return ClipState(clip, frame, display_list)
+
+    def _snapshot(self):
+        if self.tick % self.snapshot_interval != 0:
+            return
+
+        self.snapshots[self.tick] = self.state
+        if len(self.snapshots) > self.max_snapshots:
+            self.snapshot_interval *= 2
+            self.snapshots = {
+                tick: state for tick, state in self.snapshots.items() if tick % self.snapshot_interval == 0
+            }
+
+    def next_frame(self):
+        self.state = self._advance(self.state)
+        self.tick += 1
+        self._snapshot()
+        return self.state
+
+    def play(self, count):
+        for _ in range(count):
+            yield self.next_frame()
+
+    def label_frame(self, label):
+        for name, frameno in self.afp.root.labels:
+            if name == label:
+                return frameno
+        raise KeyError("Unknown label \"%s\"" % label)
+
+    def seek(self, frame):
+        """
+        Jumps to a frame number or label as it is the first time it's played, restoring the nearest snapshot before
+        it and playing forward from there.
+        """
+        if isinstance(frame, str):
+            frame = self.label_frame(frame)
+
+        if not 0 <= frame < self.frame_count:
+            raise ValueError("Frame %d is out of range, the movie has %d frames" % (frame, self.frame_count))
+
+        return self.seek_tick(frame)
+
+    def seek_tick(self, tick):
+        # Like seek, to the state after tick + 1 frames have been played, which can be past the first loop.
+        if tick < 0:
+            raise ValueError("Tick %d is out of range" % tick)
+
+        if self.tick > tick:
+            self.tick, self.state = -1, self._initial_state(self.afp.root)
+
+        snapshot_ticks = [x for x in self.snapshots if self.tick < x <= tick]
+        if snapshot_ticks:
+            self.tick = max(snapshot_ticks)
+            self.state = self.snapshots[self.tick]
+
+        while self.tick < tick:
+            self.next_frame()
+
+        return self.state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_afp', help='Input decoded AFP file')
+    parser.add_argument('-seek', help='Frame number or label to show the display list of. Defaults to the first frame.')
+    parser.add_argument('-interval', type=int, default=30, help='Frames between display list snapshots')
+    args = parser.parse_args()
+
+    afp = AfpFile.from_file(args.input_afp)
+    playback = Playback(afp, args.interval)
+
+    target = 0
+    if args.seek is not None:
+        target = int(args.seek) if args.seek.isdigit() else args.seek
+
+    try:
+        state = playback.seek(target)
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
+        exit(1)
+
+    print("Frame %d of %d" % (state.frame, playback.frame_count))
+    for nesting, placement in state.walk():
+        source = afp.tag(placement.definition).name if placement.definition is not None else "unknown"
+        print("%sdepth:%d id:%s %s frame:%s" % (
+            "  " * nesting, placement.depth, placement.src_tag_id, source,
+            placement.child.frame if placement.child is not None else "-"
+        ))
@@ -0,0 +1,380 @@
+import argparse
+import glob
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from afpreader import AP2_SHAPE, AfpFile, AfpParseError
+from compositor import canvas_jobs_from_texturelist, composite_canvas
+from decode_afp import AfpDecodeError, decode_afp_data, find_afp_files, find_bsi, run_in_pool
+from geoindex import read_geo_file
+from georeader import GeoParseError
+from playback import Playback
+from transforms import evaluate_frames
+
+"""
+Renders the frames of the movies in an extracted IFS folder (afp, afp/bsi, geo and tex with its texturelist.xml) on
+the CPU, to a folder of PNGs or a GIF per movie. Every shape with a texture is drawn as a quad cut from its atlas,
+using the world matrix, mult/add colors and blend mode transforms.py evaluates for it. Shapes without a texture
+(solid color rects) and vector masks aren't drawn, and 3D placements use their 2D part only.
+
+The atlases of a folder are composited once and copied into one shared memory block, and frames are rendered in
+ranges across a process pool, with every worker reading the atlases from that block instead of its own copy. Each
+movie is played and its transforms evaluated once, front to back, and every range is sent with its evaluated rows.
+"""
+
+# Blend modes, as in SWF. 0, 1 and anything not listed here are drawn as normal.
+BLEND_MULTIPLY = 3
+BLEND_SCREEN = 4
+BLEND_ADD = 8
+BLEND_SUBTRACT = 9
+
+# Frames each pool task renders, unless there are too few frames to keep every worker busy.
+FRAMES_PER_TASK = 32
+
+
+class SharedAtlases(object):
+    """
+    Atlases copied into one block of shared memory. handle is what workers need to map them, see attach_atlases.
+    """
+    def __init__(self, atlases):
+        layout = {}
+        offset = 0
+        for name, pixels in atlases.items():
+            layout[name] = (offset, pixels.shape)
+            offset += pixels.nbytes
+
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, offset))
+        for name, pixels in atlases.items():
+            start, shape = layout[name]
+            np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf, offset=start)[...] = pixels
+
+        self.handle = (self.memory.name, layout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.memory.close()
+        self.memory.unlink()
+
+
+# Shared memory name -> (SharedMemory, atlases) of the blocks a worker has mapped.
+_attached = {}
+
+def attach_atlases(handle):
+    """
+    Maps the atlases of a SharedAtlases handle as read-only arrays. Each block is only mapped once per process.
+    """
+    name, layout = handle
+    attached = _attached.get(name)
+    if attached is None:
+        memory = shared_memory.SharedMemory(name=name)
+        atlases = {}
+        for texture, (offset, shape) in layout.items():
+            atlases[texture] = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf, offset=offset)
+            atlases[texture].flags.writeable = False
+        attached = _attached[name] = (memory, atlases)
+    return attached[1]
+
+
+def load_atlases(tex_folder):
+    """
+    Composites every texture in a tex folder. Returns {texture name: (height, width, 4) RGBA pixels} and
+    {image name: texture name}.
+    """
+    atlases = {}
+    image_textures = {}
+    for name, size, sprites in canvas_jobs_from_texturelist(tex_folder):
+        atlases[name] = composite_canvas(size, sprites)
+        for filename, x, y in sprites:
+            image_textures[os.path.splitext(os.path.basename(filename))[0]] = name
+    return atlases, image_textures
+
+
+def load_afp(afp_filename):
+    # Extracted afps are still obfuscated when they have a bsi next to them.
+    with open(afp_filename, "rb") as infile:
+        data = bytearray(infile.read())
+
+    bsi_filename = find_bsi(afp_filename)
+    if bsi_filename is not None:
+        with open(bsi_filename, "rb") as infile:
+            decode_afp_data(data, infile.read())
+
+    return AfpFile(data)
+
+
+def load_shapes(afp, geo_folder, movie, image_textures):
+    """
+    Reads the geo file of every textured shape in an afp. Returns {tag index: (texture name, rect, uv)}, with rect
+    the top left and bottom right corners of the quad in pixels and uv the same corners on the texture, 0 to 1.
+    """
+    shapes = {}
+    for index in range(len(afp)):
+        if afp.tag_types[index] != AP2_SHAPE:
+            continue
+
+        geo_filename = os.path.join(geo_folder, "%s_shape%d" % (movie, afp.parse_tag(index).id))
+        if not os.path.exists(geo_filename):
+            continue
+
+        geo = read_geo_file(geo_filename)
+        if geo['label'] not in image_textures or geo['rects'] is None or geo['texture_rects'] is None:
+            continue
+
+        # georeader doubles rects, and scales both texture coordinates by twice the texture width.
+        top_left, bottom_right = geo['rects'][0], geo['rects'][3]
+        uv_scale = geo['texture_width'] * 2
+        uv_top_left, uv_bottom_right = geo['texture_rects'][0], geo['texture_rects'][3]
+        shapes[index] = (
+            image_textures[geo['label']],
+            (top_left[0] / 2, top_left[1] / 2, bottom_right[0] / 2, bottom_right[1] / 2),
+            (uv_top_left[0] / uv_scale, uv_top_left[1] / uv_scale, uv_bottom_right[0] / uv_scale, uv_bottom_right[1] / uv_scale),
+        )
+    return shapes
+
+
+def blend_pixels(dst, src, mode):
+    """
+    Blends premultiplied (n, 4) src pixels onto premultiplied dst pixels and returns the result.
+    """
+    src_alpha = src[:, 3:4]
+    dst_alpha = dst[:, 3:4]
+    alpha = src_alpha + dst_alpha * (1.0 - src_alpha)
+
+    if mode == BLEND_ADD:
+        rgb = dst[:, :3] + src[:, :3]
+    elif mode == BLEND_SUBTRACT:
+        rgb = dst[:, :3] - src[:, :3]
+        alpha = dst_alpha
+    elif mode == BLEND_MULTIPLY:
+        rgb = src[:, :3] * dst[:, :3] + src[:, :3] * (1.0 - dst_alpha) + dst[:, :3] * (1.0 - src_alpha)
+    elif mode == BLEND_SCREEN:
+        rgb = src[:, :3] + dst[:, :3] - src[:, :3] * dst[:, :3]
+    else:
+        rgb = src[:, :3] + dst[:, :3] * (1.0 - src_alpha)
+
+    return np.clip(np.concatenate([rgb, alpha], axis=1), 0.0, 1.0)
+
+
+def draw_quad(canvas, pixels, rect, uv, matrix, mult_color, add_color, blend):
+    """
+    Draws the rect of a shape into a premultiplied float (height, width, 4) canvas. matrix is the 2x3 transform from
+    the shape to the canvas, and each canvas pixel samples the nearest texel of pixels.
+    """
+    linear, translation = matrix[:, :2], matrix[:, 2]
+    if abs(np.linalg.det(linear)) < 1e-9:
+        return
+
+    x0, y0, x1, y1 = rect
+    if x0 == x1 or y0 == y1:
+        return
+
+    corners = linear @ np.array([[x0, x1, x0, x1], [y0, y0, y1, y1]], dtype=np.float64) + translation[:, None]
+    height, width = canvas.shape[:2]
+    left, top = np.maximum(np.floor(corners.min(axis=1)).astype(int), 0)
+    right, bottom = np.minimum(np.ceil(corners.max(axis=1)).astype(int), (width, height))
+    if left >= right or top >= bottom:
+        return
+
+    # Canvas pixel centers back to the shape's space, then to where they fall on the rect.
+    ys, xs = np.mgrid[top:bottom, left:right]
+    points = np.stack([xs.ravel() + 0.5, ys.ravel() + 0.5]) - translation[:, None]
+    local = np.linalg.solve(linear, points)
+    s = (local[0] - x0) / (x1 - x0)
+    t = (local[1] - y0) / (y1 - y0)
+    inside = (s >= 0.0) & (s < 1.0) & (t >= 0.0) & (t < 1.0)
+    if not inside.any():
+        return
+
+    texture_height, texture_width = pixels.shape[:2]
+    u = uv[0] + s[inside] * (uv[2] - uv[0])
+    v = uv[1] + t[inside] * (uv[3] - uv[1])
+    texels = pixels[
+        np.clip((v * texture_height).astype(int), 0, texture_height - 1),
+        np.clip((u * texture_width).astype(int), 0, texture_width - 1),
+    ].astype(np.float32) / 255.0
+
+    # Color transforms apply to straight colors, blending to premultiplied ones.
+    color = np.clip(texels * mult_color + add_color, 0.0, 1.0)
+    color[:, :3] *= color[:, 3:4]
+
+    ys, xs = ys.ravel()[inside], xs.ravel()[inside]
+    canvas[ys, xs] = blend_pixels(canvas[ys, xs], color, blend)
+
+
+def render_rows(rows, frame, shapes, atlases, size, view):
+    """
+    Renders one frame of evaluated rows. view is the 2x3 transform from the movie's coordinates to the canvas.
+    Returns premultiplied float (height, width, 4) pixels.
+    """
+    width, height = size
+    canvas = np.zeros((height, width, 4), dtype=np.float32)
+
+    # Paint in depth order: by the depths of every sprite an object is nested in, then its own.
+    paths = {}
+    for row in np.flatnonzero(rows['frame'] == frame):
+        parent = rows[row]['parent']
+        paths[row] = (paths[parent] if parent >= 0 else ()) + (int(rows[row]['depth']),)
+
+    for row in sorted(paths, key=paths.get):
+        shape = shapes.get(int(rows[row]['definition']))
+        if shape is None:
+            continue
+
+        texture, rect, uv = shape
+        matrix = view @ np.vstack([rows[row]['matrix'][:2, [0, 1, 3]], (0.0, 0.0, 1.0)])
+        draw_quad(
+            canvas, atlases[texture], rect, uv, matrix,
+            rows[row]['mult_color'].astype(np.float32), rows[row]['add_color'].astype(np.float32), rows[row]['blend']
+        )
+
+    return canvas
+
+
+def to_image(canvas, background=None):
+    """
+    Turns a premultiplied canvas into a PIL image. RGBA without a background, otherwise RGB over the (r, g, b)
+    background.
+    """
+    if background is not None:
+        rgb = canvas[:, :, :3] + np.array(background, dtype=np.float32) / 255.0 * (1.0 - canvas[:, :, 3:4])
+        return Image.fromarray((np.clip(rgb, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8), "RGB")
+
+    alpha = canvas[:, :, 3:4]
+    rgb = np.divide(canvas[:, :, :3], alpha, out=np.zeros_like(canvas[:, :, :3]), where=alpha > 0)
+    return Image.fromarray((np.clip(np.concatenate([rgb, alpha], axis=2), 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8), "RGBA")
+
+
+def movie_view(afp, scale):
+    # The movie's bounding box, scaled, becomes the canvas.
+    size = (max(1, int((afp.right - afp.left) * scale)), max(1, int((afp.bottom - afp.top) * scale)))
+    view = np.array([[scale, 0.0, -afp.left * scale], [0.0, scale, -afp.top * scale]], dtype=np.float64)
+    return size, view
+
+
+def _render_range(afp_filename, shapes, atlas_handle, size, view, start, count, rows, output_folder, background):
+    """
+    Renders count frames from start, given their evaluated rows. Frames are written as PNGs to output_folder, or
+    returned as images if it's None.
+    """
+    atlases = attach_atlases(atlas_handle)
+
+    frames = []
+    for i in range(count):
+        image = to_image(render_rows(rows, i, shapes, atlases, size, view), background)
+        if output_folder is not None:
+            image.save(os.path.join(output_folder, "%05d.png" % (start + i)))
+        else:
+            frames.append(image)
+
+    return afp_filename, start, count, frames
+
+
+def render_folder(ifs_folder, output_folder, movies=None, scale=1.0, gif=False, background=(0, 0, 0), jobs=None):
+    """
+    Renders every frame of the given movies (all of them by default) in an extracted IFS folder. Each movie goes to
+    output_folder/<movie>/NNNNN.png, or output_folder/<movie>.gif with gif. Returns the number of frames rendered
+    and a list of (movie, error).
+    """
+    afp_folder = os.path.join(ifs_folder, "afp")
+    if movies is None:
+        movies = [os.path.basename(x) for x in find_afp_files(afp_folder)]
+
+    atlases, image_textures = {}, {}
+    if os.path.exists(os.path.join(ifs_folder, "tex", "texturelist.xml")):
+        atlases, image_textures = load_atlases(os.path.join(ifs_folder, "tex"))
+
+    errors = []
+    fps = {}
+
+    def tasks(atlas_handle):
+        # Each movie is played once from the start, and every range is sent off with its evaluated rows, so workers
+        # never replay the frames before their range. Tasks are made as the pool takes them, so only a few ranges of
+        # rows are in memory at once.
+        for movie in movies:
+            afp_filename = os.path.join(afp_folder, movie)
+            try:
+                afp = load_afp(afp_filename)
+                shapes = load_shapes(afp, os.path.join(ifs_folder, "geo"), movie, image_textures)
+            except (AfpDecodeError, AfpParseError, GeoParseError, OSError, struct.error) as e:
+                errors.append((movie, str(e)))
+                continue
+
+            frame_folder = None
+            if not gif:
+                frame_folder = os.path.join(output_folder, movie)
+                os.makedirs(frame_folder, exist_ok=True)
+
+            fps[afp_filename] = afp.fps
+            size, view = movie_view(afp, scale)
+            playback = Playback(afp)
+            frame_count = afp.root.frame_count
+            per_task = max(1, min(FRAMES_PER_TASK, -(-frame_count // (jobs or os.cpu_count()))))
+            for start in range(0, frame_count, per_task):
+                count = min(per_task, frame_count - start)
+                yield (
+                    afp_filename, shapes, atlas_handle, size, view, start, count,
+                    evaluate_frames(playback, start, count), frame_folder, background if gif else None
+                )
+
+    with SharedAtlases(atlases) as shared:
+        # Ranges finish in any order, so GIF frames are put back in order once they're all in.
+        rendered = 0
+        gif_frames = {}
+        for afp_filename, start, count, frames in run_in_pool(_render_range, tasks(shared.handle), jobs):
+            rendered += count
+            if gif:
+                gif_frames.setdefault(afp_filename, []).append((start, frames))
+
+    if gif:
+        os.makedirs(output_folder, exist_ok=True)
+        for afp_filename, ranges in gif_frames.items():
+            frames = [frame for start, frames in sorted(ranges, key=lambda x: x[0]) for frame in frames]
+            if not frames:
+                continue
+            frames[0].save(
+                os.path.join(output_folder, os.path.basename(afp_filename) + ".gif"), save_all=True,
+                append_images=frames[1:], duration=int(round(1000.0 / (fps[afp_filename] or 60.0))), loop=0
+            )
+
+    return rendered, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ifs', help='Extracted IFS folder. A glob pattern (e.g. "dump/*_ifs") renders every folder it matches.')
+    parser.add_argument('output', help='Output folder')
+    parser.add_argument('-movie', nargs='+', help='Movies to render. Defaults to every afp in the folder.')
+    parser.add_argument('-scale', type=float, default=1.0, help='Scale of the output relative to the movie size')
+    parser.add_argument('-gif', action='store_true', help='Write a GIF per movie instead of a folder of PNGs')
+    parser.add_argument('-background', default='000000', help='Background color of GIFs, as hex RGB')
+    parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes. Defaults to the CPU count.")
+    args = parser.parse_args()
+
+    background = tuple(bytes.fromhex(args.background))
+    ifs_folders = [args.ifs] if os.path.isdir(args.ifs) else sorted(x for x in glob.glob(args.ifs) if os.path.isdir(x))
+    if not ifs_folders:
+        print("No IFS folders found in", args.ifs)
+        exit(1)
+
+    start_time = time.perf_counter()
+    total_frames = 0
+    all_errors = []
+    for ifs_folder in ifs_folders:
+        output_folder = args.output if len(ifs_folders) == 1 else os.path.join(args.output, os.path.basename(os.path.normpath(ifs_folder)))
+        rendered, errors = render_folder(ifs_folder, output_folder, args.movie, args.scale, args.gif, background, args.jobs)
+        total_frames += rendered
+        all_errors += [(os.path.join(ifs_folder, movie), error) for movie, error in errors]
+
+    for movie, error in all_errors:
+        print("Failed to render %s: %s" % (movie, error))
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    print("Rendered %d frames in %.2fs: %.1f frames/sec" % (total_frames, elapsed, total_frames / elapsed))
+    exit(1 if all_errors else 0)
@@ -0,0 +1,120 @@
+import cProfile
+import collections
+import contextlib
+import json
+import sys
+import time
+
+"""
+Counters and timers for the hot paths of the tools, exposed with --stats (JSON) and --profile (a cProfile dump that
+pstats or snakeviz can read). Everything is off until enable() is called. While it's off, count() returns straight
+away and timer() hands back one shared no-op context manager. Hot loops check stats.enabled before working out
+what to count, or add up a local count and report it once when they're done.
+
+Worker processes start each task with reset() and send snapshot() back with the result, and the parent merge()s
+it, so counts from a process pool add up the same as in one process.
+"""
+
+enabled = False
+
+counters = collections.Counter()
+
+# Timer name -> [seconds, calls]
+timers = collections.defaultdict(lambda: [0.0, 0])
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def reset():
+    counters.clear()
+    timers.clear()
+
+
+def count(name, value=1):
+    if enabled:
+        counters[name] += value
+
+
+class _Timer(object):
+    __slots__ = ('name', 'start_time')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        entry = timers[self.name]
+        entry[0] += time.perf_counter() - self.start_time
+        entry[1] += 1
+
+
+def timer(name):
+    """
+    with stats.timer("name"): adds the time spent in the block to the timer, if stats are enabled.
+    """
+    return _Timer(name) if enabled else _NULL_TIMER
+
+
+def snapshot():
+    # Everything counted so far, as plain JSON-friendly dicts. Empty if stats are off.
+    if not enabled:
+        return {}
+
+    return {
+        'counters': dict(sorted(counters.items())),
+        'timers': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in sorted(timers.items())},
+    }
+
+
+def merge(data):
+    # Adds a snapshot() from another process.
+    if not enabled or not data:
+        return
+
+    counters.update(data['counters'])
+    for name, timer_data in data['timers'].items():
+        entry = timers[name]
+        entry[0] += timer_data['seconds']
+        entry[1] += timer_data['calls']
+
+
+def add_arguments(parser):
+    parser.add_argument('--stats', nargs='?', const='-', metavar='FILE', help="Write counters and timers as JSON to FILE, or stdout if no FILE is given")
+    parser.add_argument('--profile', metavar='FILE', help="Write a cProfile dump of the run to FILE")
+
+
+@contextlib.contextmanager
+def session(stats_filename=None, profile_filename=None):
+    """
+    Enables stats and/or profiling for the duration of the block, and writes them out when it ends, even if it
+    ends with exit().
+    """
+    if stats_filename is not None:
+        enable()
+
+    profiler = None
+    if profile_filename is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_filename)
+
+        if stats_filename == '-':
+            json.dump(snapshot(), sys.stdout, indent=1)
+            print()
+        elif stats_filename is not None:
+            with open(stats_filename, "w") as outfile:
+                json.dump(snapshot(), outfile, indent=1)
@@ -0,0 +1,80 @@
+from afpbuilder import AfpBuilder
+from afpreader import AfpFile
+from playback import Playback
+
+
+def build_movie(build):
+    afp = AfpBuilder("test", (0, 100, 0, 100))
+    for shape_id in (10, 11, 12, 13):
+        afp.root.add_shape(shape_id)
+    build(afp.root)
+    return AfpFile(bytearray(afp.build()))
+
+
+def add_counter(root, sprite_id, shapes):
+    # A sprite that shows one shape per frame.
+    counter = root.add_sprite(sprite_id)
+    for i, shape_id in enumerate(shapes):
+        counter.place(1, 1, src_tag_id=shape_id, update=i > 0)
+        counter.show_frame()
+    return counter
+
+
+def shapes(state):
+    # src_tag_id of every shape on screen, parents first.
+    return [placement.src_tag_id for _, placement in state.walk() if placement.child is None]
+
+
+def test_sprite_in_one_frame_sprite_advances():
+    def build(root):
+        add_counter(root, 20, [10, 11, 12])
+        wrapper = root.add_sprite(21)
+        wrapper.place(1, 1, src_tag_id=20)
+        wrapper.show_frame()
+        root.place(1, 1, src_tag_id=21)
+        root.show_frame(5)
+
+    playback = Playback(build_movie(build))
+    assert [shapes(state) for state in playback.play(7)] == [[10], [11], [12], [10], [11], [12], [10]]
+
+
+def test_sprite_keeps_playing_when_parent_loops():
+    def build(root):
+        add_counter(root, 20, [10, 11, 12])
+        root.place(1, 1, src_tag_id=20)
+        root.show_frame(2)
+
+    playback = Playback(build_movie(build))
+    assert [shapes(state) for state in playback.play(5)] == [[10], [11], [12], [10], [11]]
+
+
+def test_sprite_replaced_before_loop_starts_over():
+    def build(root):
+        add_counter(root, 20, [10, 11, 12])
+        add_counter(root, 21, [13])
+        root.place(1, 1, src_tag_id=20)
+        root.show_frame(2)
+        root.place(1, 1, src_tag_id=21)
+        root.show_frame()
+
+    playback = Playback(build_movie(build))
+    assert [shapes(state) for state in playback.play(7)] == [[10], [11], [13], [10], [11], [13], [10]]
+
+
+def test_seek_by_tick():
+    def build(root):
+        add_counter(root, 20, [10, 11, 12])
+        root.place(1, 1, src_tag_id=20)
+        root.show_frame(4)
+
+    afp = build_movie(build)
+    expected = [shapes(state) for state in Playback(afp).play(20)]
+
+    playback = Playback(afp, snapshot_interval=2, max_snapshots=4)
+    list(playback.play(20))
+    for tick in (13, 2, 19, 0, 7):
+        assert shapes(playback.seek_tick(tick)) == expected[tick]
+        assert playback.tick == tick
+
+    # Seeking to a frame goes to the first time it's played.
+    assert shapes(playback.seek(3)) == expected[3]
@@ -1,13 +1,20 @@
 # Based on http://code.activestate.com/recipes/442299/
 import glob
+import hashlib
+import math
 import os
+import struct
 import sys
 
+import numpy as np
 from PIL import Image
 
 from lxml import etree, objectify
 from lxml.builder import E
 
+import stats
+from dxt import texture_vram
+
 class PackNode(object):
     """
     Creates an area which can recursively pack other areas of smaller sizes into itself.
@@ -43,56 +50,333 @@ class PackNode(object):
             self.child[1] = PackNode((self.area[0], self.area[1]+area.height, self.area[2], self.area[3]))
             return PackNode((self.area[0], self.area[1], self.area[0]+area.width, self.area[1]+area.height))
 
-def create_texturelist(input_path, images):
-    size = 1024, 1024
+# Canvas limits seen in real texturelists, see CANVAS_TEXTURE_ANALYSIS.md.
+MAX_CANVAS_WIDTH = 2048
+MAX_CANVAS_HEIGHT = 4096
 
-    names = [[os.path.join(input_path, x), x] for x in list(set(images))]
-    print(names)
+# Transparent border around every image, so filtering never samples its neighbors.
+GUTTER = 1
 
-    images = [(i.size[0] * i.size[1], name, i, basename) for name, basename, i in ((x[0], x[1], Image.open(x[0])) for x in names)]
+class MaxRectsBin(object):
+    """
+    A canvas packed with the MaxRects algorithm. All maximal free rectangles are kept in a numpy array, so finding a
+    spot and splitting the free rectangles it overlaps stays fast with thousands of images. Images go as high up and
+    then as far left as they fit, so the canvas grows downward.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
 
-    tree = PackNode(size)
+        # x, y, width, height
+        self.free = np.array([[0, 0, width, height]], dtype=np.int64)
 
-    package_texture = []
-    current_texture = []
-    image_lookup = {}
+        # Bounds of everything placed so far
+        self.used_width = 0
+        self.used_height = 0
+
+    def __repr__(self):
+        return "<%s %dx%d used:%dx%d free rects:%d>" % (
+            self.__class__.__name__, self.width, self.height, self.used_width, self.used_height, len(self.free)
+        )
+
+    def insert(self, width, height):
+        """
+        Places a width x height rectangle and returns its (x, y), or None if it doesn't fit.
+        """
+        free = self.free
+        candidates = free[(free[:, 2] >= width) & (free[:, 3] >= height)]
+        if not len(candidates):
+            return None
+
+        best = np.lexsort((candidates[:, 0], candidates[:, 1]))[0]
+        x, y = int(candidates[best, 0]), int(candidates[best, 1])
+
+        self.occupy(x, y, width, height)
+        return x, y
+
+    def occupy(self, x, y, width, height):
+        """
+        Marks a rectangle as used, e.g. to keep an image where it was on a previous build.
+        """
+        self._split(x, y, width, height)
+        self.used_width = max(self.used_width, x + width)
+        self.used_height = max(self.used_height, y + height)
+
+    def _split(self, x, y, width, height):
+        free = self.free
+        free_x, free_y, free_w, free_h = free[:, 0], free[:, 1], free[:, 2], free[:, 3]
+
+        overlaps = (free_x < x + width) & (free_x + free_w > x) & (free_y < y + height) & (free_y + free_h > y)
+        kept = free[~overlaps]
+        split = free[overlaps]
+        split_x, split_y, split_w, split_h = split[:, 0], split[:, 1], split[:, 2], split[:, 3]
+
+        # Whatever is left of each overlapped rectangle to the left, right, top and bottom of the placed one.
+        right = x + width
+        bottom = y + height
+        pieces = np.concatenate([
+            np.stack([split_x, split_y, x - split_x, split_h], axis=1)[split_x < x],
+            np.stack([np.full_like(split_x, right), split_y, split_x + split_w - right, split_h], axis=1)[right < split_x + split_w],
+            np.stack([split_x, split_y, split_w, y - split_y], axis=1)[split_y < y],
+            np.stack([split_x, np.full_like(split_y, bottom), split_w, split_y + split_h - bottom], axis=1)[bottom < split_y + split_h],
+        ])
+
+        if len(pieces):
+            # Only the new pieces need pruning. The kept rectangles were already maximal, and every piece lies inside
+            # a rectangle that was, so no piece can contain a kept rectangle.
+            piece_x, piece_y = pieces[:, 0:1], pieces[:, 1:2]
+            piece_right, piece_bottom = piece_x + pieces[:, 2:3], piece_y + pieces[:, 3:4]
+
+            def contained_in(rects):
+                # [piece, rect] is True if the piece is inside the rect
+                return (
+                    (rects[:, 0] <= piece_x) & (rects[:, 1] <= piece_y) &
+                    (rects[:, 0] + rects[:, 2] >= piece_right) & (rects[:, 1] + rects[:, 3] >= piece_bottom)
+                )
+
+            redundant = contained_in(kept).any(axis=1)
+
+            # Of identical pieces, only the first one is kept.
+            inside = contained_in(pieces)
+            index = np.arange(len(pieces))
+            inside &= ~(inside & inside.T) | (index[None, :] < index[:, None])
+            inside[index, index] = False
+            redundant |= inside.any(axis=1)
+
+            pieces = pieces[~redundant]
 
-    while len(images) > 0:
-        images_not_used = []
+        self.free = np.concatenate([kept, pieces])
+
+def grid_layout(count, cell_size, max_width=MAX_CANVAS_WIDTH, max_height=MAX_CANVAS_HEIGHT):
+    """
+    Lays out count cells of the same size in square-ish grids, like the icon and jacket sets. Returns the
+    (canvas index, x, y) of each cell and the size of each canvas.
+    """
+    cell_width, cell_height = cell_size
+    max_columns = max_width // cell_width
+    max_rows = max_height // cell_height
+    if max_columns < 1 or max_rows < 1:
+        raise ValueError("A %dx%d image doesn't fit in a %dx%d canvas" % (cell_width, cell_height, max_width, max_height))
+
+    placements = []
+    canvas_sizes = []
+
+    remaining = count
+    while remaining > 0:
+        columns = min(max_columns, math.ceil(math.sqrt(remaining)))
+        rows = min(max_rows, math.ceil(remaining / columns))
+        cells = min(remaining, columns * rows)
+
+        for i in range(cells):
+            placements.append((len(canvas_sizes), (i % columns) * cell_width, (i // columns) * cell_height))
+
+        canvas_sizes.append((min(cells, columns) * cell_width, math.ceil(cells / columns) * cell_height))
+        remaining -= cells
+
+    return placements, canvas_sizes
+
+def pack_images(sizes, max_width=MAX_CANVAS_WIDTH, max_height=MAX_CANVAS_HEIGHT, fixed=None):
+    """
+    Packs (width, height) cells into as few canvases as possible, largest first. Sets of identically sized cells are
+    laid out in a grid instead. Returns the (canvas index, x, y) of each cell, in the same order as sizes, and the
+    size of each canvas, cropped to the cells in it.
+
+    fixed can give a (canvas index, x, y) to keep for any cell, e.g. from a previous build, so unchanged images stay
+    put and the rest are packed around them. Canvases left empty are dropped.
+    """
+    if not sizes:
+        return [], []
+
+    fixed = fixed or {}
+    if not fixed and len(sizes) > 1 and len(set(sizes)) == 1:
+        stats.count("packer_grid_layouts")
+        return grid_layout(len(sizes), sizes[0], max_width, max_height)
+
+    for width, height in sizes:
+        if width > max_width or height > max_height:
+            raise ValueError("A %dx%d image doesn't fit in a %dx%d canvas" % (width, height, max_width, max_height))
+
+    placements = [None] * len(sizes)
+    bins = []
+
+    # Previous canvases are reopened as wide as the cells kept on them.
+    kept_canvases = sorted(set(canvas for canvas, x, y in fixed.values()))
+    for canvas in kept_canvases:
+        cells = [(i, x, y) for i, (fixed_canvas, x, y) in fixed.items() if fixed_canvas == canvas]
+        canvas_width = max(x + sizes[i][0] for i, x, y in cells)
+        bins.append(MaxRectsBin(canvas_width, max_height))
+        for i, x, y in cells:
+            bins[-1].occupy(x, y, *sizes[i])
+            placements[i] = (len(bins) - 1, x, y)
+
+    order = sorted(
+        (i for i in range(len(sizes)) if i not in fixed),
+        key=lambda i: (-sizes[i][0] * sizes[i][1], -max(sizes[i]), i)
+    )
+    remaining_area = sum(sizes[i][0] * sizes[i][1] for i in order)
+
+    # Counted locally and reported once, so the loop doesn't pay for stats.
+    insert_attempts = 0
+    spilled = 0
+
+    for i in order:
+        width, height = sizes[i]
+
+        # First fit across every canvas opened so far.
+        for bin_index, canvas in enumerate(bins):
+            insert_attempts += 1
+            position = canvas.insert(width, height)
+            if position is not None:
+                break
+        else:
+            spilled += 1 if bins else 0
+            insert_attempts += 1
+
+            # New canvases start out about as wide as a square holding everything left would be, and grow down.
+            canvas_width = min(max_width, max(width, math.ceil(math.sqrt(remaining_area))))
+            bins.append(MaxRectsBin(canvas_width, max_height))
+            bin_index = len(bins) - 1
+            position = bins[-1].insert(width, height)
+
+        placements[i] = (bin_index,) + position
+        remaining_area -= width * height
+
+    stats.count("packer_images", len(order))
+    stats.count("packer_insert_attempts", insert_attempts)
+    stats.count("packer_canvases_spilled", spilled)
+    return placements, [(canvas.used_width, canvas.used_height) for canvas in bins]
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Absolute filename -> (mtime, file size, image size)
+_image_size_cache = {}
+
+def image_size(filename):
+    """
+    Returns the (width, height) of an image without decoding it. PNGs only have their IHDR chunk read, anything else
+    is left to PIL, which also only reads the header. Sizes are cached until the file changes.
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+
+    cached = _image_size_cache.get(filename)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    with open(filename, "rb") as infile:
+        header = infile.read(24)
+
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+        size = struct.unpack_from(">II", header, 16)
+    else:
+        with Image.open(filename) as img:
+            size = img.size
+
+    _image_size_cache[filename] = (stat.st_mtime_ns, stat.st_size, size)
+    return size
+
+def pixel_hash(filename):
+    """
+    Hashes an image's decoded RGBA pixels along with its size, so the same picture saved twice hashes the same no
+    matter how each file was compressed.
+    """
+    with Image.open(filename) as img:
+        img = img.convert("RGBA")
+        return hashlib.sha1(struct.pack("<II", *img.size) + img.tobytes()).hexdigest()
+
+def dedupe_images(input_path, images):
+    """
+    Maps every image name to the first name, in sorted order, of an image with the same pixels. Only the names it
+    maps to need to be packed.
+    """
+    canonical = {}
+    by_hash = {}
+    for name in sorted(set(images)):
+        canonical[name] = by_hash.setdefault(pixel_hash(os.path.join(input_path, name)), name)
+    return canonical
+
+def load_cell(filename, cell_size=None):
+    """
+    Loads an image as RGBA with a transparent gutter around it, the way it's laid out on its canvas. cell_size can
+    add extra slack on the right and bottom. The file is closed before returning, so only the image being written
+    is ever held in memory.
+    """
+    with Image.open(filename) as img:
+        img = img.convert("RGBA")
+
+    if cell_size is None:
+        cell_size = (img.size[0] + GUTTER * 2, img.size[1] + GUTTER * 2)
+
+    cell = Image.new("RGBA", cell_size, (0, 0, 0, 0))
+    cell.paste(img, (GUTTER, GUTTER))
+    return cell
+
+def create_texturelist(input_path, images, select_format=None, previous=None):
+    """
+    Packs images into canvases and builds their texturelist.xml. select_format(canvas size, sprites) picks each
+    canvas's format, with sprites as (filename, x, y) of every image on it, and returns the format and the reason
+    for it. Without it everything is argb8888rev.
+
+    previous maps image names to the cell area and canvas they had in image_lookup from an earlier build. Images
+    whose cell is still the same size are kept where they were.
+    """
+    names = [[os.path.join(input_path, x), x] for x in sorted(set(images))]
+
+    # Packing only needs the sizes, pixels are loaded one image at a time when they're written out.
+    sizes = [image_size(name) for name, basename in names]
+
+    # Each image gets a cell with a gutter all around it. When canvases can be dxt5, cells are rounded up to whole
+    # 4x4 blocks with extra slack on the right and bottom, like the game's own texturelists.
+    cells = [(width + GUTTER * 2, height + GUTTER * 2) for width, height in sizes]
+    if select_format is not None:
+        cells = [(-(-width // 4) * 4, -(-height // 4) * 4) for width, height in cells]
+    fixed = {}
+    for i, (name, basename) in enumerate(names):
+        area, _, canvas = (previous or {}).get(basename, (None, None, None))
+        if area is not None and (area[2] - area[0], area[3] - area[1]) == cells[i]:
+            fixed[i] = (canvas, area[0], area[1])
+
+    placements, canvas_sizes = pack_images(cells, fixed=fixed)
+
+    package_texture = [[] for _ in canvas_sizes]
+    image_lookup = {}
 
-        #insert each image into the PackNode area
-        for area, name, img, basename in images:
-            uv = tree.insert(img.size)
+    # Largest first, in the order they were packed
+    for i in sorted(range(len(names)), key=lambda i: -cells[i][0] * cells[i][1]):
+        canvas, x, y = placements[i]
+        area = (x, y, x + cells[i][0], y + cells[i][1])
+        uv = (x + GUTTER, y + GUTTER, x + GUTTER + sizes[i][0], y + GUTTER + sizes[i][1])
 
-            if uv is None:
-                images_not_used.append((area, name, img, basename))
-            else:
-                current_texture.append((uv, name))
-                image_lookup[basename] = [uv.area, img.size]
+        package_texture[canvas].append((area, names[i][0], uv))
+        image_lookup[names[i][1]] = [area, sizes[i], canvas]
 
-        images = images_not_used
-        tree = PackNode(size)
+    formats = ["argb8888rev"] * len(canvas_sizes)
+    if select_format is not None:
+        for i, textures in enumerate(package_texture):
+            formats[i], reason = select_format(canvas_sizes[i], [(texture[1], texture[2][0], texture[2][1]) for texture in textures])
+            print("tex{0:03d} {1}x{2}: {3} ({4})".format(i, canvas_sizes[i][0], canvas_sizes[i][1], formats[i], reason))
 
-        package_texture.append(current_texture)
-        current_texture = []
+        uncompressed = sum(texture_vram(size, "argb8888rev") for size in canvas_sizes)
+        compressed = sum(texture_vram(size, texture_format) for size, texture_format in zip(canvas_sizes, formats))
+        print("VRAM: {0} KB, {1} KB saved over argb8888rev".format(compressed // 1024, (uncompressed - compressed) // 1024))
 
     textures = [E.texture(
         E.size(
-            "{} {}".format(size[0], size[1]),
+            "{} {}".format(canvas_sizes[i][0], canvas_sizes[i][1]),
             __type="2u16",
         ),
         *[E.image(
             E.uvrect(
-                "{} {} {} {}".format((texture[0].area[0] + 1) * 2, (texture[0].area[2] - 1) * 2, (texture[0].area[1] + 1) * 2, (texture[0].area[3] - 1) * 2),
+                "{} {} {} {}".format(texture[2][0] * 2, texture[2][2] * 2, texture[2][1] * 2, texture[2][3] * 2),
                 __type="4u16"
             ),
             E.imgrect(
-                "{} {} {} {}".format(texture[0].area[0] * 2, texture[0].area[2] * 2, texture[0].area[1] * 2, texture[0].area[3] * 2),
+                "{} {} {} {}".format(texture[0][0] * 2, texture[0][2] * 2, texture[0][1] * 2, texture[0][3] * 2),
                 __type="4u16"
             ),
             name=os.path.splitext(os.path.basename(texture[1]))[0]
         ) for texture in package_texture[i]],
-        format="argb8888rev",
+        format=formats[i],
         mag_filter="nearest",
         min_filter="nearest",
         name="tex{0:03d}".format(i),
@@ -105,4 +389,4 @@ def create_texturelist(input_path, images):
         compress="avslz"
     )
 
-    return size, etree.tostring(texturelist, pretty_print=True), image_lookup
+    return canvas_sizes, etree.tostring(texturelist, pretty_print=True), image_lookup
\ No newline at end of file
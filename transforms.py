@@ -0,0 +1,198 @@
+import argparse
+
+import numpy as np
+
+from afpreader import AfpFile
+from playback import Playback
+
+"""
+Evaluates the world transforms and colors of everything on the display list, for one or many frames at once.
+Every placed object is flattened into a row, then each nesting level is composed with its parents in a single
+vectorized pass. Matrices are 4x4 and multiply column vectors, so 2D renderers can use matrix[:2, [0, 1, 3]].
+
+Each local matrix is T(translate) * M * T(-rot_origin): the object's rotation origin is moved to the origin, scaled
+and rotated there, then translated into place. The rotation origin is also passed through in the output.
+"""
+
+EVALUATED_DTYPE = np.dtype([
+    ('frame', np.int32),        # Index of the state the row came from
+    ('nesting', np.int32),      # 0 for objects on the root clip
+    ('parent', np.int32),       # Row of the sprite this object was placed in, or -1
+    ('depth', np.int32),
+    ('src_tag_id', np.int32),   # -1 if the placement never had one
+    ('definition', np.int32),   # Tag index of the shape, image or sprite, or -1
+    ('perspective', np.bool_),  # flags1 & 0x4000000 somewhere in the chain
+    ('blend', np.int32),        # Blend mode of the object, or of its nearest parent that has one. 0 is normal.
+    ('matrix', np.float64, (4, 4)),
+    ('mult_color', np.float64, (4,)),
+    ('add_color', np.float64, (4,)),
+    ('hsl', np.float64, (3,)),
+    ('rot_origin', np.float64, (3,)),
+])
+
+
+def _value(value, default):
+    return default if value is None else value
+
+
+def flatten_states(states):
+    """
+    Flattens the display lists of a list of ClipStates into rows, parents always before their children.
+    Returns the rows of placements, and arrays of the state index, nesting level and parent row of each one.
+    """
+    placements = []
+    frames = []
+    nesting = []
+    parents = []
+
+    for frame, state in enumerate(states):
+        # (state, nesting level, parent row)
+        pending = [(state, 0, -1)]
+        while pending:
+            clip_state, level, parent = pending.pop()
+            for depth in sorted(clip_state.display_list):
+                placement = clip_state.display_list[depth]
+                row = len(placements)
+                placements.append(placement)
+                frames.append(frame)
+                nesting.append(level)
+                parents.append(parent)
+                if placement.child is not None:
+                    pending.append((placement.child, level + 1, row))
+
+    return placements, np.array(frames, dtype=np.int32), np.array(nesting, dtype=np.int32), np.array(parents, dtype=np.int32)
+
+
+def local_transforms(placements):
+    """
+    Builds the local 4x4 matrix, color transform and HSL shift of every placement.
+    """
+    count = len(placements)
+
+    a = np.array([_value(p.matrix_a, 1.0) for p in placements], dtype=np.float64)
+    b = np.array([_value(p.matrix_b, 0.0) for p in placements], dtype=np.float64)
+    c = np.array([_value(p.matrix_c, 0.0) for p in placements], dtype=np.float64)
+    d = np.array([_value(p.matrix_d, 1.0) for p in placements], dtype=np.float64)
+    tx = np.array([_value(p.matrix_tx, 0.0) for p in placements], dtype=np.float64)
+    ty = np.array([_value(p.matrix_ty, 0.0) for p in placements], dtype=np.float64)
+    tz = np.array([_value(p.translate_z_3d, 0.0) for p in placements], dtype=np.float64)
+
+    matrices = np.zeros((count, 4, 4), dtype=np.float64)
+    matrices[:, 0, 0] = a
+    matrices[:, 1, 0] = b
+    matrices[:, 0, 1] = c
+    matrices[:, 1, 1] = d
+    matrices[:, 2, 2] = 1.0
+    matrices[:, 0, 3] = tx
+    matrices[:, 1, 3] = ty
+    matrices[:, 2, 3] = tz
+    matrices[:, 3, 3] = 1.0
+
+    # transform_3D is stored a11..a33 for row vectors, like the 2D a, b, c, d, so it's transposed for column vectors.
+    has_3d = np.array([p.matrix_3d is not None for p in placements], dtype=np.bool_)
+    if has_3d.any():
+        matrix_3d = np.array([p.matrix_3d for p in placements if p.matrix_3d is not None], dtype=np.float64)
+        matrices[has_3d, :3, :3] = matrix_3d.reshape(-1, 3, 3).transpose(0, 2, 1)
+
+    rot_origin = np.array([
+        (_value(p.rot_origin_x, 0.0), _value(p.rot_origin_y, 0.0), _value(p.rot_origin_z, 0.0)) for p in placements
+    ], dtype=np.float64).reshape(count, 3)
+
+    # Folds T(-rot_origin) into the translation, so the matrix is T(translate) * M * T(-rot_origin).
+    matrices[:, :3, 3] -= np.einsum('nij,nj->ni', matrices[:, :3, :3], rot_origin)
+
+    mult_color = np.array([_value(p.mult_color, (1.0, 1.0, 1.0, 1.0)) for p in placements], dtype=np.float64).reshape(count, 4)
+    add_color = np.array([_value(p.add_color, (0.0, 0.0, 0.0, 0.0)) for p in placements], dtype=np.float64).reshape(count, 4)
+
+    # Hue is in degrees and saturation/lightness in percent, see struct HSL in AFP_FORMAT.MD.
+    hsl = np.array([_value(p.hsl, (0, 0, 0)) for p in placements], dtype=np.float64).reshape(count, 3)
+    hsl /= (360.0, 100.0, 100.0)
+
+    return matrices, mult_color, add_color, hsl, rot_origin
+
+
+def evaluate_states(states, root_matrix=None):
+    """
+    Evaluates every placed object of a list of ClipStates, e.g. every frame of a Playback. Returns a structured
+    array of EVALUATED_DTYPE, one row per placed object.
+    """
+    placements, frames, nesting, parents = flatten_states(states)
+    result = np.zeros(len(placements), dtype=EVALUATED_DTYPE)
+    if not placements:
+        return result
+
+    matrices, mult_color, add_color, hsl, rot_origin = local_transforms(placements)
+    perspective = np.array([bool(p.perspective) for p in placements], dtype=np.bool_)
+    blend = np.array([_value(p.blend, 0) for p in placements], dtype=np.int32)
+
+    top = nesting == 0
+    if root_matrix is not None:
+        matrices[top] = np.asarray(root_matrix, dtype=np.float64) @ matrices[top]
+
+    # Parents always come before their children, so composing level by level only ever reads finished rows.
+    for level in range(1, int(nesting.max()) + 1):
+        rows = np.flatnonzero(nesting == level)
+        parent_rows = parents[rows]
+
+        matrices[rows] = matrices[parent_rows] @ matrices[rows]
+
+        # (color * child_mult + child_add) * parent_mult + parent_add
+        add_color[rows] = add_color[rows] * mult_color[parent_rows] + add_color[parent_rows]
+        mult_color[rows] *= mult_color[parent_rows]
+
+        hsl[rows] += hsl[parent_rows]
+        perspective[rows] |= perspective[parent_rows]
+
+        # Modes 0 and 1 are both normal, so those take their parent's mode.
+        inherit = blend[rows] <= 1
+        blend[rows[inherit]] = blend[parent_rows[inherit]]
+
+    result['frame'] = frames
+    result['nesting'] = nesting
+    result['parent'] = parents
+    result['depth'] = [p.depth for p in placements]
+    result['src_tag_id'] = [_value(p.src_tag_id, -1) for p in placements]
+    result['definition'] = [_value(p.definition, -1) for p in placements]
+    result['perspective'] = perspective
+    result['blend'] = blend
+    result['matrix'] = matrices
+    result['mult_color'] = mult_color
+    result['add_color'] = add_color
+    result['hsl'] = hsl
+    result['rot_origin'] = rot_origin
+
+    return result
+
+
+def evaluate_frames(playback, start, count, root_matrix=None):
+    """
+    Evaluates count frames of a Playback, starting at a frame number or label and looping as needed.
+    """
+    states = [playback.seek(start)]
+    states.extend(playback.play(count - 1))
+    return evaluate_states(states, root_matrix)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_afp', help='Input decoded AFP file')
+    parser.add_argument('-seek', default='0', help='Frame number or label to start at')
+    parser.add_argument('-count', type=int, default=1, help='Number of frames to evaluate')
+    args = parser.parse_args()
+
+    playback = Playback(AfpFile.from_file(args.input_afp))
+    start = int(args.seek) if args.seek.isdigit() else args.seek
+
+    try:
+        result = evaluate_frames(playback, start, max(1, args.count))
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
+        exit(1)
+
+    for row in result:
+        matrix = row['matrix']
+        print("frame:%d %sdepth:%d id:%d  a:%.3f b:%.3f c:%.3f d:%.3f tx:%.2f ty:%.2f  mult:%s add:%s" % (
+            row['frame'], "  " * row['nesting'], row['depth'], row['src_tag_id'],
+            matrix[0, 0], matrix[1, 0], matrix[0, 1], matrix[1, 1], matrix[0, 3], matrix[1, 3],
+            np.round(row['mult_color'], 3).tolist(), np.round(row['add_color'], 3).tolist(),
+        ))